@@ -0,0 +1,132 @@
+import socket
+import struct
+import threading
+import time
+
+# struct tcp_info starts with eight one-byte fields followed by u32s; on a listening socket tcpi_unacked is the
+# number of connections waiting in the accept queue and tcpi_sacked is the backlog it was created with.
+TCP_INFO_HEAD = struct.Struct('8B6I')
+
+
+class RateLimit:
+    """
+    A token bucket allowing rate events per second with bursts of up to burst events.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Admission:
+    """
+    Decides, at accept time, whether a new connection may stay: caps how many connections are open overall and
+    from one address, and how many new ones are let in per second overall and from one address. Refusals are
+    counted by reason so an operator can see what a reconnect storm ran into.
+    """
+    def __init__(self, maxClients, maxPerAddress, newPerSecond, newPerAddressPerSecond):
+        self.max_clients = maxClients
+        self.max_per_address = maxPerAddress
+        self.new_per_address_per_second = newPerAddressPerSecond
+        self.rate = RateLimit(newPerSecond)
+        self.address_rates = {} # IP Address -> RateLimit
+        self.connected = {} # IP Address -> number of open connections
+        self.total = 0
+        self.lock = threading.Lock()
+        self.counters = {"accepted": 0, "refused_clients": 0, "refused_address_clients": 0, "refused_rate": 0,
+                         "refused_address_rate": 0}
+
+    def admit(self, address):
+        # Returns None and counts the connection if it may stay, or the name of the limit it ran into.
+        now = time.monotonic()
+
+        with self.lock:
+            if self.total >= self.max_clients:
+                reason = "refused_clients"
+            elif self.connected.get(address, 0) >= self.max_per_address:
+                reason = "refused_address_clients"
+            elif not self.address_rate(address).take(now):
+                reason = "refused_address_rate"
+            elif not self.rate.take(now):
+                reason = "refused_rate"
+            else:
+                self.count(address)
+                self.counters["accepted"] += 1
+                return None
+
+            self.counters[reason] += 1
+            return reason
+
+    def address_rate(self, address):
+        rate = self.address_rates.get(address)
+        if rate is None:
+            if len(self.address_rates) >= 4 * self.max_clients: # forget addresses whose buckets have refilled.
+                now = time.monotonic()
+                for idle in [key for key, value in self.address_rates.items() if value.full(now)]:
+                    del self.address_rates[idle]
+            rate = self.address_rates[address] = RateLimit(self.new_per_address_per_second)
+        return rate
+
+    def track(self, address):
+        # Counts a connection that did not come through admit, such as one handed over by a hot restart.
+        with self.lock:
+            self.count(address)
+
+    def count(self, address):
+        self.connected[address] = self.connected.get(address, 0) + 1
+        self.total += 1
+
+    def release(self, address):
+        with self.lock:
+            count = self.connected.get(address, 0)
+            if count <= 0:
+                return
+            if count == 1:
+                del self.connected[address]
+            else:
+                self.connected[address] = count - 1
+            self.total -= 1
+
+
+def accept_queue(listenSocket):
+    # (connections waiting to be accepted, backlog), or None where the platform does not report it.
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+
+    try:
+        info = listenSocket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_HEAD.size)
+    except OSError:
+        return None
+
+    fields = TCP_INFO_HEAD.unpack(info[:TCP_INFO_HEAD.size])
+    return fields[12], fields[13]
+
+
+def listen_overflows():
+    # The kernel's count of connections dropped because an accept queue was full (Linux, all sockets), or None.
+    try:
+        with open("/proc/net/netstat") as netstat:
+            lines = netstat.read().splitlines()
+    except OSError:
+        return None
+
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            counters = dict(zip(names.split()[1:], values.split()[1:]))
+            return int(counters.get("ListenOverflows", 0)), int(counters.get("ListenDrops", 0))
+    return None
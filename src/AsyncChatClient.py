@@ -0,0 +1,240 @@
+import asyncio
+import collections
+import re
+import Framing
+import Util
+
+# Everything the server sends arrives as one of these instead of a raw string.
+Welcome = collections.namedtuple('Welcome', 'username')
+Joined = collections.namedtuple('Joined', 'channel users history')
+Focused = collections.namedtuple('Focused', 'channel')
+Parted = collections.namedtuple('Parted', 'channel')
+UserJoined = collections.namedtuple('UserJoined', 'channel username users')
+UserLeft = collections.namedtuple('UserLeft', 'channel username')
+Message = collections.namedtuple('Message', 'channel sender text sequence')
+HistoryPage = collections.namedtuple('HistoryPage', 'channel position text')
+Notice = collections.namedtuple('Notice', 'text')
+Presence = collections.namedtuple('Presence', 'states') # {username: "online", "away" or "offline"}
+ServerShutdown = collections.namedtuple('ServerShutdown', '')
+Closed = collections.namedtuple('Closed', '')
+
+WELCOME_PATTERN = re.compile(r'> Welcome (\S+), type /help')
+JOINED_PATTERN = re.compile(r'> You have joined the channel (\S+)!\n\|([^|]*)\|(.*)', re.DOTALL)
+USER_JOINED_PATTERN = re.compile(r'> (\S+) has joined the channel (\S+)!\n\|([^|]*)\|')
+USER_LEFT_PATTERN = re.compile(r'> (\S+) has left the channel (\S+)')
+PARTED_PATTERN = re.compile(r'> You have left the channel (\S+)')
+
+
+def parse_event(payload):
+    # Turns one framed reply into an event, or None for replies that only carried control tags.
+    text, tags, remainder = Util.split_tags(payload)
+    states = dict(args[:2] for kind, args in tags if kind == 'presence')
+    if states:
+        return Presence(states)
+    tags = dict((kind, args) for kind, args in tags)
+
+    if 'focus' in tags:
+        return Focused(tags['focus'][0])
+    if 'history' in tags:
+        return HistoryPage(tags['history'][0], int(tags['history'][1]), text)
+    if 'seq' in tags and 'from' not in tags:
+        sender, separator, message = text.partition(':')
+        return Message(tags['seq'][0], sender, message.strip(), int(tags['seq'][1]))
+    if text == '/squit':
+        return ServerShutdown()
+    if text == '/quit':
+        return Closed()
+
+    for pattern, build in ((JOINED_PATTERN, lambda match: Joined(match.group(1), match.group(2).split(), match.group(3))),
+                           (USER_JOINED_PATTERN, lambda match: UserJoined(match.group(2), match.group(1),
+                                                                          match.group(3).split())),
+                           (USER_LEFT_PATTERN, lambda match: UserLeft(match.group(2), match.group(1))),
+                           (PARTED_PATTERN, lambda match: Parted(match.group(1))),
+                           (WELCOME_PATTERN, lambda match: Welcome(match.group(1)))):
+        match = pattern.search(text)
+        if match:
+            return build(match)
+
+    return Notice(text) if text.strip() else None
+
+
+class AsyncChatClient:
+    """
+    An asyncio connection to the chat server for bots. Commands are newline framed and can be pipelined without
+    waiting for replies; replies come back framed and are handed out as typed events. send() only waits once more
+    than highWater bytes are queued for the socket, and a consumer that falls queueSize events behind stops the
+    connection being read, so a slow bot pushes back on the server instead of buffering without limit.
+    """
+    def __init__(self, host, port, fullname, queueSize=1000, highWater=64 * 1024):
+        self.host = host
+        self.port = port
+        self.fullname = fullname
+        self.high_water = highWater
+        self.events = asyncio.Queue(queueSize)
+        self.skipped = collections.deque() # events passed over by wait_for, handed out first by next_event.
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.username = None
+        self.resume_token = None
+        self.closed = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    async def connect(self, timeout=30):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.transport.set_write_buffer_limits(high=self.high_water)
+
+        # The capability request and the name are pipelined; the server answers the first with a framed tag, and
+        # whatever came before that tag is the unframed greeting.
+        await self.send('/caps ' + Framing.CAPABILITY, self.fullname)
+        await asyncio.wait_for(self.reader.readuntil((Util.TAG_START + 'caps').encode('utf8')), timeout)
+        capabilities = (await self.reader.readuntil(Util.TAG_END.encode('utf8'))).decode('utf8')[:-1].split()
+
+        if Framing.CAPABILITY not in capabilities:
+            self.writer.close()
+            raise ConnectionError("The server at {0}:{1} does not support framed connections."
+                                  .format(self.host, self.port))
+
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+        self.username = (await self.wait_for(Welcome, timeout=timeout)).username
+        return self
+
+    async def read_frames(self):
+        try:
+            while True:
+                length = Framing.HEADER.unpack(await self.reader.readexactly(Framing.HEADER.size))[0]
+                payload = (await self.reader.readexactly(length)).decode('utf8', 'replace')
+
+                if payload == '/sping':
+                    self.writer.write(b'/spong\n')
+                    continue
+
+                for kind, args in Util.split_tags(payload)[1]:
+                    if kind == 'token':
+                        self.resume_token = args[0]
+
+                event = parse_event(payload)
+                if event is not None:
+                    await self.events.put(event)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            try:
+                self.events.put_nowait(Closed())
+            except asyncio.QueueFull: # next_event reports the close once the queue has been drained.
+                pass
+
+    async def send(self, *commands):
+        # Writes every command in one go; only waits when the socket is more than highWater bytes behind.
+        data = ''.join(command.replace('\n', ' ') + '\n' for command in commands).encode('utf8')
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def next_event(self, timeout=None):
+        if self.skipped:
+            return self.skipped.popleft()
+        if self.closed and self.events.empty():
+            return Closed()
+        return await asyncio.wait_for(self.events.get(), timeout)
+
+    async def wait_for(self, *eventTypes, timeout=30):
+        # Returns the next event of one of the given types, starting with those an earlier wait_for passed over;
+        # events passed over on the way stay queued, in order.
+        for index, event in enumerate(self.skipped):
+            if isinstance(event, eventTypes) or isinstance(event, Closed):
+                del self.skipped[index]
+                return event
+
+        passed = []
+        try:
+            while True:
+                if self.closed and self.events.empty():
+                    return Closed()
+                event = await asyncio.wait_for(self.events.get(), timeout)
+                if isinstance(event, eventTypes) or isinstance(event, Closed):
+                    return event
+                passed.append(event)
+        finally:
+            self.skipped.extend(passed)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.next_event()
+        if isinstance(event, Closed):
+            raise StopAsyncIteration
+        return event
+
+    async def join(self, channelName):
+        # Joining a channel the bot is already in only moves its focus there.
+        await self.send('/join ' + channelName)
+        return await self.wait_for(Joined, Focused)
+
+    async def part(self, channelName):
+        await self.send('/part ' + channelName)
+        return await self.wait_for(Parted, Notice)
+
+    async def monitor(self, *usernames):
+        # Watches the given users. The reply is a Presence event with their state now; every change after it arrives
+        # as another one.
+        await self.send('/monitor + ' + ','.join(usernames))
+        return await self.wait_for(Presence)
+
+    async def close(self):
+        if self.writer is not None and not self.closed:
+            try:
+                await self.send('/quit')
+            except ConnectionError:
+                pass
+            self.writer.close()
+
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        self.closed = True
+
+
+class ClientPool:
+    """
+    Many bot identities sharing one event loop. Connections are opened on first use and reused afterwards, with no
+    more than maxConnecting handshakes in flight so a few hundred bots starting at once do not overrun the server's
+    listen backlog.
+    """
+    def __init__(self, host, port, maxConnecting=10, **options):
+        self.host = host
+        self.port = port
+        self.options = options
+        self.clients = {} # Full Name -> AsyncChatClient
+        self.connecting = asyncio.Semaphore(maxConnecting)
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    async def get(self, fullname):
+        client = self.clients.get(fullname)
+        if client is None or client.closed:
+            async with self.connecting:
+                client = await AsyncChatClient(self.host, self.port, fullname, **self.options).connect()
+            self.clients[fullname] = client
+        return client
+
+    async def get_all(self, fullnames):
+        return await asyncio.gather(*[self.get(fullname) for fullname in fullnames])
+
+    async def close(self):
+        clients = list(self.clients.values())
+        self.clients.clear()
+        await asyncio.gather(*[client.close() for client in clients], return_exceptions=True)
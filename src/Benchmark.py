@@ -0,0 +1,1060 @@
+import asyncio
+import os
+import random
+import resource
+import selectors
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import Admission
+import AsyncChatClient
+import Capture
+import ChatClient
+import ChatServer
+import Filter
+import History
+import HotRestart
+import LogIndexer
+import Mailbox
+import Replay
+import Scheduler
+import Tls
+
+
+def start_server(**options):
+    server = ChatServer.Server(host='127.0.0.1', port=0, timeout=0.5, **options)
+    serverThread = threading.Thread(target=server.start_listening, daemon=True)
+    serverThread.start()
+    server.listening.wait(10)
+    return server, serverThread
+
+
+def stop_server(server, serverThread):
+    server.exit_signal.set()
+    serverThread.join()
+    server.server_shutdown()
+
+
+class StressClient(threading.Thread):
+    def __init__(self, address, index, operations, channels):
+        threading.Thread.__init__(self, daemon=True)
+        self.address = address
+        self.index = index
+        self.operations = operations
+        self.channels = channels
+        self.received = ''
+        self.condition = threading.Condition()
+        self.socket = None
+
+    def reader(self):
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except OSError:
+                break
+
+            if not data:
+                break
+
+            with self.condition:
+                self.received += data.decode('utf8', 'replace')
+                self.condition.notify_all()
+
+    def send(self, message, *replies):
+        # The server reads one command per recv, so wait for the reply to this command before sending the next.
+        with self.condition:
+            position = len(self.received)
+            self.socket.sendall(message.encode('utf8'))
+            self.condition.wait_for(lambda: any(reply in self.received[position:] for reply in replies), timeout=30)
+
+    def run(self):
+        self.socket = socket.create_connection(self.address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self.reader, daemon=True).start()
+
+        with self.condition:
+            self.condition.wait_for(lambda: 'your name' in self.received, timeout=5)
+
+        self.send("Stress Tester", "Welcome")
+        self.send("/nick s{0}".format(self.index), "nickname to", "taken")
+
+        for operation in range(self.operations):
+            choice = random.random()
+            if choice < 0.3:
+                channelName = random.choice(self.channels)
+                self.send("/join {0}".format(channelName), "You have joined the channel " + channelName, "Now talking in")
+            elif choice < 0.4:
+                channelName = random.choice(self.channels)
+                self.send("/part {0}".format(channelName), "You have left the channel " + channelName, "not in channel")
+            elif choice < 0.5:
+                self.send("/nick s{0}n{1}".format(self.index, operation), "nickname to", "taken")
+            else:
+                token = "token{0}x{1}".format(self.index, operation)
+                self.send("message " + token, token, "not in any channels")
+
+        self.send("/ping", "Pong")
+
+
+def check_invariants(server):
+    errors = []
+    members = {}
+
+    for channelName, channel in server.channels.items():
+        names = [user.username for user in channel.users]
+        if len(names) != len(set(names)):
+            errors.append("duplicate members in {0}".format(channelName))
+
+        for name in names:
+            members.setdefault(name, set()).add(channelName)
+
+    if members != dict((name, set(channels)) for name, channels in server.users_channels_map.items()):
+        errors.append("users_channels_map does not match channel membership")
+
+    for user in server.users:
+        if user.channels and (server.users_channels_map.get(user.username) is not user.channels
+                              or user.focus not in user.channels):
+            errors.append("{0} has an inconsistent channel index or focus".format(user.username))
+
+    usernames = set(user.username for user in server.users)
+    if len(usernames) != len(server.users):
+        errors.append("two connected users share a username")
+    if set(server.usernames.owners) != usernames | set(session["user"].username for session in server.sessions.values()):
+        errors.append("allocated usernames do not match the connected users and sessions")
+
+    for name in members:
+        if name not in usernames:
+            errors.append("{0} is in a channel but not connected".format(name))
+
+    return errors
+
+
+def wait_for_departures(server, timeout=10):
+    # A user is taken off the list first and out of their channels just after, on the shards; True once every user
+    # that went is gone from both.
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not (server.users or server.users_channels_map
+                or any(channel.users for channel in list(server.channels.values()))):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def stress(clients=50, operations=100, channelCount=8):
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    channels = ["#stress{0}".format(index) for index in range(channelCount)]
+
+    startTime = time.time()
+    workers = [StressClient(server.address, index, operations, channels) for index in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - startTime
+
+    errors = check_invariants(server)
+
+    for worker in workers:
+        worker.socket.sendall("/quit".encode('utf8'))
+        worker.socket.close()
+
+    if not wait_for_departures(server):
+        errors.append("state left behind after every client quit")
+
+    stop_server(server, serverThread)
+
+    print("stress: {0} clients x {1} operations in {2:.2f}s".format(clients, operations, elapsed))
+    for error in errors:
+        print("  invariant violated: {0}".format(error))
+
+    return not errors
+
+
+def read_until(sock, text, timeout=30):
+    sock.settimeout(timeout)
+    received = ''
+    while text not in received:
+        data = sock.recv(4096)
+        if not data:
+            break
+        received += data.decode('utf8', 'replace')
+    return text in received
+
+
+def handoff(connections=1000, samples=20):
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+
+    clients = []
+    for index in range(connections):
+        client = socket.create_connection(server.address)
+        read_until(client, 'your name')
+        client.sendall("Bench User{0}".format(index).encode('utf8'))
+        read_until(client, 'Welcome')
+        clients.append(client)
+
+    process, pause = HotRestart.handoff(server, ChatServer.__file__)
+
+    answered = 0
+    for client in random.sample(clients, min(samples, len(clients))):
+        client.sendall("/ping".encode('utf8'))
+        answered += read_until(client, 'Pong', 5)
+
+    process.kill()
+    process.wait()
+    for client in clients:
+        client.close()
+    server.unpark_readers()
+    stop_server(server, serverThread)
+
+    print("handoff: {0} connections paused for {1:.1f} ms, {2}/{3} sampled clients answered by the new process"
+          .format(connections, pause * 1000, answered, min(samples, len(clients))))
+
+    return answered == min(samples, len(clients))
+
+
+def accept(connections=2000):
+    # A reconnect storm: every client connects at once and waits for the greeting. All of them come from one
+    # address, so only the server-wide limits apply.
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    server.admission.max_per_address = connections
+    server.admission.address_rates["127.0.0.1"] = Admission.RateLimit(connections)
+    selector = selectors.DefaultSelector()
+    greeted = 0
+    refused = 0
+
+    startTime = time.time()
+    for index in range(connections):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        client.connect_ex(server.address)
+        selector.register(client, selectors.EVENT_READ, [b''])
+
+    deadline = time.time() + 60
+    while len(selector.get_map()) and time.time() < deadline:
+        for key, events in selector.select(1):
+            try:
+                data = key.fileobj.recv(4096)
+            except OSError:
+                data = b''
+            key.data[0] += data
+
+            if b'your name' in key.data[0] or b'busy' in key.data[0] or not data:
+                greeted += b'your name' in key.data[0]
+                refused += b'your name' not in key.data[0]
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    elapsed = time.time() - startTime
+
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    stop_server(server, serverThread)
+
+    print("accept: {0} simultaneous connections, {1} greeted and {2} refused in {3:.2f}s, {4} timed out; "
+          "largest burst {5}, deepest accept queue {6}".format(connections, greeted, refused, elapsed,
+                                                                connections - greeted - refused,
+                                                                server.accept_stats["largest_burst"],
+                                                                server.accept_stats["deepest_queue"]))
+
+    return greeted + refused == connections
+
+
+MEMORY_SERVER = """
+import os, resource, sys
+sys.path.insert(0, {path!r})
+import ChatServer
+resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+for key in ("MAX_CLIENTS", "MAX_CLIENTS_PER_ADDRESS", "NEW_CLIENTS_PER_SECOND", "NEW_CLIENTS_PER_ADDRESS_PER_SECOND"):
+    ChatServer.Server.SERVER_CONFIG[key] = 10 ** 6
+server = ChatServer.Server(host='127.0.0.1', port=0, timeout=0.5)
+print(server.address[1], flush=True)
+sys.stdout = open(os.devnull, 'w')
+server.start_listening()
+"""
+
+
+def resident_kb(pid):
+    with open("/proc/{0}/status".format(pid)) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def memory(*counts):
+    # Resident memory of a server process per idle, registered connection. Clients are spread over many loopback
+    # source addresses so the ephemeral port range is not what runs out.
+    if not os.path.exists("/proc/self/status"):
+        print("memory: needs /proc to read the server's resident set size")
+        return False
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    process = subprocess.Popen([sys.executable, '-c', MEMORY_SERVER.format(path=os.path.dirname(ChatServer.__file__))],
+                               stdout=subprocess.PIPE, cwd=tempfile.mkdtemp())
+    address = ('127.0.0.1', int(process.stdout.readline()))
+    time.sleep(1)
+    baseline = resident_kb(process.pid)
+    clients = []
+    results = []
+
+    try:
+        for count in sorted(counts or (1000, 10000, 50000)):
+            batch = []
+            while len(clients) + len(batch) < count:
+                index = len(clients) + len(batch)
+                client = socket.create_connection(address, source_address=('127.0.{0}.{1}'.format(index // 250 % 250,
+                                                                                                  2 + index % 250), 0))
+                client.sendall("Bench User{0}".format(index).encode('utf8')) # pipelined after the greeting.
+                batch.append(client)
+
+            for client in batch:
+                read_until(client, 'Welcome')
+            clients.extend(batch)
+
+            time.sleep(1)
+            used = resident_kb(process.pid) - baseline
+            results.append(count)
+            print("memory: {0} idle connections, {1:.1f} MB over the idle server, {2:.1f} KB per connection"
+                  .format(count, used / 1024.0, used / float(count)))
+    except OSError as errorMessage:
+        print("memory: stopped at {0} connections - {1}".format(len(clients), errorMessage))
+    finally:
+        for client in clients:
+            client.close()
+        process.kill()
+        process.wait()
+
+    return len(results) == len(counts or (1000, 10000, 50000))
+
+
+def random_word(low, high):
+    return ''.join(random.choice(string.ascii_lowercase) for index in range(random.randint(low, high)))
+
+
+def content_filter(patterns=10000, messages=20000):
+    # The content filter's matcher against the list size it has to cope with, next to checking every term in turn.
+    random.seed(1)
+    terms = [random_word(5, 12) for index in range(patterns * 4 // 5)]
+    terms += ["http://spam{0}.example.com/".format(index) for index in range(patterns - len(terms))]
+    texts = [' '.join(random_word(2, 9) for word in range(15)) for index in range(messages)]
+    texts[::100] = [text + ' ' + random.choice(terms) for text in texts[::100]]
+
+    startTime = time.time()
+    automaton = Filter.Automaton(terms)
+    buildTime = time.time() - startTime
+
+    startTime = time.time()
+    matched = sum(1 for text in texts if automaton.find(text))
+    matchTime = time.time() - startTime
+
+    sample = texts[:max(1, messages // 100)]
+    startTime = time.time()
+    naiveMatched = sum(1 for text in sample if any(term in text for term in terms))
+    naiveTime = time.time() - startTime
+
+    print("filter: {0} terms compiled in {1:.2f}s; {2} messages in {3:.2f}s ({4:.0f}/s, {5:.1f} MB/s), {6} matched; "
+          "checking each term in turn: {7:.0f}/s".format(len(automaton), buildTime, messages, matchTime,
+                                                         messages / matchTime,
+                                                         sum(len(text) for text in texts) / matchTime / 1e6, matched,
+                                                         len(sample) / naiveTime))
+
+    return matched >= len(texts[::100]) and naiveMatched == sum(1 for text in sample if automaton.find(text))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def overload_run(workers, idle, flooders, samples):
+    os.chdir(tempfile.mkdtemp())
+    configured = ChatServer.Server.SERVER_CONFIG["COMMAND_WORKERS"]
+    ChatServer.Server.SERVER_CONFIG["COMMAND_WORKERS"] = workers
+    try:
+        server, serverThread = start_server()
+    finally:
+        ChatServer.Server.SERVER_CONFIG["COMMAND_WORKERS"] = configured
+    server.admission.max_per_address = idle + flooders + 10
+    server.admission.address_rates["127.0.0.1"] = Admission.RateLimit(idle + flooders + 10)
+
+    def connect(index):
+        client = socket.create_connection(server.address)
+        client.sendall("Load User{0}".format(index).encode('utf8')) # pipelined after the greeting.
+        read_until(client, 'Welcome')
+        return client
+
+    clients = [connect(index) for index in range(idle + flooders + 3)]
+    floodClients, (pinger, talker, listener) = clients[idle:idle + flooders], clients[-3:]
+    for client in (talker, listener):
+        client.sendall(b'/join #probe')
+        read_until(client, 'joined the channel #probe')
+    time.sleep(0.5)
+
+    stop = threading.Event()
+
+    def flood():
+        # One thread keeps a /list in flight on every flooder, sending the next as soon as the answer (or the busy
+        # reply) is back, so about as many queries wait as there are flooders, far past COMMAND_QUEUE_LIMIT.
+        selector = selectors.DefaultSelector()
+        for client in floodClients:
+            client.setblocking(False)
+            try:
+                while client.recv(1 << 16): # whatever is left of the greeting.
+                    pass
+            except BlockingIOError:
+                pass
+            client.send(b'/list')
+            selector.register(client, selectors.EVENT_READ)
+
+        while not stop.is_set():
+            for key, events in selector.select(0.1):
+                try:
+                    if key.fileobj.recv(1 << 16):
+                        key.fileobj.send(b'/list')
+                    else:
+                        selector.unregister(key.fileobj)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    selector.unregister(key.fileobj)
+        selector.close()
+
+    threads = [threading.Thread(target=flood, daemon=True)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+
+    pings, chats = [], []
+    for sample in range(samples):
+        startTime = time.time()
+        pinger.sendall(b'/ping')
+        read_until(pinger, 'Pong')
+        pings.append(time.time() - startTime)
+
+        startTime = time.time()
+        talker.sendall("probe {0}".format(sample).encode('utf8'))
+        read_until(listener, "probe {0}".format(sample))
+        chats.append(time.time() - startTime)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    shed = server.scheduler.shed_counts[Scheduler.QUERY]
+    for client in clients:
+        client.close()
+    time.sleep(0.5)
+    stop_server(server, serverThread)
+
+    return pings, chats, shed
+
+
+def overload(idle=300, flooders=100, samples=50):
+    # Keepalive and chat latency while flooders keep more queries waiting than the queue takes, first with every
+    # command run on its own client thread (the old behaviour), for reference, then through the priority scheduler,
+    # which must shed queries and keep /ping and chat within their latency budgets.
+    config = ChatServer.Server.SERVER_CONFIG
+    for workers in (0, config["COMMAND_WORKERS"]):
+        pings, chats, shed = overload_run(workers, idle, flooders, samples)
+        print("overload: {0:>12}: /ping p50 {1:.1f} ms p99 {2:.1f} ms, chat p50 {3:.1f} ms p99 {4:.1f} ms, {5} queries "
+              "shed".format("{0} workers".format(workers) if workers else "inline", percentile(pings, 0.5) * 1000,
+                            percentile(pings, 0.99) * 1000, percentile(chats, 0.5) * 1000,
+                            percentile(chats, 0.99) * 1000, shed))
+
+    print("  budgets: /ping p99 {0:.0f} ms, chat p99 {1:.0f} ms".format(config["CONTROL_LATENCY"] * 1000,
+                                                                      config["CHAT_LATENCY"] * 1000))
+    return shed > 0 and percentile(pings, 0.99) <= config["CONTROL_LATENCY"] \
+        and percentile(chats, 0.99) <= config["CHAT_LATENCY"]
+
+
+def mailbox(recipients=1000, messages=100, budgetKB=1024):
+    # Offline mail with most of it spilled to the spool: time to store everything, then to hand it all out.
+    os.chdir(tempfile.mkdtemp())
+    store = Mailbox.MailStore("bench.spool", budgetKB * 1024, messages, 3600)
+    text = "<||> PrivMsg from bench001: {0} {1} <||>\n"
+
+    startTime = time.time()
+    for message in range(messages):
+        for recipient in range(recipients):
+            store.put("user{0}".format(recipient), text.format(recipient, message))
+    putTime = time.time() - startTime
+    spoolSize = store.spool_size
+
+    startTime = time.time()
+    delivered = sum(store.take("user{0}".format(recipient)).count('\n') for recipient in range(recipients))
+    takeTime = time.time() - startTime
+    store.close()
+
+    total = recipients * messages
+    print("mailbox: {0} messages for {1} offline users ({2:.1f} MB spooled), stored at {3:.0f}/s, {4} delivered at "
+          "{5:.0f}/s".format(total, recipients, spoolSize / 1e6, total / putTime, delivered, delivered / takeTime))
+
+    return delivered == total
+
+
+def snapshot(channels=5000, messages=20):
+    os.chdir(tempfile.mkdtemp())
+    server = ChatServer.Server(host='127.0.0.1', port=0)
+
+    for index in range(channels):
+        channelName = "#bench{0}".format(index)
+        channel = server.shards.run(channelName, server.load_channel, channelName)
+        channel.topic = "topic {0}".format(index)
+        for message in range(messages):
+            server.channel_files[channelName].append("user{0}: message {1}\n".format(index, message))
+
+    startTime = time.time()
+    server.snapshot_writer.save()
+    saveTime = time.time() - startTime
+
+    startTime = time.time()
+    server.snapshot_writer.save()
+    unchangedSaveTime = time.time() - startTime
+    server.server_shutdown()
+
+    startTime = time.time()
+    restarted = ChatServer.Server(host='127.0.0.1', port=0)
+    readyTime = time.time() - startTime
+
+    startTime = time.time()
+    channel = restarted.find_channel("#bench0")
+    lineCount = restarted.channel_files["#bench0"].line_count
+    firstUseTime = time.time() - startTime
+    restarted.server_shutdown()
+
+    print("snapshot: {0} channels, save {1:.1f} ms ({2:.1f} ms unchanged), {3} bytes"
+          .format(channels, saveTime * 1000, unchangedSaveTime * 1000,
+                  os.path.getsize(ChatServer.Server.SERVER_CONFIG["SNAPSHOT_FILE"])))
+    print("  restart ready in {0:.1f} ms, first channel decoded in {1:.2f} ms".format(readyTime * 1000,
+                                                                                     firstUseTime * 1000))
+
+    return channel is not None and channel.topic == "topic 0" and lineCount == messages
+
+
+class ListboxStandIn:
+    # The parts of tk.Listbox the user list uses, for running without a display.
+    def __init__(self):
+        self.items = []
+
+    def index_of(self, index):
+        return len(self.items) if index == 'end' else index
+
+    def get(self, first, last):
+        return tuple(self.items[self.index_of(first):self.index_of(last) + 1])
+
+    def insert(self, index, *items):
+        self.items[self.index_of(index):self.index_of(index)] = items
+
+    def delete(self, first, last=None):
+        del self.items[self.index_of(first):self.index_of(last if last is not None else first) + 1]
+
+
+class TextStandIn:
+    # The parts of tk.Text the chat window touches when it switches channels.
+    def configure(self, **options):
+        pass
+
+    def delete(self, first, last=None):
+        pass
+
+    def insert(self, index, *segments):
+        pass
+
+    def see(self, index):
+        pass
+
+    def yview(self, *args):
+        return 0.0, 1.0
+
+
+def user_list_box():
+    try:
+        import tkinter
+        return tkinter.Listbox(tkinter.Tk()), "tk.Listbox"
+    except Exception:
+        return ListboxStandIn(), "list box stand-in"
+
+
+def chat_window(listBox):
+    # The client's own ChatWindow, without the Tk frame around it, so apply_events runs just as it does in the client.
+    import Main
+    window = Main.ChatWindow.__new__(Main.ChatWindow)
+    window.init_state()
+    window.usersListBox = listBox
+    window.messageTextArea = TextStandIn()
+    return window
+
+
+def roster(members=10000, changes=2000, frameEvents=20):
+    usernames = ["user{0:05d}".format(index) for index in range(members)]
+    leaving = random.Random(1).sample(usernames, changes)
+
+    # The user list as it used to be kept: the list box itself, searched for every join and leave.
+    listBox, kind = user_list_box()
+    startTime = time.time()
+    for username in usernames:
+        if username not in listBox.get(0, 'end'):
+            listBox.insert('end', username)
+    for username in leaving:
+        listBox.delete(listBox.get(0, 'end').index(username))
+    scanTime = time.time() - startTime
+    expected = sorted(listBox.get(0, 'end'))
+
+    # The chat window as the client drives it: joining the channel brings its whole member list, then every leave
+    # arrives as its own event, frameEvents of them per frame.
+    listBox, kind = user_list_box()
+    window = chat_window(listBox)
+    frames = [[('show_channel', ("#big", ' '.join(usernames), None))]]
+    events = [('remove_user_from_list', (username, "#big")) for username in leaving]
+    frames.extend(events[start:start + frameEvents] for start in range(0, len(events), frameEvents))
+    startTime = time.time()
+    for frame in frames:
+        window.apply_events(frame)
+    windowTime = time.time() - startTime
+
+    print("roster ({0}): {1} joins and {2} leaves in {3:.1f} ms through ChatWindow.apply_events, {4:.1f} ms "
+          "scanning the list box".format(kind, members, changes, windowTime * 1000, scanTime * 1000))
+
+    return list(listBox.get(0, 'end')) == expected == list(window.roster("#big"))
+
+
+def bot_name(index):
+    # Every bot shares one username prefix, so the server has to tell them apart by suffix.
+    return "Bot User{0}".format(index)
+
+
+def bots(count=200, messages=50):
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    server.admission.max_per_address = count # every bot connects from the same address.
+
+    async def run_bot(pool, index):
+        bot = await pool.get(bot_name(index))
+        await bot.join("#bots{0}".format(index))
+        await bot.send(*["message {0}".format(message) for message in range(messages)]) # pipelined
+        received = 0
+        while received < messages:
+            event = await bot.wait_for(AsyncChatClient.Message)
+            if isinstance(event, AsyncChatClient.Closed):
+                break
+            received += 1
+        return received
+
+    async def run_all():
+        async with AsyncChatClient.ClientPool(*server.address) as pool:
+            startTime = time.time()
+            await pool.get_all([bot_name(index) for index in range(count)])
+            connectTime = time.time() - startTime
+
+            startTime = time.time()
+            received = await asyncio.gather(*[run_bot(pool, index) for index in range(count)])
+            return connectTime, time.time() - startTime, sum(received)
+
+    try:
+        connectTime, runTime, received = asyncio.run(run_all())
+    finally:
+        stop_server(server, serverThread)
+
+    print("bots: {0} connections in {1:.2f}s, {2} of {3} pipelined messages echoed in {4:.2f}s ({5:.0f}/s)"
+          .format(count, connectTime, received, count * messages, runTime, received / max(runTime, 1e-9)))
+
+    return received == count * messages
+
+
+def slow_consumer(messages=5000, size=1000, samples=20):
+    # One member of #a never reads while another floods #a. Someone talking in a channel on the same shard must still
+    # be answered at once, and the member that stopped reading is cut off once its outbox is full.
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    shard = server.shards.shard_for("#a")
+    neighbour = next(channelName for channelName in ("#b{0}".format(index) for index in range(1000))
+                     if server.shards.shard_for(channelName) is shard)
+
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(server.address)
+    read_until(stalled, 'your name')
+    stalled.sendall(b'Stalled Reader')
+    read_until(stalled, 'type /help')
+    stalled.sendall(b'/join #a')
+    read_until(stalled, 'joined the channel #a')
+    stalledName = server.users[-1].username
+
+    async def drain(client):
+        while not isinstance(await client.next_event(), AsyncChatClient.Closed):
+            pass
+
+    async def run_all():
+        async with AsyncChatClient.ClientPool(*server.address) as pool:
+            flooder, probe = await pool.get_all([bot_name(0), bot_name(1)])
+            await flooder.join("#a")
+            await probe.join(neighbour)
+            draining = asyncio.ensure_future(drain(flooder))
+            await flooder.send(*["{0} {1}".format("x" * size, index) for index in range(messages)]) # pipelined
+
+            latencies = []
+            for sample in range(samples):
+                text = "probe {0}".format(sample)
+                startTime = time.time()
+                await probe.send(text)
+                while True:
+                    try:
+                        event = await probe.wait_for(AsyncChatClient.Message, timeout=5)
+                    except asyncio.TimeoutError:
+                        return latencies
+                    if isinstance(event, AsyncChatClient.Closed):
+                        return latencies
+                    if event.text == text:
+                        latencies.append(time.time() - startTime)
+                        break
+                await asyncio.sleep(0.05)
+
+            draining.cancel()
+            return latencies
+
+    try:
+        latencies = asyncio.run(run_all())
+        cutOff = server.usernames.owner(stalledName) is None
+    finally:
+        stalled.close()
+        stop_server(server, serverThread)
+
+    print("slow_consumer: {0} of {1} messages in {2} answered while #a was flooded past a stalled reader, p50 {3:.1f} "
+          "ms, max {4:.1f} ms; stalled reader {5}".format(len(latencies), samples, neighbour,
+                                                         percentile(latencies, 0.5) * 1000,
+                                                         max(latencies or [float('nan')]) * 1000,
+                                                         "cut off" if cutOff else "still connected"))
+    return len(latencies) == samples and max(latencies) < 1 and cutOff
+
+
+def replay(clients=30, operations=50, bots=10):
+    # Captures a stress run plus some framed, pipelining bots, then plays the trace back to fresh servers.
+    os.chdir(tempfile.mkdtemp())
+    tracePath = os.path.abspath("capture.trace")
+    server, serverThread = start_server()
+    server.start_capture(tracePath)
+    channels = ["#replay{0}".format(index) for index in range(8)]
+
+    async def run_bots():
+        async with AsyncChatClient.ClientPool(*server.address) as pool:
+            for bot in await pool.get_all([bot_name(index) for index in range(bots)]):
+                await bot.join(random.choice(channels))
+                await bot.send(*["message {0}".format(message) for message in range(operations)])
+
+    startTime = time.time()
+    workers = [StressClient(server.address, index, operations, channels) for index in range(clients)]
+    for worker in workers:
+        worker.start()
+    asyncio.run(run_bots())
+    for worker in workers:
+        worker.join()
+        worker.socket.sendall("/quit".encode('utf8'))
+        worker.socket.close()
+    captureTime = time.time() - startTime
+
+    wait_for_departures(server)
+    records = server.stop_capture()
+    stop_server(server, serverThread)
+
+    header, trace = Capture.read_trace(tracePath)
+    commands = sum(1 for record in trace if record[2] in (Capture.MESSAGE, Capture.LINE))
+    print("replay: captured {0} records ({1} commands, {2} bytes) from {3} connections in {4:.2f}s, scrubbed: {5}"
+          .format(records, commands, os.path.getsize(tracePath), clients + bots, captureTime, header[1]))
+
+    passed = records == len(trace)
+    for speed in (10, None):
+        os.chdir(tempfile.mkdtemp())
+        server, serverThread = start_server()
+        try:
+            result = Replay.replay(tracePath, *server.address, speed=speed)
+        finally:
+            wait_for_departures(server)
+            errors = check_invariants(server)
+            stop_server(server, serverThread)
+
+        print("  " + Replay.report(result, speed))
+        for error in errors:
+            print("  invariant violated: {0}".format(error))
+        passed = passed and not errors and not result["errors"] and result["sent"] == commands
+
+    return passed
+
+
+def presence(users=200, watchers=50, watched=20):
+    # Watchers monitor a random few of the users, who then all go away and come back; every watcher must be told
+    # of exactly the changes of the users it watches. Polling /ison for the same lists is timed for comparison.
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    server.admission.max_per_address = users + watchers
+
+    async def run_all():
+        async with AsyncChatClient.ClientPool(*server.address) as pool:
+            people = await pool.get_all([bot_name(index) for index in range(users)])
+            observers = await pool.get_all([bot_name(users + index) for index in range(watchers)])
+            lists = [random.sample([person.username for person in people], watched) for observer in observers]
+
+            replies = await asyncio.gather(*[observer.monitor(*names) for observer, names in zip(observers, lists)])
+            initial = all(reply.states == dict((name, "online") for name in names)
+                          for reply, names in zip(replies, lists))
+
+            startTime = time.time()
+            for observer, names in zip(observers, lists):
+                await observer.send('/ison ' + ' '.join(names))
+            await asyncio.gather(*[observer.wait_for(AsyncChatClient.Notice) for observer in observers])
+            pollTime = time.time() - startTime
+
+            async def collect(observer, names, state):
+                seen = {}
+                while len(seen) < len(names):
+                    event = await observer.wait_for(AsyncChatClient.Presence, timeout=10)
+                    if isinstance(event, AsyncChatClient.Closed):
+                        break
+                    seen.update(event.states)
+                return seen == dict((name, state) for name in names)
+
+            results = []
+            pushTimes = []
+            for command, state in (('/away lunch', "away"), ('/away', "online")):
+                startTime = time.time()
+                for person in people:
+                    await person.send(command)
+                results.extend(await asyncio.gather(*[collect(observer, names, state)
+                                                      for observer, names in zip(observers, lists)]))
+                pushTimes.append(time.time() - startTime)
+
+            indexed = sum(len(subscribers) for subscribers in server.presence.watchers.values())
+            return initial, all(results), pollTime, pushTimes, indexed
+
+    try:
+        initial, delivered, pollTime, pushTimes, indexed = asyncio.run(run_all())
+    finally:
+        stop_server(server, serverThread)
+
+    print("presence: {0} watchers x {1} names over {2} users; one /ison polling round {3:.1f} ms, "
+          "{4} changes pushed per status flip of all users in {5}"
+          .format(watchers, watched, users, pollTime * 1000, indexed,
+                  " and ".join("{0:.1f} ms".format(pushTime * 1000) for pushTime in pushTimes)))
+
+    return initial and delivered and indexed == watchers * watched
+
+
+def fanout(recipients=500, rounds=5):
+    # One alert to every recipient, as a single multi-target /notice and as one /notice per recipient.
+    os.chdir(tempfile.mkdtemp())
+    server, serverThread = start_server()
+    server.admission.max_per_address = recipients + 1
+
+    async def run_all():
+        async with AsyncChatClient.ClientPool(*server.address) as pool:
+            sender = await pool.get(bot_name(0))
+            bots = await pool.get_all([bot_name(index + 1) for index in range(recipients)])
+            names = [bot.username for bot in bots]
+
+            async def received(bot, text):
+                while True:
+                    event = await bot.wait_for(AsyncChatClient.Notice)
+                    if isinstance(event, AsyncChatClient.Closed) or text in event.text:
+                        return not isinstance(event, AsyncChatClient.Closed)
+
+            results = {}
+            for single in (True, False):
+                times = []
+                for round in range(rounds):
+                    text = "alert {0} {1}".format("one" if single else "each", round) # the server lowercases it.
+                    startTime = time.time()
+                    if single:
+                        await sender.send("/notice {0} {1}".format(','.join(names), text))
+                    else:
+                        await sender.send(*["/notice {0} {1}".format(name, text) for name in names])
+                    arrived = await asyncio.gather(*[received(bot, text) for bot in bots])
+                    replies = 1 if single else recipients
+                    for reply in range(replies):
+                        await sender.wait_for(AsyncChatClient.Notice)
+                    times.append(time.time() - startTime)
+                    if not all(arrived):
+                        return None
+                results[single] = min(times)
+            return results
+
+    try:
+        results = asyncio.run(run_all())
+    finally:
+        stop_server(server, serverThread)
+
+    if results is None:
+        print("fanout: some recipients did not get the notice")
+        return False
+
+    print("fanout: a notice to {0} users in {1:.1f} ms as one command, {2:.1f} ms as {0} commands"
+          .format(recipients, results[True] * 1000, results[False] * 1000))
+    return True
+
+
+def make_certificate(directory):
+    # A throwaway self-signed RSA certificate for 127.0.0.1, made with the openssl command line tool.
+    certFile, keyFile = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=IP:127.0.0.1,DNS:localhost", "-keyout", keyFile, "-out", certFile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certFile, keyFile
+
+
+def reconnect_storm(address, clients):
+    # Every client reconnects at once, each through its own thread, and waits for the greeting.
+    barrier = threading.Barrier(len(clients) + 1)
+    reused = []
+
+    def reconnect(client):
+        barrier.wait()
+        client.connect(*address)
+        if client.isClientConnected and client.receive():
+            reused.append(client.socket.session_reused)
+        client.disconnect()
+
+    threads = [threading.Thread(target=reconnect, args=(client,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    startTime = time.time()
+    for thread in threads:
+        thread.join()
+    return time.time() - startTime, len(reused), sum(reused)
+
+
+def tls(connections=500, rounds=3):
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        certFile, keyFile = make_certificate(directory)
+    except (OSError, subprocess.CalledProcessError) as error:
+        print("tls: could not make a test certificate ({0})".format(error))
+        return False
+
+    config = ChatServer.Server.SERVER_CONFIG
+    configured = config["TLS_CERT_FILE"], config["TLS_KEY_FILE"]
+    config["TLS_CERT_FILE"], config["TLS_KEY_FILE"] = certFile, keyFile
+    try:
+        server, serverThread = start_server()
+    finally:
+        config["TLS_CERT_FILE"], config["TLS_KEY_FILE"] = configured
+    server.admission.max_per_address = connections
+    server.admission.address_rates["127.0.0.1"] = Admission.RateLimit(connections * 10)
+
+    context = Tls.client_context(certFile)
+    passed = True
+    try:
+        for resumed in (False, True):
+            clients = [ChatClient.Client(context) for index in range(connections)]
+            if resumed: # one full handshake each first, to get a session to offer.
+                reconnect_storm(server.address, clients)
+
+            times = []
+            for storm in range(rounds):
+                if not resumed:
+                    for client in clients:
+                        client.tls_session = None
+                elapsed, greeted, reused = reconnect_storm(server.address, clients)
+                times.append(elapsed)
+                passed = passed and greeted == connections and reused == (connections if resumed else 0)
+
+            best = min(times)
+            print("tls: {0} {1} handshakes at once in {2:.2f}s ({3:.0f}/s), {4} of {5} greeted, {6} resumed"
+                  .format(connections, "resumed" if resumed else "full", best, connections / best, greeted,
+                          connections, reused))
+
+        sessions = server.tls_context.session_stats()
+        print("  server: {0} handshakes completed, {1} resumed".format(sessions["accept_good"], sessions["hits"]))
+    finally:
+        deadline = time.time() + 10
+        while server.users and time.time() < deadline:
+            time.sleep(0.05)
+        stop_server(server, serverThread)
+
+    return passed
+
+
+def write_logs(directory, channels, megabytes):
+    # Channel logs of about the given total size, half of it in #channel0 so that one log has to be split.
+    words = ["hello", "anyone", "around", "the", "build", "is", "green", "again", "lunch", "deploy", "at", "noon"]
+    sizes = [megabytes << 19] + [(megabytes << 19) // max(channels - 1, 1)] * (channels - 1)
+    for channel, size in enumerate(sizes):
+        lines = ["{0}: {1}\n".format(bot_name(index), ' '.join(random.choice(words)
+                                                              for word in range(random.randint(1, 20))))
+                 for index in range(1000)]
+        block = ''.join(lines).encode('utf8')
+        with open(os.path.join(directory, "#channel{0}.txt".format(channel)), "wb") as logFile:
+            for copy in range(max(size // len(block), 1)):
+                logFile.write(block)
+
+
+def indexer(channels=16, megabytes=64):
+    # Indexes and compacts a directory of logs on one worker and on every core, then checks the result against
+    # ChannelHistory's own scan.
+    directory = tempfile.mkdtemp()
+    write_logs(directory, channels, megabytes)
+    logs = LogIndexer.channel_logs(directory)
+    expected = {}
+    for logPath in logs:
+        history = History.ChannelHistory(os.path.splitext(logPath)[0])
+        history.ensure_index()
+        with open(logPath, "rb") as logFile:
+            checksum = 0
+            for chunk in iter(lambda: logFile.read(1 << 20), b''):
+                checksum = zlib.crc32(chunk, checksum)
+        expected[logPath] = (history.offsets, checksum)
+
+    chunkSize = max((megabytes << 20) // 16, 1 << 20)
+    passed = True
+    for workers in sorted({1, os.cpu_count() or 1}):
+        result = LogIndexer.index_logs(directory, workers, chunkSize, progress=None)
+        print("indexer: {0} channels ({1} tasks), {2:.1f} MB, {3} lines in {4:.2f}s ({5:.1f} MB/s) on {6} workers, "
+              "segments {7:.0%} of the logs".format(result["channels"], result["tasks"], result["bytes"] / 1e6,
+                                                   result["lines"], result["seconds"],
+                                                   result["bytes"] / 1e6 / result["seconds"], workers,
+                                                   result["compacted_bytes"] / result["bytes"]))
+
+    print("  largest worker: {0:.1f} MB resident".format(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+
+    for logPath in logs:
+        offsets, checksum = expected[logPath]
+        indexed = LogIndexer.read_index(logPath)
+        segments = 0
+        lines = 0
+        for count, text in LogIndexer.read_segments(logPath):
+            segments = zlib.crc32(text.encode('utf8'), segments)
+            lines += count
+        if indexed is None or indexed[1] != offsets or segments != checksum or lines != len(offsets):
+            print("  {0}: index or segments do not match the log".format(os.path.basename(logPath)))
+            passed = False
+
+    # A line the server appends after the run is picked up without rescanning the rest.
+    history = History.ChannelHistory(os.path.splitext(logs[0])[0])
+    history.append("late: after the index was built\n")
+    reloaded = History.ChannelHistory(os.path.splitext(logs[0])[0])
+    if reloaded.line_count != len(expected[logs[0]][0]) + 1 or \
+            reloaded.read_range(reloaded.line_count - 1, reloaded.line_count) != "late: after the index was built\n":
+        print("  the line appended after indexing was not found")
+        passed = False
+
+    shutil.rmtree(directory, ignore_errors=True)
+    return passed
+
+
+BENCHMARKS = {"stress": stress, "handoff": handoff, "accept": accept, "memory": memory, "filter": content_filter,
+              "mailbox": mailbox, "overload": overload, "snapshot": snapshot, "roster": roster, "bots": bots,
+              "replay": replay, "tls": tls, "slow_consumer": slow_consumer,
+              "presence": presence, "fanout": fanout, "indexer": indexer}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: Benchmark.py [{0}] [args...]".format("|".join(sorted(BENCHMARKS))))
+        sys.exit(2)
+
+    result = BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
+    sys.exit(0 if result is not False else 1)
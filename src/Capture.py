@@ -0,0 +1,171 @@
+import hashlib
+import hmac
+import os
+import re
+import string
+import struct
+import threading
+import time
+
+# File layout: MAGIC, a header (wall clock time the capture started, whether it was scrubbed), then one record per
+# event: seconds since the start, connection id, kind and payload length, followed by the payload itself.
+MAGIC = b'CHATTRC1'
+HEADER = struct.Struct('!dB')
+RECORD = struct.Struct('!dIBI')
+
+OPEN = 0 # a connection was accepted; no payload.
+MESSAGE = 1 # one command from a client that does not frame its input, to be sent on its own.
+LINE = 2 # one command from a framed client, to be sent followed by a newline.
+CLOSE = 3 # the connection went away; no payload.
+
+# Command -> what each of its arguments holds, the last letter standing for any further ones: n is a name, which is
+# scrubbed consistently so replies and lookups still find the same user, k is kept as it is (channels, numbers,
+# capabilities), and t is free text, which is blanked. Commands not listed here have their arguments blanked.
+ARGUMENTS = {"/join": "k", "/part": "k", "/history": "k", "/list": "k", "/filter": "k", "/caps": "k",
+             "/connect": "k", "/capture": "k", "/topic": "kt", "/knock": "kt", "/kick": "kn", "/invite": "nk",
+             "/privmsg": "nt", "/notice": "nt", "/oper": "nt", "/nick": "n", "/setname": "n", "/who": "n",
+             "/whois": "n", "/userip": "n", "/userhost": "n", "/ison": "n", "/kill": "n"}
+WORD = re.compile(r'[^\W\d_]+')
+USERNAME = re.compile(r'([^\W\d_])(\D{0,3})(\d{3,})$')
+
+
+class Scrubber:
+    """
+    Takes the personal data out of captured commands without changing their shape. Every letter of a name, in any
+    script, is replaced by one picked by an HMAC of the word up to and including it, under a key drawn at random for
+    each capture: the same name always gets the same stand-in of the same length, and words that start alike keep
+    starting alike, so a username built from a full name still matches the one built from its stand-in. Nothing of
+    the mapping can be worked out from the trace without the key. Message text, passwords and tokens become runs of
+    'x' of the same length.
+    """
+    def __init__(self, key=None):
+        self.key = key if key is not None else os.urandom(32)
+
+    def blank(self, text):
+        return ''.join('x' if character.isalnum() else character for character in text)
+
+    def letter(self, prefix, character):
+        digest = hmac.new(self.key, prefix.lower().encode('utf8'), hashlib.sha256).digest()
+        letter = string.ascii_lowercase[digest[0] % 26]
+        return letter.upper() if character.isupper() else letter
+
+    def pseudonym(self, text):
+        # Each run of letters is replaced letter by letter; everything else is kept.
+        return WORD.sub(lambda match: ''.join(self.letter(match.group()[:index + 1], character)
+                                              for index, character in enumerate(match.group())), text)
+
+    def name(self, name):
+        # A username is the first letter of a full name, up to three of the surname and a number; each part is
+        # replaced as it would be in the full name, so it becomes the username the scrubbed full name gets.
+        match = USERNAME.match(name)
+        if match is None:
+            return self.pseudonym(name)
+        return self.pseudonym(match.group(1)) + self.pseudonym(match.group(2)) + match.group(3)
+
+    def scrub(self, text, registered):
+        # A registered client's command, or the full name it sent to register.
+        if not registered and not text.startswith('/'):
+            return self.pseudonym(text)
+
+        words = text.split(' ')
+        if not words[0].startswith('/'):
+            return self.blank(text)
+
+        kinds = ARGUMENTS.get(words[0].lower(), "t")
+        position = 0
+        for index in range(1, len(words)):
+            if not words[index]:
+                continue
+            kind = kinds[min(position, len(kinds) - 1)]
+            position += 1
+            if kind == "n": # a list of targets may name channels too, which are kept.
+                words[index] = ','.join(name if name.startswith('#') else self.name(name)
+                                        for name in words[index].split(','))
+            elif kind == "t":
+                words[index] = self.blank(words[index])
+
+        return ' '.join(words)
+
+
+class TraceWriter:
+    """
+    Records what clients send, one record per command as the server reads it, to a binary trace that Replay.py can
+    play back. Connections are numbered in the order they are first seen. Writes are buffered, so recording costs
+    the reading thread a lock and a copy, not a system call.
+    """
+    def __init__(self, path, scrub=True):
+        self.path = path
+        self.scrubber = Scrubber() if scrub else None
+        self.connections = {} # User -> connection id
+        self.next_connection = 0
+        self.records = 0
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.file = open(path, "wb", buffering=1024 * 1024)
+        self.file.write(MAGIC + HEADER.pack(time.time(), scrub))
+
+    def connection(self, user, now):
+        # Users that were connected before the capture started are opened on first sight.
+        connection = self.connections.get(user)
+        if connection is None:
+            connection = self.connections[user] = self.next_connection
+            self.next_connection += 1
+            self.write(now, connection, OPEN, b'')
+        return connection
+
+    def write(self, now, connection, kind, payload):
+        self.file.write(RECORD.pack(now - self.start, connection, kind, len(payload)) + payload)
+        self.records += 1
+
+    def open(self, user):
+        with self.lock:
+            if self.file is not None:
+                self.connection(user, time.monotonic())
+
+    def record(self, user, text):
+        kind = LINE if user.framed else MESSAGE
+        if text.startswith('/caps'): # anything pipelined behind it is read, and recorded, again once it is framed.
+            text, kind = text.partition('\n')[0], LINE
+
+        if self.scrubber is not None:
+            text = self.scrubber.scrub(text, bool(user.username))
+
+        with self.lock:
+            if self.file is not None:
+                now = time.monotonic()
+                self.write(now, self.connection(user, now), kind, text.encode('utf8'))
+
+    def close(self, user):
+        with self.lock:
+            connection = self.connections.pop(user, None)
+            if self.file is not None and connection is not None:
+                self.write(time.monotonic(), connection, CLOSE, b'')
+
+    def stop(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_trace(path):
+    # Returns (header, records): header is (start time, scrubbed), records a list of
+    # (seconds since the start, connection id, kind, payload) in the order they were written.
+    with open(path, "rb") as traceFile:
+        data = traceFile.read()
+
+    if not data.startswith(MAGIC):
+        raise ValueError("{0} is not a chat server trace.".format(path))
+
+    position = len(MAGIC)
+    startTime, scrubbed = HEADER.unpack_from(data, position)
+    position += HEADER.size
+    records = []
+
+    while position + RECORD.size <= len(data):
+        offset, connection, kind, length = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        records.append((offset, connection, kind, data[position:position + length]))
+        position += length
+
+    return (startTime, bool(scrubbed)), records
@@ -1,43 +1,78 @@
+import Util
 
 class Channel:
     def __init__(self, name):
-        self.users = [] # A list of the users in this channel.
+        self.users = {} # User -> None, in the order they joined; a dict so membership checks and removal are O(1).
         self.channel_name = name
-        self.channel_topic = ""
+        self.tag = Util.make_tag('chan', name) # Prefixes everything the channel sends, so clients can tell channels apart.
+        self._topic = ""
+        self.version = 0 # Bumped on every membership or topic change so snapshots know what to re-encode.
 
-    def welcome_user(self, username, channel_text_history):
+    @property
+    def topic(self):
+        return self._topic
+
+    @topic.setter
+    def topic(self, new_topic):
+        self._topic = new_topic
+        self.version += 1
+
+    def add_user(self, user):
+        self.users[user] = None
+        self.version += 1
+
+    def welcome_user(self, newUser, channel_text_history):
+        # Only the user who joined gets the channel history; everyone else just hears about the join.
         all_users = self.get_all_users_in_channel()
+        chatMessage = '\n\n> {0} has joined the channel {1}!\n|{2}|'.format(newUser.username, self.channel_name, all_users)
+        chatMessage = (self.tag + chatMessage).encode('utf8')
 
         for user in self.users:
-            if user.username is username:
-                chatMessage = '\n\n> {0} have joined the channel {1}!\n|{2}|'.format("You", self.channel_name, all_users)
-                user.socket.sendall((chatMessage + channel_text_history).encode('utf8'))
+            if user is newUser:
+                welcomeMessage = '\n\n> {0} have joined the channel {1}!\n|{2}|'.format("You", self.channel_name, all_users)
+                self.send_to(user, (self.tag + welcomeMessage + channel_text_history).encode('utf8'))
             else:
-                chatMessage = '\n\n> {0} has joined the channel {1}!\n|{2}|'.format(username, self.channel_name, all_users)
-                user.socket.sendall((chatMessage + channel_text_history).encode('utf8'))
+                self.send_to(user, chatMessage)
+
+    def broadcast_message(self, chatMessage, username='', sequence=None):
+        # Messages that were written to the channel log carry their sequence id so clients can resume after it.
+        # Each variant is encoded once for the whole fan-out.
+        tag = Util.make_tag('seq', self.channel_name, sequence) if sequence is not None else self.tag
+        ownMessage = (tag + "You: {0}".format(chatMessage)).encode('utf8')
+        otherMessage = (tag + "{0} {1}".format(username, chatMessage)).encode('utf8')
 
-    def broadcast_message(self, chatMessage, username=''):
         for user in self.users:
-            if user.username is username:
-                user.socket.sendall("You: {0}".format(chatMessage).encode('utf8'))
-            else:
-                user.socket.sendall("{0} {1}".format(username, chatMessage).encode('utf8'))
+            self.send_to(user, ownMessage if user.username is username else otherMessage)
 
     def broadcast_server_message(self, message):
+        message = (self.tag + message).encode('utf8')
         for user in self.users:
-            user.socket.sendall(message.encode('utf8'))
+            self.send_to(user, message)
+
+    def send_to(self, user, data):
+        # Never blocks: what the peer cannot take yet waits in its outbox. A peer that has gone away, or was cut off
+        # for not reading, is cleaned up by its own client thread; it must not stop the broadcast.
+        try:
+            user.socket.sendall(data)
+        except OSError:
+            pass
 
     def get_all_users_in_channel(self):
         return ' '.join([user.username for user in self.users])
 
     def update(self):
+        self.version += 1
         all_users = self.get_all_users_in_channel()
 
+        chatMessage = (self.tag + '/supdate |' + all_users).encode('utf8')
         for user in self.users:
-            chatMessage = '/supdate |' + all_users
-            user.socket.sendall(chatMessage.encode('utf8'))
+            self.send_to(user, chatMessage)
 
     def remove_user_from_channel(self, user):
-        self.users.remove(user)
+        if user not in self.users:
+            return
+
+        del self.users[user]
+        self.version += 1
         leave_message = "\n> {0} has left the channel {1}\n".format(user.username, self.channel_name)
         self.broadcast_message(leave_message)
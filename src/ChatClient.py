@@ -1,16 +1,31 @@
+import codecs
 import socket
 import sys
+import Util
 
 class Client:
-    def __init__(self):
+    def __init__(self, tlsContext=None):
         self.socket = None
+        self.tls_context = tlsContext # an ssl.SSLContext (see Tls.client_context) to connect over TLS, or None.
+        self.tls_session = None # the last TLS session, offered on the next connection so it can skip the full handshake.
         self.isClientConnected = False
+        self.address = None
+        self.resume_token = None # issued by the server after registration; lets a new connection take over the session.
+        self.last_seen = {} # Channel Name -> id of the last message received in it.
+        self.pending = '' # received text not handed out yet, such as a control tag split across two reads.
+        self.decoder = codecs.getincrementaldecoder('utf8')()
+        self.tags = [] # the control tags that came with the last message received.
+        self.history_reply = None # (Channel Name, position) when the last message received was a /history page.
 
     def connect(self, host, port):
+        self.address = (host, port)
+
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.connect((host, port))
+            if self.tls_context is not None:
+                self.socket = self.tls_context.wrap_socket(self.socket, server_hostname=host, session=self.tls_session)
             self.isClientConnected = True
         except socket.error as errorMessage:
             if errorMessage.errno == socket.errno.ECONNREFUSED:
@@ -18,8 +33,42 @@ class Client:
             else:
                 sys.stderr.write('Error, unable to connect: {0}'.format(errorMessage))
 
+    def reconnect(self):
+        # Opens a new connection and resumes the previous session on it, asking only for the channel messages that
+        # arrived after the last ones seen.
+        if self.address is None or self.resume_token is None:
+            return False
+
+        if self.socket is not None:
+            self.keep_session()
+            self.socket.close()
+        self.isClientConnected = False
+        self.pending = ''
+        self.decoder.reset()
+
+        self.connect(*self.address)
+        if not self.isClientConnected:
+            return False
+
+        try:
+            self.socket.recv(4096) # the greeting asking for a full name.
+            lastSeen = ' '.join('{0}:{1}'.format(channelName, sequence) for channelName, sequence in self.last_seen.items())
+            self.send('/resume {0} {1}'.format(self.resume_token, lastSeen))
+        except OSError:
+            self.isClientConnected = False
+            return False
+
+        return True
+
+    def keep_session(self):
+        # With TLS 1.3 the ticket arrives after the handshake, so the session is only worth keeping once something
+        # has been read; taking it when the connection ends always gets the latest one.
+        if self.tls_context is not None and getattr(self.socket, "session", None) is not None:
+            self.tls_session = self.socket.session
+
     def disconnect(self):
         if self.isClientConnected:
+            self.keep_session()
             self.socket.close()
             self.isClientConnected = False
 
@@ -31,4 +80,49 @@ class Client:
         if not self.isClientConnected:
             return ""
 
-        return self.socket.recv(size).decode('utf8')
+        # Control tags are consumed here; a read that carried only tags is followed by another one.
+        self.history_reply = None
+        message, self.pending = self.pending, ''
+
+        while True:
+            if not message or message.rfind(Util.TAG_START) > message.rfind(Util.TAG_END):
+                data = self.socket.recv(size)
+                if not data:
+                    return ''
+                message += self.decoder.decode(data)
+                continue
+
+            historyStart = message.find(Util.TAG_START + 'history ')
+            if historyStart == 0:
+                return self.receive_history(message, size)
+            elif historyStart > 0: # hand out what came before the page first.
+                message, self.pending = message[:historyStart], message[historyStart:]
+
+            text, self.tags, remainder = Util.split_tags(message)
+
+            for kind, args in self.tags:
+                if kind == 'token':
+                    self.resume_token = args[0]
+                elif kind == 'seq':
+                    self.last_seen[args[0]] = int(args[1])
+
+            if text:
+                return text
+
+            message, self.pending = self.pending, ''
+
+    def receive_history(self, message, size):
+        tagEnd = message.find(Util.TAG_END)
+        channelName, position, length = message[1:tagEnd].split(' ')[1:]
+        page = message[tagEnd + 1:]
+
+        while len(page) < int(length):
+            data = self.socket.recv(size)
+            if not data:
+                return ''
+            page += self.decoder.decode(data)
+
+        self.tags = []
+        self.history_reply = (channelName, int(position))
+        self.pending = page[int(length):]
+        return page[:int(length)]
@@ -1,22 +1,58 @@
+import Admission
+import binascii
+import Capture
+import collections
+import os
+import select
 import socket
 import sys
 import threading
+import time
 import Channel
+import Filter
+import Framing
+import History
+import HotRestart
+import Mailbox
+import Outbox
+import Presence
+import Resolver
+import Scheduler
+import Shard
+import Snapshot
+import TimerWheel
+import Tls
 import User
+import Usernames
 import Util
 from time import gmtime, strftime
 
 
 class Server:
-    SERVER_CONFIG = {"MAX_CONNECTIONS": 15}
+    SERVER_CONFIG = {"LISTEN_BACKLOG": 4096, "MAX_CLIENTS": 10000, "MAX_CLIENTS_PER_ADDRESS": 200,
+                     "NEW_CLIENTS_PER_SECOND": 2000, "NEW_CLIENTS_PER_ADDRESS_PER_SECOND": 500, "CHANNEL_SHARDS": 4, "SNAPSHOT_FILE": "server.snapshot",
+                     "SNAPSHOT_INTERVAL": 30, "KEEPALIVE_INTERVAL": 60, "IDLE_TIMEOUT": 180, "AUTO_AWAY_AFTER": 600,
+                     "RESUME_TTL": 300, "HISTORY_ON_JOIN": 500, "HISTORY_PAGE": 500, "RECEIVE_BUFFER_SIZE": 4096,
+                     "THREAD_STACK_SIZE": 256 * 1024, "RESOLVER_TTL": 300, "RESOLVER_CACHE_SIZE": 4096,
+                     "FILTER_FILE": "filter.terms", "FILTER_ACTION": "mask", "FILTER_RELOAD_INTERVAL": 10,
+                     "MAILBOX_FILE": "mailboxes.spool", "MAILBOX_MEMORY": 16 * 1024 * 1024, "MAILBOX_LIMIT": 200,
+                     "MAILBOX_TTL": 86400, "MAILBOX_EXPIRY_INTERVAL": 60, "COMMAND_WORKERS": 16, "QUERY_WORKERS": 2,
+                     "CONTROL_LATENCY": 0.1, "CHAT_LATENCY": 0.25, "COMMAND_QUEUE_LIMIT": 64,
+                     "CAPTURE_FILE": "capture.trace", "CAPTURE_SCRUB": True, "TLS_CERT_FILE": None,
+                     "TLS_KEY_FILE": None, "TLS_HANDSHAKE_TIMEOUT": 10, "TLS_SESSION_TICKETS": 1,
+                     "MONITOR_LIMIT": 100, "MAX_MESSAGE_TARGETS": 1000, "SEND_QUEUE_LIMIT": 1024 * 1024}
     CHANNEL_OPERATOR_PASSWORD = "operator"
     HELP_MESSAGE = """\n<||> The list of commands available are: <||>
 
 /away                       - User can set status to away and set an away message.
+/capture [on|off]           - Starts or stops recording client traffic for Replay.py (operators only).
 /connect [server] [port]    - Instructs the server to shutdown.
 /clear                      - Extra command implemented to clear the chat window
 /die                        - Instructs the server to shutdown.
+/filter [channel] [action]  - Sets what a channel does with banned terms: drop, mask, flag or off (operators only).
+/filter reload              - Reloads the banned terms file now (operators only).
 /help                       - Show the instructions.
+/history [channel] [before] - Fetches the channel messages logged before the given position.
 /info                       - Returns information about the server.
 /invite [name] [channel]    - Invite a user to a channel.
 /ison [nickname]            - Check to see if users are online.
@@ -25,16 +61,20 @@ class Server:
 /knock [channel] [message]  - Sends a message to the target_channel.
 /kill [client]              - Forcibly removes client from the network.                            
 /list                       - Lists all available channels.
+/monitor [+|-] [names]      - Watches (or stops watching) users; their online/away/offline changes are pushed to you.
+/monitor [c|l|s]            - Clears your watch list, lists it, or shows the current state of everyone on it.
 /nick [nickname]            - Changes users nickname.
-/notice [nickname] [msg]    - Similar to PRIVMSG, except no automatic replies.
+/notice [names] [msg]       - Similar to PRIVMSG, except no automatic replies.
+/part [channel]             - Leave a channel (the one you are talking in by default).
 /oper [username] [password] - Authenticates a user as an IRC operator.
 /ping                       - A Ping message results in a Pong Reply.
 /pong                       - A Pong message results in a Ping Reply.
-/privmsg [nickname] [msg]   - Send a private message to a user.
+/privmsg [names] [msg]      - Send a private message to users or channels, comma separated (a,b,#c).
 /quit                       - Exits the program.
 /restart                    - Restart the server.
 /rules                      - Requests the server rules.
 /setname [fullname]         - Allows a client to change the "real name" specified when registering a connection.
+/stats                      - Shows connection admission and accept queue counters (operators only).
 /time                       - Returns the local time on the server.
 /topic [channel] [topic]    - Returns or sets the channels topic.
 /userhost [nicknames]       - Returns a list of information about the nicknames specified.
@@ -47,15 +87,75 @@ class Server:
 
 
     WELCOME_MESSAGE = "\n> Welcome to our chat app!!! What is your name?\n".encode('utf8')
-
-    def __init__(self, host=socket.gethostbyname('localhost'), port=50000, allowReuseAddress=True, timeout=3):
+    BUSY_MESSAGE = "\n> The server is busy, please try again later.\n".encode('utf8')
+    FAILED_MESSAGE = "\n> Something went wrong with that command; it was not completed.\n".encode('utf8')
+    # Command -> priority class; anything else that is not a command is chat. None runs on the client's own thread:
+    # /ping, /pong and /quit so that nothing queued ahead of them on a busy chat path can delay them, and /restart
+    # since handing over the sockets waits for every client thread, the one asking included, to pause.
+    COMMAND_PRIORITIES = {"/quit": None, "/ping": None, "/pong": None, "/part": Scheduler.CONTROL,
+                          "/away": Scheduler.CONTROL, "/join": Scheduler.CHAT, "/privmsg": Scheduler.CHAT,
+                          "/notice": Scheduler.CHAT, "/knock": Scheduler.CHAT, "/invite": Scheduler.CHAT,
+                          "/nick": Scheduler.CHAT, "/history": Scheduler.CHAT, "/monitor": Scheduler.CHAT,
+                          "/clear": Scheduler.CHAT, "/setname": Scheduler.CHAT, "/oper": Scheduler.ADMIN,
+                          "/kick": Scheduler.ADMIN, "/kill": Scheduler.ADMIN, "/die": Scheduler.ADMIN,
+                          "/wallops": Scheduler.ADMIN, "/filter": Scheduler.ADMIN, "/topic": Scheduler.ADMIN,
+                          "/connect": Scheduler.ADMIN, "/capture": Scheduler.ADMIN, "/restart": None}
+
+    def __init__(self, host='127.0.0.1', port=50000, allowReuseAddress=True, timeout=3,
+                 serverSocket=None):
         self.address = (host, port)
         self.channels = {} # Channel Name -> Channel
-        self.channel_files = {} # Channel Name -> Channel File
-        self.users_channels_map = {} # User Name -> Channel Name
-        self.client_thread_list = [] # A list of all threads that are either running or have finished their task.
+        self.channel_files = {} # Channel Name -> History.ChannelHistory
+        self.users_channels_map = {} # User Name -> that user's User.channels, for users in at least one channel
+        self.client_threads = set() # The threads serving clients that are still connected.
+        self.receive_buffers = collections.deque() # Spare receive buffers, shared by every connection's thread.
         self.users = [] # A list of all the users who are connected to the server.
+        self.users_lock = threading.Lock() # Guards users and users_channels_map, which span every shard.
+        self.sessions = {} # Resume Token -> {"user", "channels", "monitoring" (names watched), "expiry" (Timer)}
+        self.held_names = {} # User Name -> Resume Token, for names only a session held for a departed user keeps.
+        self.usernames = Usernames.UsernameAllocator() # Held by every connected user and every resumable session.
+        self.presence = Presence.PresenceIndex(Server.SERVER_CONFIG["MONITOR_LIMIT"]) # Who is watching whom.
+        self.content_filter = Filter.ContentFilter(Server.SERVER_CONFIG["FILTER_FILE"],
+                                                   Server.SERVER_CONFIG["FILTER_ACTION"])
+        self.content_filter.reload()
+        self.scheduler = Scheduler.Scheduler(Server.SERVER_CONFIG["COMMAND_WORKERS"],
+                                             {Scheduler.CONTROL: Server.SERVER_CONFIG["CONTROL_LATENCY"],
+                                              Scheduler.CHAT: Server.SERVER_CONFIG["CHAT_LATENCY"]},
+                                             Server.SERVER_CONFIG["COMMAND_QUEUE_LIMIT"],
+                                             concurrency={Scheduler.QUERY: Server.SERVER_CONFIG["QUERY_WORKERS"]})
+        self.mailboxes = Mailbox.MailStore(Server.SERVER_CONFIG["MAILBOX_FILE"], Server.SERVER_CONFIG["MAILBOX_MEMORY"],
+                                           Server.SERVER_CONFIG["MAILBOX_LIMIT"], Server.SERVER_CONFIG["MAILBOX_TTL"])
+        self.resolver = Resolver.Resolver(Server.SERVER_CONFIG["RESOLVER_TTL"],
+                                          maxEntries=Server.SERVER_CONFIG["RESOLVER_CACHE_SIZE"])
+        self.shards = Shard.ShardPool(Server.SERVER_CONFIG["CHANNEL_SHARDS"]) # Channel Name -> owning executor
+        self.writer = Outbox.Writer() # Finishes the sends a client's socket could not take at once.
+        self.capture = None # A Capture.TraceWriter while client traffic is being recorded.
+        self.tls_context = None # Every connection is TLS when a certificate is configured.
+        if Server.SERVER_CONFIG["TLS_CERT_FILE"]:
+            self.tls_context = Tls.server_context(Server.SERVER_CONFIG["TLS_CERT_FILE"],
+                                                  Server.SERVER_CONFIG["TLS_KEY_FILE"],
+                                                  Server.SERVER_CONFIG["TLS_SESSION_TICKETS"])
         self.exit_signal = threading.Event()
+        self.handoff_signal = threading.Event() # Set while a hot restart is handing the sockets to a new process.
+        self.listening = threading.Event() # Set once start_listening is ready for connections.
+        self.handoff_condition = threading.Condition()
+        self.active_readers = set() # Threads between reading a command and waiting for the next one.
+        self.snapshot = Snapshot.SnapshotReader.open(Server.SERVER_CONFIG["SNAPSHOT_FILE"]) # Loaded lazily (mmap).
+        self.snapshot_writer = Snapshot.SnapshotWriter(self, Server.SERVER_CONFIG["SNAPSHOT_FILE"],
+                                                       Server.SERVER_CONFIG["SNAPSHOT_INTERVAL"])
+        self.timers = TimerWheel.TimerWheel() # Keepalives, idle eviction and auto-away for every connection.
+        self.admission = Admission.Admission(Server.SERVER_CONFIG["MAX_CLIENTS"],
+                                             Server.SERVER_CONFIG["MAX_CLIENTS_PER_ADDRESS"],
+                                             Server.SERVER_CONFIG["NEW_CLIENTS_PER_SECOND"],
+                                             Server.SERVER_CONFIG["NEW_CLIENTS_PER_ADDRESS_PER_SECOND"])
+        self.accept_stats = {"wakeups": 0, "largest_burst": 0, "deepest_queue": 0,
+                             "kernel_overflows": Admission.listen_overflows()}
+
+        if serverSocket is not None: # Resuming from a hot restart: the socket is already bound and listening.
+            self.serverSocket = serverSocket
+            self.serverSocket.settimeout(timeout)
+            self.address = self.serverSocket.getsockname()
+            return
 
         try:
             self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -76,43 +176,227 @@ class Server:
                                                                                              errorMessage))
             raise
 
+        self.address = self.serverSocket.getsockname()
+        self.restore_sessions() # a hot restart hands over the sessions themselves instead.
+
     def start_listening(self, defaultGreeting="\n> Welcome to our chat app!!! What is your full name?\n"):
-        self.serverSocket.listen(Server.SERVER_CONFIG["MAX_CONNECTIONS"])
+        timeout = self.serverSocket.gettimeout()
+        self.serverSocket.listen(Server.SERVER_CONFIG["LISTEN_BACKLOG"])
+        self.serverSocket.setblocking(False)
+        threading.stack_size(Server.SERVER_CONFIG["THREAD_STACK_SIZE"]) # client threads only ever need a little stack.
+        self.listening.set()
+        self.snapshot_writer.start()
+        self.writer.start()
+        self.timers.start()
+        self.timers.schedule(Server.SERVER_CONFIG["FILTER_RELOAD_INTERVAL"], self.check_filter)
+        self.timers.schedule(Server.SERVER_CONFIG["MAILBOX_EXPIRY_INTERVAL"], self.expire_mail)
 
         try:
+            print("Waiting for clients to establish a connection\n")
             while not self.exit_signal.is_set():
-                try:
-                    print("Waiting for a client to establish a connection\n")
-                    clientSocket, clientAddress = self.serverSocket.accept()
-                    print("Connection established with IP address {0} and port {1}\n".format(clientAddress[0],
-                                                                                             clientAddress[1]))
-                    user = User.User(clientSocket)
-                    self.users.append(user)
-                    self.welcome_user(user)
-                    clientThread = threading.Thread(target=self.client_thread, args=(user,))
-                    clientThread.start()
-                    self.client_thread_list.append(clientThread)
-                except socket.timeout:
-                    pass
+                if self.wait_readable(self.serverSocket, timeout):
+                    self.accept_pending()
         except KeyboardInterrupt:
             self.exit_signal.set()
 
-        for client in self.client_thread_list:
-            if client.is_alive():
-                client.join()
+        for client in list(self.client_threads):
+            client.join()
+
+    def accept_pending(self):
+        # Takes every connection that is waiting, not just one, so a burst of reconnects is cleared in one wakeup.
+        # Nothing here writes to a client that was let in; the greeting is sent from the client's own thread.
+        queue = Admission.accept_queue(self.serverSocket)
+        accepted = 0
+
+        while True:
+            try:
+                clientSocket, clientAddress = self.serverSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as errorMessage: # e.g. out of file descriptors; leave the rest queued for the next wakeup.
+                sys.stderr.write("Failed to accept a connection. Error - {0}\n".format(errorMessage))
+                break
+
+            accepted += 1
+            if self.admission.admit(clientAddress[0]) is not None:
+                self.refuse(clientSocket)
+                continue
+
+            clientSocket.setblocking(True)
+            if self.tls_context is not None: # the handshake itself happens on the client's own thread.
+                clientSocket = Tls.SecureSocket(clientSocket, self.tls_context)
+            user = User.User(self.outbound(clientSocket))
+            user.address = clientAddress
+            with self.users_lock:
+                self.users.append(user)
+            self.start_client(user)
+
+        self.accept_stats["wakeups"] += 1
+        self.accept_stats["largest_burst"] = max(self.accept_stats["largest_burst"], accepted)
+        if queue is not None:
+            self.accept_stats["deepest_queue"] = max(self.accept_stats["deepest_queue"], queue[0])
+
+    def refuse(self, clientSocket):
+        # Best effort only: a refused client must never hold up the accept loop. A TLS client could not read the
+        # message before a handshake, so it is simply closed.
+        if self.tls_context is None:
+            try:
+                clientSocket.setblocking(False)
+                clientSocket.send(Server.BUSY_MESSAGE)
+            except OSError:
+                pass
+        clientSocket.close()
+
+    def outbound(self, clientSocket):
+        # Everything sent to a client goes through its outbox, so no thread ever waits on a peer that is not reading.
+        return Outbox.Outbox(clientSocket, self.writer, Server.SERVER_CONFIG["SEND_QUEUE_LIMIT"])
 
     def welcome_user(self, user):
         user.socket.sendall(Server.WELCOME_MESSAGE)
 
-    def client_thread(self, user, size=4096):
-        fullname = user.socket.recv(size).decode('utf8')
-        username = Util.generate_username(fullname).lower()
+    def start_client(self, user):
+        user.last_seen = user.last_activity = time.monotonic()
+        capture = self.capture
+        if capture is not None:
+            capture.open(user)
+        user.idle_timer = self.timers.schedule(self.next_idle_check(user), self.check_idle, user)
+
+        clientThread = threading.Thread(target=self.client_thread, args=(user,))
+        self.client_threads.add(clientThread)
+        clientThread.start()
+
+    def wait_readable(self, sock, timeout=None):
+        # Every reader blocks here rather than in recv. A thread that has returned from here is "active" until it
+        # comes back, and a hot restart only has to wait for the active ones; idle readers never need waking.
+        currentThread = threading.current_thread()
+
+        with self.handoff_condition:
+            self.active_readers.discard(currentThread)
+            if self.handoff_signal.is_set():
+                self.handoff_condition.notify_all()
+
+        while True:
+            if self.handoff_signal.is_set():
+                with self.handoff_condition:
+                    self.handoff_condition.wait_for(lambda: not self.handoff_signal.is_set())
+
+            if getattr(sock, "pending", None) is not None and sock.pending():
+                readable = True # already decrypted, so the socket itself may have nothing more to read.
+            elif hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(sock, select.POLLIN)
+                readable = poller.poll(None if timeout is None else timeout * 1000)
+            else:
+                readable = select.select([sock], [], [], timeout)[0]
+
+            if not readable:
+                return False
+
+            with self.handoff_condition:
+                if not self.handoff_signal.is_set():
+                    self.active_readers.add(currentThread)
+                    return True
+
+    def park_readers(self, timeout=5):
+        # Stops every reader except the caller from consuming input, waiting for the ones mid-command to finish.
+        caller = threading.current_thread()
+        deadline = time.time() + timeout
+
+        with self.handoff_condition:
+            self.handoff_signal.set()
+
+            while any(reader is not caller and reader.is_alive() for reader in self.active_readers):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Client threads did not pause for the handoff.")
+                self.handoff_condition.wait(min(remaining, 0.05))
+
+    def unpark_readers(self):
+        with self.handoff_condition:
+            self.handoff_signal.clear()
+            self.handoff_condition.notify_all()
+
+    def receive(self, user, size=4096):
+        # Returns the next decoded chunk, or '' once the peer has gone. A multi-byte character split across two
+        # reads is kept in user.buffer until the rest of it arrives. A framed client gets one line at a time.
+        while True:
+            if user.framed and b'\n' in user.buffer:
+                line, user.buffer = user.buffer.split(b'\n', 1)
+                text = line.decode('utf8', 'replace').rstrip('\r')
+                if text:
+                    self.record(user, text)
+                    return text
+                continue
+
+            self.wait_readable(user.socket)
+            data = self.recv(user.socket, size)
+
+            if not data:
+                return ''
+
+            user.last_seen = time.monotonic()
+
+            if user.framed:
+                user.buffer += data
+                continue
+
+            data = user.buffer + data
+            user.buffer = b''
+
+            try:
+                text = data.decode('utf8')
+            except UnicodeDecodeError as error:
+                if error.reason != 'unexpected end of data':
+                    text = data.decode('utf8', 'replace')
+                else:
+                    user.buffer = data[error.start:]
+                    text = data[:error.start].decode('utf8')
+
+            if text:
+                self.record(user, text)
+                return text
+
+    def record(self, user, text):
+        capture = self.capture
+        if capture is not None:
+            capture.record(user, text)
+
+    def recv(self, sock, size):
+        # Reads into a pooled buffer and copies out only what arrived, instead of every read allocating size bytes.
+        try:
+            buffer = self.receive_buffers.pop()
+        except IndexError:
+            buffer = bytearray(Server.SERVER_CONFIG["RECEIVE_BUFFER_SIZE"])
+
+        try:
+            count = sock.recv_into(buffer, min(size, len(buffer)))
+            return bytes(memoryview(buffer)[:count])
+        finally:
+            self.receive_buffers.append(buffer)
+
+    def register(self, user, size=4096):
+        fullname = self.receive(user, size)
+
+        if fullname.startswith('/caps'):
+            fullname = self.negotiate(user, fullname, size)
+
+        if fullname.startswith('/resume'):
+            if self.resume(user, fullname):
+                return True
+            user.socket.sendall("\n> Your session could not be resumed. What is your full name?\n".encode('utf8'))
+            fullname = self.receive(user, size)
+
+        prefix = Util.username_prefix(fullname).lower()
+
+        while not prefix:
+            if not fullname: # the client left before finishing the handshake.
+                return False
 
-        while not username:
             user.socket.sendall("\n> Please enter your full name(first and last. middle optional).\n".encode('utf8'))
-            fullname = user.socket.recv(size).decode('utf8')
-            username = Util.generate_username(fullname).lower()
+            fullname = self.receive(user, size)
+            prefix = Util.username_prefix(fullname).lower()
 
+        username = self.usernames.allocate(prefix, user)
         user.username = username
         user.nickname = username
         user.fullname = fullname
@@ -120,96 +404,389 @@ class Server:
         welcomeMessage = '\n> Welcome {0}, type /help for a list of helpful commands.\n\n'.format(user.username)\
             .encode('utf8')
         user.socket.sendall(welcomeMessage)
+        self.issue_token(user)
+        self.publish_presence(user.username, self.presence_of(user))
+        return True
+
+    def negotiate(self, user, message, size=4096):
+        # /caps <capability> ... -- sent before the handshake. Anything the client pipelined after it is kept for the
+        # next receive, and the reply lists the capabilities that were turned on.
+        line, separator, rest = message.partition('\n')
+        enabled = [capability for capability in line.split()[1:] if capability == Framing.CAPABILITY]
+
+        if enabled:
+            user.buffer = rest.encode('utf8') + user.buffer
+            user.framed = True
+            user.socket = Framing.FramedSocket(user.socket)
+            rest = ''
+
+        user.socket.sendall(Util.make_tag('caps', *enabled).encode('utf8'))
+        return rest.strip() or self.receive(user, size)
+
+    def issue_token(self, user):
+        user.resume_token = binascii.hexlify(os.urandom(16)).decode('ascii')
+
+        with self.users_lock:
+            self.sessions[user.resume_token] = {"user": user, "channels": [], "monitoring": [], "expiry": None}
+
+        user.socket.sendall(Util.make_tag('token', user.resume_token).encode('utf8'))
+
+    def resume(self, user, message):
+        # /resume <token> [<channel>:<last seen id> ...] -- takes over the identity of the session the token was
+        # issued to and sends only the channel messages the client missed.
+        parts = message.split()
+        token = parts[1] if len(parts) > 1 else ''
+
+        with self.users_lock:
+            session = self.sessions.pop(token, None)
+
+        if session is None:
+            return False
+
+        self.timers.cancel(session["expiry"])
+        previous = session["user"]
+        if self.snapshot is not None: # from here on the user's own record is what gets saved.
+            self.snapshot.users.pop(previous.username, None)
+
+        if previous in self.users: # the old connection is dead but has not been noticed yet.
+            previous.resume_token = None
+            try:
+                previous.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            session["channels"] = previous.channel_names()
+            session["monitoring"] = self.presence.watched(previous)
+            self.remove_user(previous, keepUsername=True)
+
+        # The session held on to the username all along, so it passes straight to the new connection.
+        with self.users_lock:
+            self.usernames.assign(previous.username, user)
+            self.held_names.pop(previous.username, None)
+            user.username = previous.username
+            user.nickname = previous.nickname
+            user.fullname = previous.fullname
+            user.usertype = previous.usertype
+            user.status = previous.status
+            user.awaymessage = previous.awaymessage
+
+        user.socket.sendall('\n> Welcome back {0}.\n\n'.format(user.username).encode('utf8'))
+        self.issue_token(user)
+        self.presence.watch(user, session["monitoring"])
+        self.publish_presence(user.username, self.presence_of(user))
+        self.deliver_mail(user, token)
+
+        lastSeen = dict(part.rsplit(':', 1) for part in parts[2:] if ':' in part)
+        for channelName in session["channels"]:
+            self.join(user, "/join {0} {1}".format(channelName, lastSeen.get(channelName, '')))
+
+        return True
+
+    def expire_session(self, token):
+        with self.users_lock:
+            session = self.sessions.get(token)
+            if session is not None and session["user"] not in self.users:
+                del self.sessions[token]
+                self.held_names.pop(session["user"].username, None)
+                self.usernames.release(session["user"].username)
+                self.mailboxes.drop(token)
+                if self.snapshot is not None: # or the next snapshot would hold the name all over again.
+                    self.snapshot.users.pop(session["user"].username, None)
+
+    def deliver_mail(self, user, token):
+        # Everything sent to the user while only their session held the name arrives in one batch.
+        with self.users_lock:
+            waiting = self.mailboxes.take(token)
+
+        if waiting:
+            user.socket.sendall(("\n<||> Messages received while you were away: <||>\n" + waiting).encode('utf8'))
+
+    def expire_mail(self):
+        self.mailboxes.expire()
+        self.timers.schedule(Server.SERVER_CONFIG["MAILBOX_EXPIRY_INTERVAL"], self.expire_mail)
+
+    def restore_sessions(self):
+        # Everyone who was connected when the last snapshot was taken gets a resume session, so their name is held
+        # for them and only the token they were issued brings back their status and channels. Operator status is
+        # never carried over; it has to be asked for again with /oper.
+        if self.snapshot is None:
+            return
+
+        for username in list(self.snapshot.users):
+            record = self.snapshot.user(username)
+            # A record without a token can never be resumed; a token nobody has just holds the name until it expires.
+            token = record["resume_token"] or binascii.hexlify(os.urandom(16)).decode('ascii')
+            if token in self.sessions or not self.usernames.claim(username):
+                continue
+
+            user = User.User(None, record["fullname"], username, record["nickname"])
+            user.status = record["status"]
+            user.awaymessage = record["awaymessage"]
+            user.resume_token = token
+            self.held_names[username] = token
+            self.sessions[token] = {"user": user, "channels": record["channel"].split(), "monitoring": [],
+                                    "expiry": self.timers.schedule(Server.SERVER_CONFIG["RESUME_TTL"],
+                                                                   self.expire_session, token)}
+
+    def client_thread(self, user, size=4096):
+        if not user.username: # A user handed over by a hot restart has already registered.
+            try:
+                if self.tls_context is not None:
+                    user.socket.handshake(Server.SERVER_CONFIG["TLS_HANDSHAKE_TIMEOUT"])
+                self.welcome_user(user)
+                registered = self.register(user, size)
+            except OSError:
+                registered = False
+            except Exception as errorMessage: # the connection is still cleaned up below, as for any failed handshake.
+                sys.stderr.write("Registration failed. Error - {0!r}\n".format(errorMessage))
+                registered = False
+
+            if not registered:
+                self.remove_user(user)
+                self.disconnect(user)
+                return
 
         while True:
-            chatMessage = user.socket.recv(size).decode('utf8').lower()
+            try:
+                chatMessage = self.receive(user, size).lower()
+            except OSError:
+                chatMessage = ''
 
             if self.exit_signal.is_set():
                 break
 
             if not chatMessage:
+                self.remove_user(user)
                 break
 
-            if '/away' in chatMessage:
-                self.away(user, chatMessage)
-            elif '/connect' in chatMessage:
-                self.connect(chatMessage)
-            elif '/clear' in chatMessage:
-                self.clear(user)
-            elif '/die' in chatMessage:
-                self.die()
-            elif '/help' in chatMessage:
-                self.help(user)
-            elif '/info' in chatMessage:
-                self.info(user)
-            elif '/invite' in chatMessage:
-                self.invite(user, chatMessage)
-            elif '/ison' in chatMessage:
-                self.ison(user, chatMessage)
-            elif '/join' in chatMessage:
-                self.join(user, chatMessage)
-            elif '/kick' in chatMessage:
-                self.kick(user, chatMessage)
-            elif '/kill' in chatMessage:
-                self.kill(user, chatMessage)
-            elif '/list' in chatMessage:
-                self.list_all_channels(user)
-            elif '/nick' in chatMessage:
-                self.nick(user, chatMessage)
-            elif '/notice' in chatMessage:
-                self.notice(user, chatMessage)
-            elif '/oper' in chatMessage:
-                self.oper(user, chatMessage)
-            elif '/ping' in chatMessage:
-                self.ping(user)
-            elif '/pong' in chatMessage:
-                self.pong(user)
-            elif '/privmsg' in chatMessage:
-                self.privateMessage(user, chatMessage)
-            elif '/quit' in chatMessage:
-                self.quit(user)
+            if chatMessage.strip() == '/spong': # a reply to our keepalive, not user activity.
+                continue
+
+            try:
+                self.mark_active(user)
+                result = self.scheduler.run(self.classify(chatMessage), self.dispatch, user, chatMessage)
+
+                if result is Scheduler.SHED:
+                    user.socket.sendall(Server.BUSY_MESSAGE)
+                elif not result:
+                    break
+            except OSError: # the peer went away while we were answering it.
+                self.remove_user(user)
                 break
-            elif '/restart' in chatMessage:
-                self.restart()
-            elif '/rules' in chatMessage:
-                self.rules(user)
-            elif '/setname' in chatMessage:
-                self.setname(user, chatMessage)
-            elif '/time' in chatMessage:
-                self.time(user)
-            elif '/topic' in chatMessage:
-                self.topic(user, chatMessage)
-            elif '/userhost' in chatMessage:
-                self.userhost(user, chatMessage)
-            elif '/userip' in chatMessage:
-                self.user_ip(user, chatMessage)
-            elif '/users' in chatMessage:
-                self.users_list(user)
-            elif '/version' in chatMessage:
-                self.version(user)
-            elif '/wallops' in chatMessage:
-                self.wallops(user, chatMessage)
-            elif '/who' in chatMessage:
-                self.who(user, chatMessage)
-            elif '/whois' in chatMessage:
-                self.who_is(user, chatMessage)
-            else:
-                self.send_message(user, chatMessage + '\n')
+            except Exception as errorMessage: # a broken command must not end the thread that cleans up after the user.
+                sys.stderr.write("Command {0!r} from {1} failed. Error - {2!r}\n".format(chatMessage, user.username,
+                                                                                      errorMessage))
+                try:
+                    user.socket.sendall(Server.FAILED_MESSAGE)
+                except OSError:
+                    self.remove_user(user)
+                    break
 
         if self.exit_signal.is_set():
-            user.socket.sendall('/squit'.encode('utf8'))
+            try:
+                user.socket.sendall('/squit'.encode('utf8'))
+            except OSError: # the client is already gone.
+                pass
+
+        self.disconnect(user)
 
+    def disconnect(self, user):
         user.socket.close()
+        capture = self.capture
+        if capture is not None:
+            capture.close(user)
+        if user.address is not None:
+            self.admission.release(user.address[0])
+        self.client_threads.discard(threading.current_thread())
+
+    def next_idle_check(self, user):
+        # Seconds until the earliest of this user's keepalive, eviction or auto-away deadlines.
+        config = Server.SERVER_CONFIG
+        now = time.monotonic()
+        silent = now - user.last_seen
+        idle = now - user.last_activity
+
+        deadlines = [config["IDLE_TIMEOUT"] - silent]
+        deadlines.append(config["KEEPALIVE_INTERVAL"] - silent if silent < config["KEEPALIVE_INTERVAL"]
+                         else config["KEEPALIVE_INTERVAL"])
+        if not user.auto_away and user.status == "Online":
+            deadlines.append(config["AUTO_AWAY_AFTER"] - idle)
+
+        return max(1, min(deadlines))
+
+    def check_idle(self, user):
+        # Runs on the timer wheel thread, so nothing here may block. Activity only updates timestamps; the single
+        # timer per connection is re-armed from here rather than on every message.
+        config = Server.SERVER_CONFIG
+        now = time.monotonic()
+
+        if now - user.last_seen >= config["IDLE_TIMEOUT"]:
+            try:
+                user.socket.shutdown(socket.SHUT_RDWR) # its client thread sees the EOF and removes the user.
+            except OSError:
+                pass
+            return
+
+        if now - user.last_activity >= config["AUTO_AWAY_AFTER"] and user.status == "Online" and user.username:
+            user.auto_away = True
+            user.status = "Away"
+            user.awaymessage = "Idle"
+            self.publish_presence(user.username, "away")
+
+        if now - user.last_seen >= config["KEEPALIVE_INTERVAL"] and user.username:
+            try: # only ever tried: a client whose outbox or socket is busy gets its keepalive next time round.
+                user.socket.send('/sping'.encode('utf8'), getattr(socket, "MSG_DONTWAIT", 0))
+            except OSError:
+                pass
+
+        user.idle_timer = self.timers.schedule(self.next_idle_check(user), self.check_idle, user)
+
+    def mark_active(self, user):
+        user.last_activity = time.monotonic()
+
+        if user.auto_away:
+            user.auto_away = False
+            user.status = "Online"
+            user.awaymessage = ""
+            user.socket.sendall("<||> Status changed back to Online. <||>\n".encode('utf8'))
+            self.publish_presence(user.username, "online")
+
+    def command_of(self, chatMessage):
+        # The command a line is, by its first word, or '' for chat; classify and dispatch must always agree on it.
+        words = chatMessage.split(None, 1)
+        return words[0] if words and words[0].startswith('/') else ''
+
+    def classify(self, chatMessage):
+        # The priority class of a command; other slash commands are queries.
+        command = self.command_of(chatMessage)
+        if not command:
+            return Scheduler.CHAT
+        return Server.COMMAND_PRIORITIES.get(command, Scheduler.QUERY)
+
+    def dispatch(self, user, chatMessage):
+        command = self.command_of(chatMessage)
+
+        if command == '/away':
+            self.away(user, chatMessage)
+        elif command == '/connect':
+            self.connect(chatMessage)
+        elif command == '/capture':
+            self.capture_traffic(user, chatMessage)
+        elif command == '/clear':
+            self.clear(user)
+        elif command == '/die':
+            self.die()
+        elif command == '/filter':
+            self.filter(user, chatMessage)
+        elif command == '/help':
+            self.help(user)
+        elif command == '/history':
+            self.history(user, chatMessage)
+        elif command == '/info':
+            self.info(user)
+        elif command == '/invite':
+            self.invite(user, chatMessage)
+        elif command == '/ison':
+            self.ison(user, chatMessage)
+        elif command == '/join':
+            self.join(user, chatMessage)
+        elif command == '/kick':
+            self.kick(user, chatMessage)
+        elif command == '/kill':
+            self.kill(user, chatMessage)
+        elif command == '/list':
+            self.list_all_channels(user)
+        elif command == '/monitor':
+            self.monitor(user, chatMessage)
+        elif command == '/nick':
+            self.nick(user, chatMessage)
+        elif command == '/notice':
+            self.notice(user, chatMessage)
+        elif command == '/part':
+            self.part(user, chatMessage)
+        elif command == '/oper':
+            self.oper(user, chatMessage)
+        elif command == '/ping':
+            self.ping(user)
+        elif command == '/pong':
+            self.pong(user)
+        elif command == '/privmsg':
+            self.privateMessage(user, chatMessage)
+        elif command == '/quit':
+            self.quit(user)
+            return False
+        elif command == '/restart':
+            self.restart(user)
+        elif command == '/rules':
+            self.rules(user)
+        elif command == '/setname':
+            self.setname(user, chatMessage)
+        elif command == '/stats':
+            self.stats(user)
+        elif command == '/time':
+            self.time(user)
+        elif command == '/topic':
+            self.topic(user, chatMessage)
+        elif command == '/userhost':
+            self.userhost(user, chatMessage)
+        elif command == '/userip':
+            self.user_ip(user, chatMessage)
+        elif command == '/users':
+            self.users_list(user)
+        elif command == '/version':
+            self.version(user)
+        elif command == '/wallops':
+            self.wallops(user, chatMessage)
+        elif command == '/who':
+            self.who(user, chatMessage)
+        elif command == '/whois':
+            self.who_is(user, chatMessage)
+        else:
+            self.send_message(user, chatMessage + '\n')
+
+        return True
 
     def away(self, user, chatMessage):
+        user.auto_away = False
+
         if len(chatMessage.split()) > 1:
             awayMessage = chatMessage.split(" ", 1)[1]
             user.status = "Away"
             user.awaymessage = awayMessage
             user.socket.sendall("<||> Status changed to Away. <||>\n".encode('utf8'))
+            self.publish_presence(user.username, "away")
         else:
             user.status = "Online"
-            user.awayMessage = ""
+            user.awaymessage = ""
+            self.publish_presence(user.username, "online")
+
+    def capture_traffic(self, user, chatMessage):
+        if user.usertype == "user":
+            user.socket.sendall('\n<||>  Must be a Channel Operator or Admin to capture traffic. <||>\n'.encode('utf8'))
+            return
+
+        parts = chatMessage.split()
+        if len(parts) == 2 and parts[1] == 'on':
+            self.start_capture(Server.SERVER_CONFIG["CAPTURE_FILE"], Server.SERVER_CONFIG["CAPTURE_SCRUB"])
+            user.socket.sendall('\n<||> Capturing client traffic to {0}. <||>\n'
+                                .format(Server.SERVER_CONFIG["CAPTURE_FILE"]).encode('utf8'))
+        elif len(parts) == 2 and parts[1] == 'off':
+            records = self.stop_capture()
+            user.socket.sendall('\n<||> Capture stopped after {0} records. <||>\n'.format(records).encode('utf8'))
+        else:
+            state = 'on, {0} records so far'.format(self.capture.records) if self.capture is not None else 'off'
+            user.socket.sendall('\n<||> Capture is {0}. Usage: /capture [on|off] <||>\n'.format(state).encode('utf8'))
+
+    def start_capture(self, path, scrub=True):
+        # Every connected user is included from their next command on; a capture already running is finished first.
+        self.stop_capture()
+        self.capture = Capture.TraceWriter(path, scrub)
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is None:
+            return 0
+        capture.stop()
+        return capture.records
 
     def connect(self, chatMessage):
         host = chatMessage.split()[1]
@@ -231,9 +808,57 @@ class Server:
         self.broadcast_message("/squit")
         self.server_shutdown()
 
+    def filter(self, user, chatMessage):
+        if user.usertype == "user":
+            user.socket.sendall('\n<||>  Must be a Channel Operator or Admin to change the filter. <||>\n'.encode('utf8'))
+            return
+
+        parts = chatMessage.split()
+        if len(parts) == 2 and parts[1] == 'reload':
+            count = self.content_filter.reload()
+            user.socket.sendall('\n<||> Content filter reloaded with {0} terms. <||>\n'.format(count).encode('utf8'))
+        elif len(parts) == 2:
+            user.socket.sendall('\n<||> Content filter action for {0}: {1} <||>\n'
+                                .format(parts[1], self.content_filter.action(parts[1])).encode('utf8'))
+        elif len(parts) == 3 and parts[2] in Filter.ACTIONS:
+            self.content_filter.set_action(parts[1], parts[2])
+            user.socket.sendall('\n<||> Content filter action for {0} set to {1}. <||>\n'
+                                .format(parts[1], parts[2]).encode('utf8'))
+        else:
+            user.socket.sendall('\n<||> Usage: /filter reload, or /filter [channel] [{0}] <||>\n'
+                                .format('|'.join(Filter.ACTIONS)).encode('utf8'))
+
+    def check_filter(self):
+        # Runs on the timer wheel; a changed terms file is compiled on its own thread.
+        self.content_filter.reload_if_changed()
+        self.timers.schedule(Server.SERVER_CONFIG["FILTER_RELOAD_INTERVAL"], self.check_filter)
+
     def help(self, user):
         user.socket.sendall(Server.HELP_MESSAGE)
 
+    def history(self, user, chatMessage):
+        # /history <channel> <before> -- the page of logged messages before the given position.
+        if len(chatMessage.split()) < 3 or not chatMessage.split()[2].isdigit():
+            user.socket.sendall("<||> Usage: /history [channel] [before]. <||>\n".encode('utf8'))
+            return
+
+        channelName = chatMessage.split()[1]
+
+        if self.find_channel(channelName) is None:
+            user.socket.sendall("<||> Channel does not exist. <||>\n".encode('utf8'))
+        else:
+            self.shards.run(channelName, self.send_history, user, channelName, int(chatMessage.split()[2]))
+
+    def send_history(self, user, channelName, before):
+        # Runs on the shard that owns channelName. The tag carries the length so the client can tell where the page
+        # ends however it is split across reads.
+        history = self.channel_files[channelName]
+        before = min(before, history.line_count)
+        start = max(0, before - Server.SERVER_CONFIG["HISTORY_PAGE"])
+        page = history.read_range(start, before)
+
+        user.socket.sendall((Util.make_tag('history', channelName, start, len(page)) + page).encode('utf8'))
+
     def info(self, user):
         user.socket.sendall(
             '<||> This is a Chat Server that follows the IRC Protocol Written By Luis Perrone for CNT4713. <||>\n'
@@ -278,53 +903,110 @@ class Server:
             user.socket.sendall('\n<||>  Must provide at least one nickname. <||>\n'.encode('utf8'))
         else:
             onlineUsers = ""
-            nicknames = chatMessage.split()
+            nicknames = chatMessage.split()[1:]
             for name in nicknames:
-                for targetUser in self.users:
-                    if targetUser.username == name:
-                        if targetUser.status == "Online":
-                            onlineUsers = onlineUsers + " " + targetUser.username
-                            break
+                if self.presence_of(self.usernames.owner(name)) == "online":
+                    onlineUsers = onlineUsers + " " + name
             if onlineUsers != "":
                 user.socket.sendall(('\n<||>  Online Users: ' + onlineUsers + ' <||>\n').encode('utf8'))
             else:
                 user.socket.sendall('\n<||>  None of the specified users are currently online. <||>\n'.encode('utf8'))
 
     def join(self, user, chatMessage):
-        channel_text_history = ''
-        isInSameRoom = False
-
+        # /join <channel> [<last seen id>] -- with an id, only the messages after it are sent.
         if len(chatMessage.split()) >= 2:
             channelName = chatMessage.split()[1]
+            since = int(chatMessage.split()[2]) if len(chatMessage.split()) > 2 and chatMessage.split()[2].isdigit() \
+                else None
+
+            if '/' in channelName or '\\' in channelName or channelName.startswith('.') \
+                    or self.is_server_file(channelName):
+                user.socket.sendall("\n<||>  Invalid channel name: {0} <||>\n".format(channelName).encode('utf8'))
+            elif channelName in user.channels: # already a member, so this only moves the focus; nothing is replayed.
+                user.focus = channelName
+                user.socket.sendall((Util.make_tag('focus', channelName)
+                                     + "\n<||>  Now talking in channel: {0} <||>\n".format(channelName)).encode('utf8'))
+            else:
+                channel = self.shards.run(channelName, self.join_channel, user, channelName, since)
 
-            if user.username in self.users_channels_map: # Here we are switching to a new channel.
-                if self.users_channels_map[user.username] == channelName:
-                    user.socket.sendall("\n<||>  You are already in channel: {0}".format(channelName).encode('utf8'))
-                    isInSameRoom = True
-                else: # switch to a new channel
-                    oldChannelName = self.users_channels_map[user.username]
-                    self.channels[oldChannelName].remove_user_from_channel(user) # remove them from the previous channel
+                with self.users_lock:
+                    user.add_channel(channelName, channel)
+                    user.focus = channelName
+                    self.users_channels_map[user.username] = user.channels
+        else:
+            self.help(user)
 
-            if not isInSameRoom:
-                if not channelName in self.channels:
-                    newChannel = Channel.Channel(channelName)
-                    self.channels[channelName] = newChannel
+    def is_server_file(self, channelName):
+        # A channel's log is <channel>.txt in the working directory, which must never be one of the server's own
+        # files, whatever the configuration names them: the log would be appended to and replayed to anyone joining.
+        logPath = os.path.abspath(History.ChannelHistory(channelName).path)
+        return any(os.path.abspath(Server.SERVER_CONFIG[setting]) == logPath
+                   for setting in ("FILTER_FILE", "SNAPSHOT_FILE", "MAILBOX_FILE", "CAPTURE_FILE"))
 
-                self.channel_files[channelName] = open(channelName + ".txt", "a+")
+    def join_channel(self, user, channelName, since=None):
+        # Runs on the shard that owns channelName.
+        channel = self.load_channel(channelName)
+        history = self.channel_files[channelName]
 
-                self.channel_files[channelName].close()
+        # A fresh join only gets the most recent messages; older ones are fetched back with /history.
+        count = history.line_count
+        start = max(0, count - Server.SERVER_CONFIG["HISTORY_ON_JOIN"]) if since is None else min(max(0, since), count)
 
-                self.channel_files[channelName] = open(channelName + ".txt", "r+")
+        channel_text_history = Util.make_tag('from', channelName, start) + '\n' + history.read_range(start, count)
+        channel_text_history += Util.make_tag('seq', channelName, count)
 
-                channel_text_history = ('\n' + self.channel_files[channelName].read())
+        channel.add_user(user)
+        channel.welcome_user(user, channel_text_history)
+        return channel
 
-                self.channel_files[channelName].close()
+    def part(self, user, chatMessage):
+        # /part [channel] -- leaves a channel, by default the one the user is talking in.
+        channelName = chatMessage.split()[1] if len(chatMessage.split()) > 1 else user.focus
 
-                self.channels[channelName].users.append(user)
-                self.channels[channelName].welcome_user(user.username, channel_text_history)
-                self.users_channels_map[user.username] = channelName
-        else:
-            self.help(user.socket)
+        if channelName not in user.channels:
+            user.socket.sendall("\n<||>  You are not in channel: {0} <||>\n".format(channelName).encode('utf8'))
+            return
+
+        self.leave_channel(user, channelName)
+        self.shards.run(channelName, self.channels[channelName].remove_user_from_channel, user)
+        user.socket.sendall((self.channels[channelName].tag
+                             + "\n> You have left the channel {0}\n".format(channelName)).encode('utf8'))
+
+    def leave_channel(self, user, channelName):
+        # Drops channelName from the user's own index; the channel's member list is updated on its shard.
+        with self.users_lock:
+            user.channels.pop(channelName, None)
+
+            if user.focus == channelName:
+                user.focus = next(reversed(user.channels), None) # the most recently joined channel left.
+            if not user.channels:
+                self.users_channels_map.pop(user.username, None)
+
+    def load_channel(self, channelName):
+        # Runs on the shard that owns channelName. A channel from the snapshot is only decoded when first used.
+        if channelName in self.channels:
+            return self.channels[channelName]
+
+        channel = Channel.Channel(channelName)
+        history = History.ChannelHistory(channelName)
+
+        if self.snapshot is not None and channelName in self.snapshot.channels:
+            record = self.snapshot.channel(channelName)
+            channel.topic = record["topic"]
+            history.load_index(record["log_size"], record["offsets"])
+
+        self.channel_files[channelName] = history
+        self.channels[channelName] = channel
+        return channel
+
+    def find_channel(self, channelName):
+        if channelName in self.channels:
+            return self.channels[channelName]
+
+        if self.snapshot is not None and channelName in self.snapshot.channels:
+            return self.shards.run(channelName, self.load_channel, channelName)
+
+        return None
 
     def kick(self, user, chatMessage):
         if user.usertype != "user":
@@ -333,7 +1015,8 @@ class Server:
                 targetName = chatMessage.split()[2]
                 for targetUser in self.users:
                     if targetUser.username == targetName:
-                        self.channels[channelName].remove_user_from_channel(targetUser)
+                        self.leave_channel(targetUser, channelName)
+                        self.shards.run(channelName, self.channels[channelName].remove_user_from_channel, targetUser)
                         targetUser.socket.send((
                                 "<|*|>  You have been removed from channel " + channelName + " by " + user.username
                                 + ". <|*|>\n").encode(
@@ -378,74 +1061,193 @@ class Server:
 
             if len(chatMessage.split()) == 2:
                 if targetChannel in self.channels:
-                    self.channels[targetChannel].broadcast_message(': Requesting Invite\n', user.username)
+                    self.shards.run(targetChannel, self.channels[targetChannel].broadcast_message,
+                                    ': Requesting Invite\n', user.username)
                 else:
                     user.socket.sendall('\n> Channel does not exist.\n'.encode('utf8'))
 
             elif len(chatMessage.split()) > 2:
                 if targetChannel in self.channels:
-                    self.channels[targetChannel].broadcast_message((':' + requestMessage + '\n'), user.username)
+                    self.shards.run(targetChannel, self.channels[targetChannel].broadcast_message,
+                                    (':' + requestMessage + '\n'), user.username)
 
             else:
                 user.socket.sendall('\n> Channel does not exist.\n'.encode('utf8'))
 
     def list_all_channels(self, user):
+        if self.snapshot is not None:
+            for channelName in list(self.snapshot.channels):
+                self.find_channel(channelName)
+
         if len(self.channels) == 0:
             chatMessage = "\n<||> No rooms available. Create your own by typing /join [channel_name] <||>\n"\
                 .encode('utf8')
             user.socket.sendall(chatMessage)
         else:
             chatMessage = '\n\n<||> Current channels available are: <||>\n'
-            for channel in self.channels:
-                chatMessage += "    \n" + channel + ": " + str(len(self.channels[channel].users)) + " user(s)"
+            for channelName, channel in list(self.channels.items()): # shards add channels while this runs.
+                chatMessage += "    \n" + channelName + ": " + str(len(channel.users)) + " user(s)"
             chatMessage += "\n"
             user.socket.sendall(chatMessage.encode('utf8'))
 
     def nick(self, user, chatMessage):
+        if len(chatMessage.split()) < 2:
+            user.socket.sendall('<||> Must provide a nickname. <||> \n'.encode('utf8'))
+            return
+
         nickname = chatMessage.split()[1]
-        usernametaken = False
-        for user2 in self.users:
-            if user2.nickname == nickname:
-                user.socket.sendall('<||> Nickname is taken! Try again. <||> \n'.encode('utf8'))
-                usernametaken = True
-                break
+        channelNames = []
+
+        # The rename is atomic with respect to every other registration; the channels it touches are then
+        # refreshed on their own shards.
+        with self.users_lock:
+            usernametaken = not self.usernames.claim(nickname, user)
+
+            if usernametaken != True:
+                oldusername = user.username
+                user.nickname = nickname
+                user.username = nickname
+                self.usernames.release(oldusername)
+
+                if oldusername in self.users_channels_map:
+                    self.users_channels_map[user.username] = self.users_channels_map.pop(oldusername)
+                channelNames = list(user.channels)
+
+        if usernametaken:
+            user.socket.sendall('<||> Nickname is taken! Try again. <||> \n'.encode('utf8'))
+            return
+
+        msg = '<||> You have changed your nickname to ' + user.username + " from " + oldusername + ". <||> \n"
+        user.socket.sendall((msg.encode('utf8')))
+        self.publish_presence(oldusername, "offline")
+        self.publish_presence(user.username, self.presence_of(user))
+
+        self.shards.run_all(channelNames, lambda channelName: self.channels[channelName].update())
+
+    def monitor(self, user, chatMessage):
+        # /monitor + name[,name...] | - name[,name...] | c | l | s
+        parts = chatMessage.split(None, 2)
+        action = parts[1] if len(parts) > 1 else ''
+        names = parts[2].replace(',', ' ').split() if len(parts) > 2 else []
+
+        if action == '+' and names:
+            watched = self.presence.watch(user, names)
+            if len(watched) < len(names):
+                user.socket.sendall('\n<||> Monitor list is full ({0} names), some were not added. <||>\n'
+                                    .format(self.presence.limit).encode('utf8'))
+            self.send_presence(user, watched)
+        elif action == '-' and names:
+            self.presence.unwatch(user, names)
+            user.socket.sendall('\n<||> No longer monitoring: {0} <||>\n'.format(', '.join(names)).encode('utf8'))
+        elif action == 'c':
+            self.presence.clear(user)
+            user.socket.sendall('\n<||> Monitor list cleared. <||>\n'.encode('utf8'))
+        elif action == 'l':
+            user.socket.sendall('\n<||> Monitoring: {0} <||>\n'
+                                .format(', '.join(self.presence.watched(user)) or 'nobody').encode('utf8'))
+        elif action == 's':
+            self.send_presence(user, self.presence.watched(user))
+        else:
+            user.socket.sendall('\n<||> Usage: /monitor + [names], /monitor - [names], or /monitor c|l|s <||>\n'
+                                .encode('utf8'))
 
-        if  usernametaken != True:
-            self.users.remove(user)
-            channel = self.channels[self.users_channels_map[user.username]]
-            del self.users_channels_map[user.username]
-            channel.users.remove(user)
-            oldusername = user.username
-            user.nickname = nickname
-            user.username = nickname
-            self.users_channels_map[user.username] = channel
-            if oldusername in self.users_channels_map:
-                oldchannel = self.users_channels_map[oldusername]
-                del self.users_channels_map[oldusername]
-                self.users_channels_map[user.username] = oldchannel
-            msg = '<||> You have changed your nickname to ' + user.username + " from " + oldusername + ". <||> \n"
-            user.socket.sendall((msg.encode('utf8')))
-
-            if user.username in self.users_channels_map:
-                self.users.append(user)
-                channel.users.append(user)
-                channel.update()
+    def presence_of(self, user):
+        if user is None:
+            return "offline"
+        return "away" if user.status == "Away" else "online"
+
+    def send_presence(self, user, names):
+        states = [(name, self.presence_of(self.usernames.owner(name))) for name in names]
+        tags = ''.join(Util.make_tag('presence', name, state) for name, state in states)
+        summary = ', '.join('{0} is {1}'.format(name, state) for name, state in states) or 'nobody'
+        user.socket.sendall((tags + '\n<||> Presence: {0} <||>\n'.format(summary)).encode('utf8'))
+
+    def publish_presence(self, username, state):
+        # Pushed from the shard the name hashes to, so the caller (maybe the timer wheel) never waits on a slow
+        # subscriber, and one user's changes always arrive in the order they happened. Costs nothing when nobody
+        # watches the name.
+        if username and self.presence.has_subscribers(username):
+            self.shards.submit(username, self.push_presence, username, state)
+
+    def push_presence(self, username, state):
+        message = (Util.make_tag('presence', username, state)
+                   + '<||> {0} is now {1}. <||>\n'.format(username, state)).encode('utf8')
+        for subscriber in self.presence.subscribers(username):
+            try:
+                subscriber.socket.sendall(message)
+            except OSError: # the subscriber is leaving; its own thread will clear its list.
+                pass
 
     def notice(self, user, chatMessage):
-        if len(chatMessage.split()) < 3:
+        if len(chatMessage.rstrip().split(None, 2)) < 3:
             user.socket.sendall('\n <||> Must provide a target name and a message to send a notice. <||> \n'
                                 .encode('utf8'))
         else:
-            targetName = chatMessage.split()[1]
-            privMessage = chatMessage.split()[2]
-            for targetuser in self.users:
-                if targetuser.username == targetName:
-                    targetSocket = targetuser.socket
-                    user.socket.send(("<||> Notice to " + targetName + ": " + privMessage + " <||>\n")
-                                     .encode('utf8'))
-                    targetSocket.send(("<||> Notice from " + user.username + ": " + privMessage + " <||>\n")
-                                      .encode('utf8'))
-                    break
+            self.send_to_targets(user, chatMessage, "Notice")
+
+    def send_to_targets(self, user, chatMessage, kind):
+        # <command> <target>[,<target>...] <text> -- a target is a user, online or with a session still held for them,
+        # or a channel the sender is in. Every target is resolved in one pass, the message is encoded once and handed
+        # to the outbox of each user it goes to, which never blocks, so one recipient that is not reading cannot hold
+        # up the others; the sender gets a single reply covering them all.
+        command, targetList, text = chatMessage.rstrip().split(None, 2)
+        targetNames = list(collections.OrderedDict.fromkeys(name for name in targetList.split(',') if name))
+        limit = Server.SERVER_CONFIG["MAX_MESSAGE_TARGETS"]
+        message = "<||> {0} from {1}: {2} <||>\n".format(kind, user.username, text)
+        recipients, channelNames, stored, full, outsider, unknown = [], [], [], [], [], []
+
+        with self.users_lock: # so no recipient can resume between the lookup and the mailbox write.
+            for name in targetNames[:limit]:
+                targetuser = self.usernames.owner(name)
+                if targetuser is not None:
+                    recipients.append((name, targetuser))
+                elif name in user.channels:
+                    channelNames.append(name)
+                elif name.startswith('#') or name in self.channels:
+                    outsider.append(name)
+                elif name not in self.held_names: # mail is only kept for someone who can resume and collect it.
+                    unknown.append(name)
+                elif self.mailboxes.put(self.held_names[name], message):
+                    stored.append(name)
+                else:
+                    full.append(name)
+
+        data = message.encode('utf8')
+        delivered, gone = [], []
+        for name, targetuser in recipients:
+            try:
+                targetuser.socket.sendall(data)
+                delivered.append(name)
+            except OSError: # left after the lookup or cut off for not reading; their own thread cleans up.
+                gone.append(name)
+
+        for channelName in channelNames:
+            self.shards.run(channelName, self.send_channel_message, user, channelName, text + '\n')
+            delivered.append(channelName)
+
+        reply = ""
+        if delivered:
+            reply += "<||> {0} to {1}: {2} <||>\n".format(kind, ', '.join(delivered), text)
+        if kind == "PrivMsg":
+            for name, targetuser in recipients:
+                if targetuser.status == "Away":
+                    reply += "<||> Current Status Away: " + targetuser.awaymessage + " (" + name + ")\n"
+        if stored:
+            reply += "<||> {0} {1} offline; the message will be delivered when they return. <||>\n"\
+                .format(', '.join(stored), "is" if len(stored) == 1 else "are")
+        if full:
+            reply += "<||> Mailbox full, the message was not kept for: {0} <||>\n".format(', '.join(full))
+        if gone:
+            reply += "<||> Left before the message was delivered: {0} <||>\n".format(', '.join(gone))
+        if outsider:
+            reply += "<||> Must be a member of the channel to send to it: {0} <||>\n".format(', '.join(outsider))
+        if unknown:
+            reply += "<||> No such user: {0} <||>\n".format(', '.join(unknown))
+        if len(targetNames) > limit:
+            reply += "<||> Too many targets (at most {0}); not sent to: {1} <||>\n"\
+                .format(limit, ', '.join(targetNames[limit:]))
+
+        user.socket.sendall(reply.encode('utf8'))
 
     def oper(self, user, chatMessage):
         if len(chatMessage.split()) < 3:
@@ -470,31 +1272,48 @@ class Server:
         user.socket.sendall('\n<||> Ping\n'.encode('utf8'))
 
     def privateMessage(self, user, chatMessage):
-        if len(chatMessage.split()) < 3:
+        if len(chatMessage.rstrip().split(None, 2)) < 3:
             user.socket.sendall('\n <||> Must provide a target name and a message to send. <||> \n'.encode('utf8'))
         else:
-            targetName = chatMessage.split()[1]
-            privMessage = chatMessage.split()[2]
-            for targetuser in self.users:
-                if targetuser.username == targetName:
-                    targetSocket = targetuser.socket
-                    user.socket.send(("<||> PrivMsg to " + targetName + ": " + privMessage + " <||>\n")
-                                     .encode('utf8'))
-                    targetSocket.send(("<||> PrivMsg from " + user.username + ": " + privMessage + " <||>\n")
-                                      .encode('utf8'))
-                    if targetuser.status == "Away":
-                        user.socket.send(("<||> Current Status Away: " + targetuser.awaymessage + "\n").encode('utf8'))
-                    break
+            self.send_to_targets(user, chatMessage, "PrivMsg")
 
     def quit(self, user):
-        user.socket.sendall('/quit'.encode('utf8'))
+        with self.users_lock:
+            self.sessions.pop(user.resume_token, None) # a deliberate /quit ends the session.
+
+        try:
+            user.socket.sendall('/quit'.encode('utf8'))
+        except OSError:
+            pass
+
         self.remove_user(user)
 
-    def restart(self):
-        self.broadcast_message("\n <||> Restarting Server! <||> \n")
-        self.broadcast_message("/squit")
-        main()
-        self.server_shutdown()
+    def restart(self, user):
+        if not HotRestart.is_supported():
+            user.socket.sendall("\n<||> Hot restart is not supported on this platform. <||>\n".encode('utf8'))
+            return
+
+        if self.tls_context is not None: # a TLS connection's state lives in this process and cannot be handed over.
+            user.socket.sendall("\n<||> Hot restart is not supported with TLS. <||>\n".encode('utf8'))
+            return
+
+        # The new process takes over the listening socket and every connection; clients only see a short pause.
+        try:
+            process, pause = HotRestart.handoff(self, os.path.abspath(__file__))
+        except Exception as errorMessage:
+            sys.stderr.write("Hot restart failed, still serving. Error - {0}\n".format(errorMessage))
+            user.socket.sendall("\n<||> Restart failed, the server is still running. <||>\n".encode('utf8'))
+            return
+
+        print("Handed {0} connection(s) to process {1} in {2:.1f} ms\n".format(len(self.users), process.pid,
+                                                                              pause * 1000))
+        # os._exit skips everything server_shutdown would do, so what only lives in this process goes to disk first:
+        # whatever the capture still has buffered. The snapshot is the new process's to write now; this one's view of
+        # the users stopped at the handoff.
+        self.snapshot_writer.stop()
+        self.snapshot_writer.join()
+        self.stop_capture()
+        os._exit(0)
 
     def rules(self, user):
         user.socket.sendall("<||> The Rules in this server are simple. Chat away! <||>\n".encode('utf8'))
@@ -510,6 +1329,45 @@ class Server:
             message = "<||> Successfully changed name to " + user.fullname + " from " + old_name + ". <||>\n"
             user.socket.sendall(message.encode('utf8'))
 
+    def stats(self, user):
+        if user.usertype == "user":
+            user.socket.sendall('\n<||>  Must be a Channel Operator or Admin to see the server stats. <||>\n'
+                                .encode('utf8'))
+            return
+
+        queue = Admission.accept_queue(self.serverSocket)
+        overflows = Admission.listen_overflows()
+        startOverflows = self.accept_stats["kernel_overflows"]
+
+        with self.admission.lock:
+            counters = dict(self.admission.counters)
+            connected = self.admission.total
+
+        information = "\n<||> Server stats: <||>\n\n"
+        information += "<connections>: {0} open, {1} accepted, {2} refused (clients {3}, per address {4}, " \
+                       "rate {5}, per address rate {6})\n".format(connected, counters["accepted"],
+                                                                 sum(counters.values()) - counters["accepted"],
+                                                                 counters["refused_clients"],
+                                                                 counters["refused_address_clients"],
+                                                                 counters["refused_rate"],
+                                                                 counters["refused_address_rate"])
+        information += "<accept>: {0} wakeups, largest burst {1}, deepest queue {2}, queue now {3}\n".format(
+            self.accept_stats["wakeups"], self.accept_stats["largest_burst"], self.accept_stats["deepest_queue"],
+            "{0} of {1}".format(*queue) if queue is not None else "unknown")
+        if overflows is not None and startOverflows is not None:
+            information += "<listen overflows>: {0}, <listen drops>: {1} (whole host, since start)\n".format(
+                overflows[0] - startOverflows[0], overflows[1] - startOverflows[1])
+        for name, waiting, oldest, shed in self.scheduler.stats():
+            information += "<{0} commands>: {1} waiting, oldest {2:.0f} ms, {3} shed\n".format(name, waiting,
+                                                                                            oldest * 1000, shed)
+        if self.tls_context is not None:
+            sessions = self.tls_context.session_stats()
+            information += "<tls>: {0} handshakes completed, {1} resumed from the session cache or a ticket, " \
+                           "{2} sessions cached\n".format(sessions["accept_good"], sessions["hits"],
+                                                          sessions["number"])
+
+        user.socket.sendall(information.encode('utf8'))
+
     def time(self, user):
         time = strftime("\n<||> %a, %d %b %Y %H:%M:%S +0000 <||>\n", gmtime())
         user.socket.sendall(time.encode('utf8'))
@@ -518,20 +1376,27 @@ class Server:
         if len(chatMessage.split()) < 2:
             user.socket.sendall("<||> Must provide a channel name to view channel topic. <||>\n".encode('utf8'))
         else:
-            if len(chatMessage.split()) > 2:
-                channelName = chatMessage.split()[1]
+            channelName = chatMessage.split()[1]
+            channel = self.find_channel(channelName)
+
+            if channel is None:
+                user.socket.sendall("<||> Channel does not exist. <||>\n".encode('utf8'))
+            elif len(chatMessage.split()) > 2:
                 topicName = chatMessage.split(" ", 2)[2]
-                self.channels[channelName].topic = topicName
-                self.channels[channelName].broadcast_server_message(("<||> Channel Topic has been changed to "
-                                                                     + topicName + ". <||>\n"))
+                self.shards.run(channelName, self.set_topic, channelName, topicName)
             else:
-                channelName = chatMessage.split()[1]
-                if self.channels[channelName].topic == "":
+                if channel.topic == "":
                     user.socket.sendall("<||> No channel topic has been set yet. <||>\n".encode('utf8'))
                 else:
-                    message = "<||> Channel " + channelName + " topic: " + self.channels[channelName].topic + " <||>\n"
+                    message = "<||> Channel " + channelName + " topic: " + channel.topic + " <||>\n"
                     user.socket.sendall(message.encode('utf8'))
 
+    def set_topic(self, channelName, topicName):
+        # Runs on the shard that owns channelName.
+        self.channels[channelName].topic = topicName
+        self.channels[channelName].broadcast_server_message(("<||> Channel Topic has been changed to "
+                                                             + topicName + ". <||>\n"))
+
     def userhost(self, user, chatMessage):
         if len(chatMessage.split()) < 2:
             user.socket.sendall("<||> Must provide a nickname or list of nicknames. <||>\n".encode('utf8'))
@@ -556,16 +1421,20 @@ class Server:
             user.socket.sendall("<||> Must provide a nickname. <||>\n".encode('utf8'))
         else:
             nickname = chatMessage.split()[1]
-            userfound = False
-            for targetUser in self.users:
-                if targetUser.username == nickname:
-                    message = "<||> " + targetUser.username + " IP Address: " + socket.gethostbyname(socket.gethostname()) \
-                              + ". <||>\n"
-                    user.socket.sendall(message.encode('utf8'))
-                    userfound = True
-                    break
-            if userfound != True:
+            targetUser = self.usernames.owner(nickname)
+
+            if targetUser is None or targetUser.address is None:
                 user.socket.sendall("<||> User not in the network. <||>\n".encode('utf8'))
+                return
+
+            # The host name is only ever read from the resolver's cache; a miss is answered once the lookup is done.
+            address = targetUser.address[0]
+            hostname = self.resolver.lookup(address, lambda hostname: user.socket.sendall(
+                "<||> {0} Host: {1}. <||>\n".format(nickname, hostname or "unknown").encode('utf8')))[1]
+
+            message = "<||> {0} IP Address: {1}{2}. <||>\n".format(targetUser.username, address,
+                                                                   " ({0})".format(hostname) if hostname else "")
+            user.socket.sendall(message.encode('utf8'))
 
     def users_list(self, user):
         information = "\n<||> List of users: <||>\n\n"
@@ -622,16 +1491,10 @@ class Server:
                 user.socket.sendall(information.encode('utf8'))
 
     def send_message(self, user, chatMessage):
-        if user.username in self.users_channels_map:
-            self.channels[self.users_channels_map[user.username]].broadcast_message(chatMessage, "{0}: "
-                                                                                    .format(user.username))
+        channelName = user.focus
 
-            self.channel_files[self.users_channels_map[user.username]] = open(
-                self.users_channels_map[user.username] + ".txt", "a+")
-
-            self.channel_files[self.users_channels_map[user.username]].write(user.username + ': ' + chatMessage)
-
-            self.channel_files[self.users_channels_map[user.username]].close()
+        if channelName in user.channels:
+            self.shards.run(channelName, self.send_channel_message, user, channelName, chatMessage)
         else:
             chatMessage = """\n> You are currently not in any channels:
 
@@ -640,16 +1503,69 @@ Use /join [channel name] to join a channel.\n\n""".encode('utf8')
 
             user.socket.sendall(chatMessage)
 
-    def remove_user(self, user):
-        if user.username in self.users_channels_map:
-            self.channels[self.users_channels_map[user.username]].remove_user_from_channel(user)
-            del self.users_channels_map[user.username]
-
-        self.users.remove(user)
+    def send_channel_message(self, user, channelName, chatMessage):
+        # Runs on the shard that owns channelName, so the broadcast order matches the order written to the log.
+        action, chatMessage = self.content_filter.check(channelName, chatMessage)
+
+        if action == "drop":
+            user.socket.sendall("\n<||> Your message to {0} was blocked by the content filter. <||>\n"
+                                .format(channelName).encode('utf8'))
+            return
+        if action == "flag":
+            self.broadcast_message_to_operators("\n<||> Filter flagged {0} in {1}: {2} <||>\n"
+                                                .format(user.username, channelName, chatMessage.strip()))
+
+        history = self.channel_files[channelName]
+        history.append(user.username + ': ' + chatMessage)
+
+        self.channels[channelName].broadcast_message(chatMessage, "{0}: ".format(user.username), history.line_count)
+
+    def remove_user(self, user, keepUsername=False):
+        self.timers.cancel(user.idle_timer)
+
+        with self.users_lock:
+            channelNames = user.channel_names()
+            user.channels.clear()
+            user.focus = None
+            # After a /resume the name, and its entry here, belong to the new connection by the time the old one's
+            # thread gets to this; only the entry that is this user's own goes.
+            if self.users_channels_map.get(user.username) is user.channels:
+                del self.users_channels_map[user.username]
+
+            departed = user in self.users
+            if departed:
+                self.users.remove(user)
+                if user.username and not keepUsername and user.resume_token not in self.sessions:
+                    self.usernames.release(user.username)
+                elif user.username:
+                    self.usernames.assign(user.username, None)
+
+            # Keep the session around for a while so a client that lost its connection can resume it.
+            if user.resume_token in self.sessions:
+                session = self.sessions[user.resume_token]
+                session["channels"] = channelNames
+                session["monitoring"] = self.presence.watched(user)
+                self.held_names[user.username] = user.resume_token
+                session["expiry"] = self.timers.schedule(Server.SERVER_CONFIG["RESUME_TTL"], self.expire_session,
+                                                         user.resume_token)
+
+        self.shards.run_all(channelNames, lambda channelName: self.channels[channelName].remove_user_from_channel(user))
+        self.presence.clear(user)
+        if departed and not keepUsername:
+            self.publish_presence(user.username, "offline")
         print("Client: {0} has left\n".format(user.username))
 
     def server_shutdown(self):
         print("<||> Shutting down chat server. <||>\n")
+        self.snapshot_writer.stop()
+        self.snapshot_writer.save()
+        self.timers.stop()
+        self.shards.stop()
+        self.resolver.stop()
+        self.scheduler.stop()
+        self.mailboxes.close()
+        self.stop_capture()
+        self.writer.stop()
         self.serverSocket.close()
 
     def broadcast_message(self, message):
@@ -662,7 +1578,14 @@ Use /join [channel name] to join a channel.\n\n""".encode('utf8')
                 user.socket.sendall(message.encode('utf8'))
 
 def main():
-    chatServer = Server()
+    if len(sys.argv) > 2 and sys.argv[1] == '--resume':
+        chatServer = HotRestart.resume(int(sys.argv[2]), lambda serverSocket: Server(serverSocket=serverSocket))
+    else:
+        chatServer = Server()
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--capture': # --capture [trace file]
+        chatServer.start_capture(sys.argv[2] if len(sys.argv) > 2 else Server.SERVER_CONFIG["CAPTURE_FILE"],
+                                 Server.SERVER_CONFIG["CAPTURE_SCRUB"])
 
     print("\nListening on port {0}".format(chatServer.address[1]))
     print("Waiting for connections...\n")
@@ -0,0 +1,133 @@
+import collections
+import os
+import threading
+
+ACTIONS = ("drop", "mask", "flag", "off")
+
+
+class Automaton:
+    """
+    An Aho-Corasick matcher over a fixed set of patterns. find() walks the text once, whatever the number of
+    patterns, and reports every stretch of it covered by a pattern.
+    """
+    def __init__(self, patterns):
+        self.patterns = sorted(set(pattern.lower() for pattern in patterns if pattern))
+        self.goto = [{}] # State -> {character: next state}
+        self.fail = [0]
+        self.longest = [0] # State -> length of the longest pattern that ends on reaching it, or 0.
+
+        for pattern in self.patterns:
+            state = 0
+            for character in pattern:
+                following = self.goto[state].get(character)
+                if following is None:
+                    following = self.goto[state][character] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.longest.append(0)
+                state = following
+            self.longest[state] = len(pattern)
+
+        # Breadth first, so every state's failure link is finished before its children need it.
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(character, 0)
+                self.longest[following] = max(self.longest[following], self.longest[self.fail[following]])
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def find(self, text):
+        # [(start, end)] of the longest pattern ending at each position that ends a match, in order.
+        goto = self.goto
+        fail = self.fail
+        longest = self.longest
+        spans = []
+        state = 0
+
+        for position, character in enumerate(text):
+            following = goto[state].get(character)
+            while following is None and state:
+                state = fail[state]
+                following = goto[state].get(character)
+            state = following or 0
+
+            if longest[state]:
+                spans.append((position + 1 - longest[state], position + 1))
+
+        return spans
+
+    def mask(self, text, spans, replacement='*'):
+        characters = list(text)
+        for start, end in spans:
+            characters[start:end] = replacement * (end - start)
+        return ''.join(characters)
+
+
+class ContentFilter:
+    """
+    The banned terms from a pattern file (one per line, # for comments) and what each channel does with a message
+    that contains one. A changed file is compiled on a thread of its own and swapped in with a single assignment, so
+    messages keep flowing through the old automaton until the new one is ready.
+    """
+    def __init__(self, path, defaultAction="mask"):
+        self.path = path
+        self.default_action = defaultAction
+        self.actions = {} # Channel Name -> action, for channels that do not use the default.
+        self.automaton = Automaton(())
+        self.loaded_mtime = None
+        self.reloading = threading.Lock()
+
+    def action(self, channelName):
+        return self.actions.get(channelName, self.default_action)
+
+    def set_action(self, channelName, action):
+        if action == self.default_action:
+            self.actions.pop(channelName, None)
+        else:
+            self.actions[channelName] = action
+
+    def check(self, channelName, message):
+        # Returns (action, message to deliver); the action is None when nothing matched or the channel is unfiltered.
+        action = self.action(channelName)
+        automaton = self.automaton
+        if action == "off" or not len(automaton):
+            return None, message
+
+        spans = automaton.find(message)
+        if not spans:
+            return None, message
+
+        return action, automaton.mask(message, spans) if action == "mask" else message
+
+    def reload_if_changed(self):
+        # Called periodically from the timer wheel, which must not block, so compiling happens elsewhere.
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+
+        if mtime != self.loaded_mtime:
+            self.reload_async()
+
+    def reload_async(self):
+        threading.Thread(target=self.reload, name="filter-reload", daemon=True).start()
+
+    def reload(self):
+        with self.reloading:
+            try:
+                mtime = os.path.getmtime(self.path)
+                with open(self.path, encoding='utf8') as patternFile:
+                    patterns = [line.strip() for line in patternFile if line.strip() and not line.startswith('#')]
+            except OSError:
+                mtime, patterns = None, []
+
+            self.automaton = Automaton(patterns)
+            self.loaded_mtime = mtime
+            return len(self.automaton)
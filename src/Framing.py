@@ -0,0 +1,39 @@
+import struct
+import threading
+
+# A client that sends "/caps framed" gets every reply as a 4 byte big-endian length followed by that many bytes,
+# and has its own input split on newlines, so it can pipeline commands and still tell where each reply ends.
+CAPABILITY = "framed"
+HEADER = struct.Struct('!I')
+
+
+def frame(data):
+    return HEADER.pack(len(data)) + data
+
+
+class FramedSocket:
+    """
+    Wraps a client socket so that everything sent through it is framed. Sends from different threads are
+    serialized, since two interleaved frames would corrupt the stream.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.lock = threading.Lock()
+
+    def sendall(self, data):
+        with self.lock:
+            self.socket.sendall(frame(data))
+
+    def send(self, data, flags=0):
+        # With MSG_DONTWAIT, as from the timer wheel, this only ever tries: if another thread is mid-frame, or the
+        # outbox underneath cannot take the frame now, 0 is returned. The outbox finishes any frame it starts.
+        if not self.lock.acquire(not flags):
+            return 0
+        try:
+            sent = self.socket.send(frame(data), flags)
+        finally:
+            self.lock.release()
+        return len(data) if sent else 0
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
@@ -0,0 +1,98 @@
+import array
+import os
+import LogIndexer
+
+
+class ChannelHistory:
+    """
+    The <channel>.txt log of a channel plus an index of where every line starts. The index is built by scanning the
+    log the first time it is needed, unless a snapshot already provided it; an index LogIndexer.py built offline
+    saves scanning all but what was appended to the log after it.
+    """
+    def __init__(self, channelName):
+        self.path = channelName + ".txt"
+        self.offsets = None # array('Q') of the byte offset at which each line starts.
+        self.size = 0
+        self.ends_with_newline = True
+
+    @property
+    def line_count(self):
+        self.ensure_index()
+        return len(self.offsets)
+
+    def load_index(self, size, offsets):
+        # Trust a snapshotted index only if the log has not changed since it was taken.
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            self.offsets = offsets
+            self.size = size
+            self.ends_with_newline = size == 0 or self.last_byte() == b'\n'
+
+    def last_byte(self):
+        with open(self.path, "rb") as logFile:
+            logFile.seek(-1, os.SEEK_END)
+            return logFile.read(1)
+
+    def ensure_index(self):
+        if self.offsets is not None:
+            return
+
+        self.offsets = array.array('Q')
+        self.size = 0
+        self.ends_with_newline = True
+
+        if os.path.exists(self.path):
+            indexed = LogIndexer.read_index(self.path) # built offline, so only what was appended since is scanned.
+            with open(self.path, "rb") as logFile:
+                if indexed is not None and indexed[0]:
+                    self.size, self.offsets = indexed
+                    logFile.seek(self.size - 1)
+                    self.ends_with_newline = logFile.read(1) == b'\n'
+                for chunk in iter(lambda: logFile.read(1 << 20), b''):
+                    self.index_bytes(chunk)
+
+    def index_bytes(self, data):
+        if self.ends_with_newline and data:
+            self.offsets.append(self.size)
+
+        position = data.find(b'\n')
+        while position != -1 and position + 1 < len(data):
+            self.offsets.append(self.size + position + 1)
+            position = data.find(b'\n', position + 1)
+
+        self.size += len(data)
+        if data:
+            self.ends_with_newline = data.endswith(b'\n')
+
+    def append(self, text):
+        self.ensure_index()
+        data = text.encode('utf8')
+
+        with open(self.path, "ab") as logFile:
+            logFile.write(data)
+
+        self.index_bytes(data)
+
+    def read_since(self, sequence):
+        # Line n of the log is the message with sequence id n; returns every line after the given id.
+        return self.read_range(sequence, self.line_count)
+
+    def read_range(self, start, end):
+        # Lines start up to (but not including) end, counted from 0.
+        self.ensure_index()
+        start = max(0, start)
+        end = min(end, len(self.offsets))
+
+        if start >= end:
+            return ''
+
+        endOffset = self.offsets[end] if end < len(self.offsets) else self.size
+        with open(self.path, "rb") as logFile:
+            logFile.seek(self.offsets[start])
+            return logFile.read(endOffset - self.offsets[start]).decode('utf8', 'replace')
+
+    def read_all(self):
+        if not os.path.exists(self.path):
+            return ''
+
+        with open(self.path, "rb") as logFile:
+            return logFile.read().decode('utf8', 'replace')
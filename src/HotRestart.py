@@ -0,0 +1,214 @@
+import array
+import json
+import socket
+import struct
+import subprocess
+import sys
+import time
+import Framing
+import User
+
+MAX_FDS_PER_MESSAGE = 250 # SCM_RIGHTS batches must stay under the kernel limit (253 on Linux).
+HANDOFF_TIMEOUT = 30
+DRAIN_TIMEOUT = 1 # Seconds to let replies still queued in outboxes go out; the new process sends what is left first.
+
+
+def is_supported():
+    return hasattr(socket, "AF_UNIX") and hasattr(socket.socket, "sendmsg")
+
+
+def send_fds(channel, fds):
+    for start in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        batch = fds[start:start + MAX_FDS_PER_MESSAGE]
+        channel.sendmsg([struct.pack('!I', len(batch))],
+                        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', batch))])
+
+
+def receive_exactly(channel, size):
+    data = b''
+    while len(data) < size:
+        chunk = channel.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff channel closed early.")
+        data += chunk
+    return data
+
+
+def receive_fds(channel, count):
+    fds = []
+    while len(fds) < count:
+        data, ancillary, flags, address = channel.recvmsg(4, socket.CMSG_SPACE(MAX_FDS_PER_MESSAGE * 4))
+        if not data:
+            raise ConnectionError("Handoff channel closed early.")
+        if len(data) < 4:
+            receive_exactly(channel, 4 - len(data))
+
+        for level, messageType, payload in ancillary:
+            if level == socket.SOL_SOCKET and messageType == socket.SCM_RIGHTS:
+                batch = array.array('i')
+                batch.frombytes(payload[:len(payload) - (len(payload) % batch.itemsize)])
+                fds.extend(batch)
+    return fds
+
+
+def capture_state(server):
+    # Called once every reader has parked and every outbox is held, so nothing is being read or written and every
+    # User/Channel is stable.
+    users = []
+    for user in server.users:
+        users.append({"fullname": user.fullname, "username": user.username, "nickname": user.nickname,
+                      "usertype": user.usertype, "status": user.status, "awaymessage": user.awaymessage,
+                      "buffer": user.buffer.decode('latin1'), "resume_token": user.resume_token,
+                      "framed": user.framed, "focus": user.focus, "monitoring": server.presence.watched(user),
+                      "pending": user.socket.hold().decode('latin1')})
+
+    positions = dict((id(user), index) for index, user in enumerate(server.users))
+    channels = []
+    for channelName, channel in server.channels.items():
+        channels.append({"name": channelName, "topic": channel.topic,
+                         "members": [positions[id(member)] for member in channel.users if id(member) in positions]})
+
+    # Sessions whose connection already dropped are still resumable on the new server.
+    sessions = []
+    for token, session in server.sessions.items():
+        user = session["user"]
+        if id(user) not in positions:
+            sessions.append({"token": token, "channels": session["channels"], "fullname": user.fullname,
+                             "username": user.username, "nickname": user.nickname, "usertype": user.usertype,
+                             "status": user.status, "awaymessage": user.awaymessage,
+                             "monitoring": session["monitoring"]})
+
+    return {"users": users, "channels": channels, "sessions": sessions,
+            "filter_actions": server.content_filter.actions, "mailboxes": server.mailboxes.capture()}
+
+
+def restore_state(server, state, clientSockets):
+    for fields, clientSocket in zip(state["users"], clientSockets):
+        clientSocket.setblocking(True)
+        user = User.User(server.outbound(clientSocket), fields["fullname"], fields["username"], fields["nickname"],
+                         usertype=fields["usertype"])
+        try:
+            user.socket.sendall(fields["pending"].encode('latin1')) # already framed, if the client is.
+        except OSError: # the client left during the handoff; its reader will notice.
+            pass
+        user.status = fields["status"]
+        user.awaymessage = fields["awaymessage"]
+        user.buffer = fields["buffer"].encode('latin1')
+        user.resume_token = fields["resume_token"]
+        user.focus = fields["focus"]
+        try:
+            user.address = clientSocket.getpeername()[:2]
+            server.admission.track(user.address[0])
+        except OSError: # the client left during the handoff; its reader will notice.
+            pass
+        if fields["framed"]:
+            user.framed = True
+            user.socket = Framing.FramedSocket(user.socket)
+        server.users.append(user)
+        if user.username: # a user still registering has no name to hold yet.
+            server.usernames.claim(user.username, user)
+        server.presence.watch(user, fields["monitoring"])
+        if user.resume_token is not None:
+            server.sessions[user.resume_token] = {"user": user, "channels": [], "monitoring": [], "expiry": None}
+
+    for fields in state["sessions"]:
+        user = User.User(None, fields["fullname"], fields["username"], fields["nickname"], usertype=fields["usertype"])
+        user.status = fields["status"]
+        user.awaymessage = fields["awaymessage"]
+        user.resume_token = fields["token"]
+        server.usernames.claim(user.username)
+        server.held_names[user.username] = fields["token"]
+        server.sessions[fields["token"]] = {"user": user, "channels": fields["channels"],
+                                            "monitoring": fields["monitoring"],
+                                            "expiry": server.timers.schedule(server.SERVER_CONFIG["RESUME_TTL"],
+                                                                             server.expire_session, fields["token"])}
+
+    server.content_filter.actions.update(state["filter_actions"])
+    server.mailboxes.restore(state["mailboxes"])
+
+    # The users in the state are the ones that count now; only the old records of sessions handed over stay on, so
+    # anyone who left during the handoff is not brought back by the next snapshot.
+    if server.snapshot is not None:
+        heldNames = set(fields["username"] for fields in state["sessions"])
+        for username in list(server.snapshot.users):
+            if username not in heldNames:
+                del server.snapshot.users[username]
+
+    for fields in state["channels"]:
+        channel = server.load_channel(fields["name"])
+        channel.topic = fields["topic"]
+        channel.users = dict.fromkeys(server.users[index] for index in fields["members"])
+        for member in channel.users:
+            member.add_channel(fields["name"], channel)
+            server.users_channels_map[member.username] = member.channels
+
+    for user in list(server.users):
+        server.start_client(user)
+
+
+def spawn(script):
+    # The new process is exec'd first and waits for the state, so interpreter start-up is not part of the pause.
+    parentChannel, childChannel = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    process = subprocess.Popen([sys.executable, script, '--resume', str(childChannel.fileno())],
+                               pass_fds=[childChannel.fileno()])
+    childChannel.close()
+    return parentChannel, process
+
+
+def handoff(server, script):
+    """
+    Hands the listening socket and every client connection over to a freshly exec'd server. Returns the new
+    process and the pause, in seconds, during which no client input was being read; raises if the new process did
+    not take over, in which case this server carries on serving.
+    """
+    channel, process = spawn(script)
+    holding = False
+
+    try:
+        startTime = time.time()
+        server.park_readers()
+        server.writer.wait_drained(DRAIN_TIMEOUT)
+        # Timers and shards may still send; from here on that is only queued, so this process never writes to a
+        # connection the new one already owns, and nothing it already queued is lost or sent out of order.
+        server.writer.hold()
+        holding = True
+
+        state = capture_state(server)
+        payload = json.dumps(state).encode('utf8')
+        channel.sendall(struct.pack('!Q', len(payload)) + payload)
+        send_fds(channel, [server.serverSocket.fileno()] + [user.socket.fileno() for user in server.users])
+
+        channel.settimeout(HANDOFF_TIMEOUT)
+        if receive_exactly(channel, 1) != b'R':
+            raise ConnectionError("New server did not acknowledge the handoff.")
+
+        return process, time.time() - startTime
+    except Exception:
+        process.kill()
+        if holding:
+            for user in server.users:
+                user.socket.unhold()
+            server.writer.unhold()
+        server.unpark_readers()
+        raise
+    finally:
+        channel.close()
+
+
+def resume(channelFd, serverFactory):
+    """
+    The receiving half of handoff: rebuilds the server around the inherited sockets and acknowledges once every
+    connection has a reader again.
+    """
+    channel = socket.socket(fileno=channelFd)
+    length = struct.unpack('!Q', receive_exactly(channel, 8))[0]
+    state = json.loads(receive_exactly(channel, length).decode('utf8'))
+
+    fds = receive_fds(channel, len(state["users"]) + 1)
+    server = serverFactory(socket.socket(fileno=fds[0]))
+    restore_state(server, state, [socket.socket(fileno=fd) for fd in fds[1:]])
+
+    channel.sendall(b'R')
+    channel.close()
+    server.snapshot_writer.save() # the last snapshot on disk predates the handoff.
+    return server
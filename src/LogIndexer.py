@@ -0,0 +1,239 @@
+import array
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# <channel>.idx: MAGIC, a header (size of the log when it was indexed, line count, crc32 of the last TAIL bytes
+# before that size), then the byte offset at which every line starts, as little-endian unsigned 64 bit integers.
+INDEX_MAGIC = b'CHATIDX1'
+INDEX_HEADER = struct.Struct('!QQI')
+TAIL = 4096
+
+# <channel>.seg: MAGIC, then segments of whole lines in log order, each a header (line count, compressed length)
+# followed by the lines compressed with zlib.
+SEGMENT_MAGIC = b'CHATSEG1'
+SEGMENT_HEADER = struct.Struct('!II')
+SEGMENT_SIZE = 1 << 20 # Bytes of log per segment, give or take a line; also what a worker holds in memory.
+
+CHUNK_SIZE = 64 << 20 # Logs bigger than this are split, at line boundaries, into tasks of about this size.
+
+
+def channel_logs(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(".txt"))
+
+
+def index_path(logPath):
+    return os.path.splitext(logPath)[0] + ".idx"
+
+
+def segment_path(logPath):
+    return os.path.splitext(logPath)[0] + ".seg"
+
+
+def tail_checksum(logFile, size):
+    logFile.seek(max(0, size - TAIL))
+    return zlib.crc32(logFile.read(min(size, TAIL)))
+
+
+def split_chunks(logPath, size, chunkSize=CHUNK_SIZE):
+    # [(start, end)] covering the first size bytes, every chunk but the last ending just after a newline.
+    if size <= chunkSize:
+        return [(0, size)]
+
+    bounds = [0]
+    with open(logPath, "rb") as logFile, mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while bounds[-1] + chunkSize < size:
+            newline = data.find(b'\n', bounds[-1] + chunkSize - 1, size)
+            if newline == -1 or newline + 1 >= size:
+                break
+            bounds.append(newline + 1)
+
+    return list(zip(bounds, bounds[1:] + [size]))
+
+
+def write_offsets(offsetFile, offsets):
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    offsets.tofile(offsetFile)
+
+
+def index_chunk(logPath, start, end, partPath):
+    """
+    Runs in a worker process: indexes and compacts bytes start to end of a log, which start at a line, writing the
+    line offsets to partPath.off and the segments to partPath.seg. The log is mapped rather than read, and only one
+    segment and its offsets are held at a time, so memory stays flat however big the chunk is.
+    """
+    lines = 0
+
+    with open(partPath + ".off", "wb") as offsetFile, open(partPath + ".seg", "wb") as segmentFile:
+        if start >= end: # an empty log, which cannot be mapped.
+            return lines
+
+        with open(logPath, "rb") as logFile, mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = start
+            while position < end:
+                segmentEnd = data.find(b'\n', min(position + SEGMENT_SIZE, end) - 1, end)
+                segmentEnd = end if segmentEnd == -1 else segmentEnd + 1
+                block = data[position:segmentEnd]
+
+                offsets = array.array('Q', [position])
+                newline = block.find(b'\n')
+                while newline != -1 and newline + 1 < len(block):
+                    offsets.append(position + newline + 1)
+                    newline = block.find(b'\n', newline + 1)
+
+                compressed = zlib.compress(block)
+                segmentFile.write(SEGMENT_HEADER.pack(len(offsets), len(compressed)) + compressed)
+                write_offsets(offsetFile, offsets)
+
+                lines += len(offsets)
+                position = segmentEnd
+
+    return lines
+
+
+def merge_parts(logPath, size, parts, lines):
+    # Joins a log's chunk outputs, in order, into its .idx and .seg files; each replaces the old one in one step.
+    with open(logPath, "rb") as logFile:
+        checksum = tail_checksum(logFile, size)
+
+    outputs = ((index_path(logPath), INDEX_MAGIC + INDEX_HEADER.pack(size, lines, checksum), ".off"),
+               (segment_path(logPath), SEGMENT_MAGIC, ".seg"))
+
+    for target, header, extension in outputs:
+        with open(target + ".tmp", "wb") as output:
+            output.write(header)
+            for part in parts:
+                with open(part + extension, "rb") as partFile:
+                    shutil.copyfileobj(partFile, output, 1 << 20)
+                os.remove(part + extension)
+        os.replace(target + ".tmp", target)
+
+
+class Progress:
+    def __init__(self, totalBytes, channels, stream=sys.stderr, interval=0.5):
+        self.total_bytes = totalBytes
+        self.channels = channels
+        self.stream = stream
+        self.interval = interval
+        self.done_bytes = 0
+        self.done_channels = 0
+        self.start = time.monotonic()
+        self.shown = 0.0
+
+    def advance(self, chunkBytes, channelsFinished):
+        self.done_bytes += chunkBytes
+        self.done_channels += channelsFinished
+        now = time.monotonic()
+        if self.stream is not None and (now - self.shown >= self.interval or self.done_bytes == self.total_bytes):
+            self.shown = now
+            self.stream.write("\r{0:.1f} of {1:.1f} MB, {2} of {3} channels, {4:.1f} MB/s   ".format(
+                self.done_bytes / 1e6, self.total_bytes / 1e6, self.done_channels, self.channels,
+                self.done_bytes / 1e6 / max(now - self.start, 1e-9)))
+            self.stream.flush()
+
+
+def index_logs(directory, workers=None, chunkSize=CHUNK_SIZE, progress=sys.stderr):
+    """
+    Builds the .idx and .seg files for every channel log in directory on a pool of processes. Each log is one task,
+    or several if it is bigger than chunkSize; the biggest go first so the pool is not left waiting on one straggler.
+    Only what the logs held when the run started is indexed, so the server can keep appending meanwhile.
+    """
+    workers = workers or os.cpu_count() or 1
+    logs = [(logPath, os.path.getsize(logPath)) for logPath in channel_logs(directory)]
+    workDirectory = tempfile.mkdtemp(prefix=".index-", dir=directory)
+    tasks = [] # (log path, start, end, part path)
+    parts = {} # Log Path -> [part path] in log order
+    for logPath, size in logs:
+        chunks = split_chunks(logPath, size, chunkSize)
+        parts[logPath] = []
+        for number, (start, end) in enumerate(chunks):
+            partPath = os.path.join(workDirectory, "{0}.{1}".format(os.path.basename(logPath), number))
+            parts[logPath].append(partPath)
+            tasks.append((logPath, start, end, partPath))
+    tasks.sort(key=lambda task: task[1] - task[2])
+
+    sizes = dict(logs)
+    remaining = dict((logPath, len(chunkParts)) for logPath, chunkParts in parts.items())
+    lines = dict((logPath, 0) for logPath in parts)
+    report = Progress(sum(sizes.values()), len(logs), progress)
+    startTime = time.monotonic()
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = dict((pool.submit(index_chunk, *task), task) for task in tasks)
+            for future in as_completed(futures):
+                logPath, start, end, partPath = futures[future]
+                lines[logPath] += future.result()
+                remaining[logPath] -= 1
+                if not remaining[logPath]:
+                    merge_parts(logPath, sizes[logPath], parts[logPath], lines[logPath])
+                report.advance(end - start, 0 if remaining[logPath] else 1)
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors=True)
+
+    if progress is not None:
+        progress.write("\n")
+
+    elapsed = time.monotonic() - startTime
+    compacted = sum(os.path.getsize(segment_path(logPath)) for logPath in parts)
+    return {"channels": len(logs), "tasks": len(tasks), "lines": sum(lines.values()), "bytes": report.total_bytes,
+            "compacted_bytes": compacted, "seconds": elapsed, "workers": workers}
+
+
+def read_index(logPath):
+    # (size, offsets) from the log's .idx if it indexes the log as it is now, or a prefix of it that the server has
+    # only appended to since; otherwise None.
+    try:
+        with open(index_path(logPath), "rb") as indexFile, open(logPath, "rb") as logFile:
+            if indexFile.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            size, count, checksum = INDEX_HEADER.unpack(indexFile.read(INDEX_HEADER.size))
+            if os.path.getsize(logPath) < size or tail_checksum(logFile, size) != checksum:
+                return None
+
+            offsets = array.array('Q')
+            offsets.fromfile(indexFile, count)
+    except (OSError, EOFError, struct.error):
+        return None
+
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return size, offsets
+
+
+def read_segments(logPath):
+    # Yields (line count, text) for every segment of the log's .seg file, in order.
+    with open(segment_path(logPath), "rb") as segmentFile:
+        if segmentFile.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError("{0} is not a segment file.".format(segment_path(logPath)))
+
+        while True:
+            header = segmentFile.read(SEGMENT_HEADER.size)
+            if len(header) < SEGMENT_HEADER.size:
+                return
+            count, length = SEGMENT_HEADER.unpack(header)
+            yield count, zlib.decompress(segmentFile.read(length)).decode('utf8', 'replace')
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    result = index_logs(directory, workers)
+    print("Indexed {0} channels ({1} tasks), {2} lines, {3:.1f} MB in {4:.2f}s ({5:.1f} MB/s) on {6} workers; "
+          "segments take {7:.0%} of the logs".format(result["channels"], result["tasks"], result["lines"],
+                                                    result["bytes"] / 1e6, result["seconds"],
+                                                    result["bytes"] / 1e6 / max(result["seconds"], 1e-9),
+                                                    result["workers"],
+                                                    result["compacted_bytes"] / max(result["bytes"], 1)))
+
+if __name__ == "__main__":
+    main()
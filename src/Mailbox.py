@@ -0,0 +1,165 @@
+import collections
+import os
+import struct
+import threading
+import time
+
+# A spooled message on disk: expiry (time.time()), then the length of the recipient's token and of the message, then
+# both.
+SPOOL_RECORD = struct.Struct('!dHI')
+
+
+class MailStore:
+    """
+    Messages waiting for users who are offline, kept in arrival order in a mailbox per resume session, so only the
+    client holding that session's token ever sees them, never whoever gets the name next. They are held in memory up
+    to memoryBudget bytes in total; past that, new messages are appended to a spool file instead, and the mailbox
+    only remembers where. Each mailbox holds at most limit messages and every message expires ttl seconds after it
+    was sent. Putting, taking and expiring a message are all O(1).
+    """
+    def __init__(self, spoolPath, memoryBudget, limit, ttl):
+        self.spool_path = spoolPath
+        self.memory_budget = memoryBudget
+        self.limit = limit
+        self.ttl = ttl
+        self.mailboxes = {} # Resume Token -> deque of (expiry, message or None if spooled, offset, length)
+        self.expiries = collections.deque() # (expiry, token) in sending order, which is also expiry order.
+        self.memory_used = 0
+        self.spool = None
+        self.spool_size = 0
+        self.spooled = 0 # messages in the spool file that have not been taken or expired yet.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(mailbox) for mailbox in self.mailboxes.values())
+
+    def put(self, token, message):
+        # False if the recipient's mailbox is already full.
+        with self.lock:
+            mailbox = self.mailboxes.get(token)
+            if mailbox is None:
+                mailbox = self.mailboxes[token] = collections.deque()
+            elif len(mailbox) >= self.limit:
+                return False
+
+            expiry = time.time() + self.ttl
+            data = message.encode('utf8')
+
+            if self.memory_used + len(data) <= self.memory_budget:
+                mailbox.append((expiry, data, 0, len(data)))
+                self.memory_used += len(data)
+            else:
+                mailbox.append((expiry, None, self.write_spool(expiry, token, data), len(data)))
+
+            self.expiries.append((expiry, token))
+            return True
+
+    def write_spool(self, expiry, token, data):
+        if self.spool is None:
+            self.spool = open(self.spool_path, "w+b")
+            self.spool_size = 0
+
+        name = token.encode('utf8')
+        offset = self.spool_size + SPOOL_RECORD.size + len(name)
+        self.spool.seek(self.spool_size)
+        self.spool.write(SPOOL_RECORD.pack(expiry, len(name), len(data)) + name + data)
+        self.spool_size += SPOOL_RECORD.size + len(name) + len(data)
+        self.spooled += 1
+        return offset
+
+    def take(self, token):
+        # Every message still waiting for the session, oldest first, as one string; '' if there are none.
+        with self.lock:
+            mailbox = self.mailboxes.pop(token, None)
+            if not mailbox:
+                return ''
+
+            now = time.time()
+            messages = []
+            for entry in mailbox:
+                data = self.release(entry)
+                if entry[0] > now:
+                    messages.append(data.decode('utf8', 'replace'))
+
+            self.compact_spool()
+            return ''.join(messages)
+
+    def drop(self, token):
+        # The session is gone, so nobody can ever collect its mail.
+        with self.lock:
+            for entry in self.mailboxes.pop(token, ()):
+                if entry[1] is not None:
+                    self.memory_used -= entry[3]
+                else:
+                    self.spooled -= 1
+
+            self.compact_spool()
+
+    def release(self, entry):
+        # Forgets one message and returns its bytes.
+        expiry, data, offset, length = entry
+        if data is not None:
+            self.memory_used -= length
+            return data
+
+        self.spooled -= 1
+        self.spool.flush()
+        self.spool.seek(offset)
+        return self.spool.read(length)
+
+    def expire(self):
+        # Drops messages whose time is up, oldest first; each pass only looks at what has actually expired.
+        with self.lock:
+            now = time.time()
+            while self.expiries and self.expiries[0][0] <= now:
+                expiry, token = self.expiries.popleft()
+                mailbox = self.mailboxes.get(token)
+                if mailbox and mailbox[0][0] <= now: # otherwise it was delivered or dropped already.
+                    entry = mailbox.popleft()
+                    if entry[1] is not None:
+                        self.memory_used -= entry[3]
+                    else:
+                        self.spooled -= 1
+                    if not mailbox:
+                        del self.mailboxes[token]
+
+            self.compact_spool()
+
+    def compact_spool(self):
+        # The spool only ever grows while something in it is still waiting; once it is all gone it starts over.
+        if self.spool is not None and self.spooled == 0 and self.spool_size:
+            self.spool.truncate(0)
+            self.spool_size = 0
+
+    def capture(self):
+        # For a hot restart: the new process reopens the same spool file, so spooled entries stay as offsets.
+        with self.lock:
+            if self.spool is not None:
+                self.spool.flush()
+            return dict((token, [[expiry, data.decode('latin1') if data is not None else None, offset, length]
+                                 for expiry, data, offset, length in mailbox])
+                        for token, mailbox in self.mailboxes.items())
+
+    def restore(self, mailboxes):
+        with self.lock:
+            for token, entries in mailboxes.items():
+                mailbox = self.mailboxes[token] = collections.deque()
+                for expiry, data, offset, length in entries:
+                    if data is not None:
+                        mailbox.append((expiry, data.encode('latin1'), offset, length))
+                        self.memory_used += length
+                    else:
+                        if self.spool is None:
+                            self.spool = open(self.spool_path, "r+b")
+                            self.spool_size = os.path.getsize(self.spool_path)
+                        mailbox.append((expiry, None, offset, length))
+                        self.spooled += 1
+                    self.expiries.append((expiry, token))
+
+            self.expiries = collections.deque(sorted(self.expiries))
+
+    def close(self):
+        with self.lock:
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
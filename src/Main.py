@@ -3,7 +3,11 @@ from tkinter import messagebox
 import ChatClient as client
 import BaseDialog as dialog
 import BaseEntry as entry
+import Roster
+import collections
+import queue
 import threading
+import time
 
 class SocketThreadedTask(threading.Thread):
     def __init__(self, socket, **callbacks):
@@ -17,30 +21,49 @@ class SocketThreadedTask(threading.Thread):
         while True:
             try:
                 message = self.socket.receive()
+                channel = self.message_channel()
 
-                if message == '/quit':
+                if self.socket.history_reply is not None:
+                    self.callbacks['prepend_history'](*(self.socket.history_reply + (message,)))
+                elif message == '':
+                    if self.reconnect():
+                        continue
+                    self.callbacks['update_chat_window']('\n> You have been disconnected from the server.\n')
+                    self.socket.disconnect()
+                    break
+                elif message == '/quit':
                     self.callbacks['clear_chat_window']()
                     self.callbacks['update_chat_window']('\n> You have been disconnected from the server.\n')
                     self.socket.disconnect()
                     break
+                elif message == '/sping':
+                    self.socket.send('/spong')
                 elif '/supdate' in message:
                     split_message = message.split('|')
-                    self.callbacks['clear_user_list']()
-                    self.callbacks['update_user_list'](split_message[1])
-                    break
+                    self.callbacks['clear_user_list'](channel)
+                    self.callbacks['update_user_list'](split_message[1], channel)
                 elif message == '/squit':
                     self.callbacks['clear_user_list']()
                     self.callbacks['clear_chat_window']()
                     self.callbacks['update_chat_window']('\n> The server was forcibly shutdown. No further messages are able to be sent\n')
                     self.socket.disconnect()
                     break
-                elif 'joined' in message:
-                    split_message = message.split('|')
+                elif 'have joined' in message:
+                    split_message = message.split('|', 2)
                     self.current_channel = (message.split(' ')[6]).split('!')[0]
-                    self.callbacks['clear_chat_window']()
-                    self.callbacks['update_chat_window_special_text'](split_message[0] + '\n' + split_message[2])
-                    self.callbacks['update_user_list'](split_message[1])
+                    start = [int(args[1]) for kind, args in self.socket.tags if kind == 'from'] or [None]
+                    self.callbacks['show_channel'](self.current_channel, split_message[1], start[0])
+                    self.callbacks['update_chat_window_special_text'](split_message[0] + '\n\n')
+                    self.callbacks['update_chat_window_special_text'](split_message[2][1:], start[0])
                     self.callbacks['add_channel_tab'](self.current_channel)
+                elif 'has joined' in message:
+                    split_message = message.split('|')
+                    self.callbacks['update_chat_window_special_text'](split_message[0], None, channel)
+                    self.callbacks['update_user_list'](split_message[1], channel)
+                elif any(kind == 'focus' for kind, args in self.socket.tags):
+                    self.current_channel = channel
+                    self.callbacks['focus_channel'](channel)
+                    self.callbacks['update_chat_window_special_text'](message, None, channel)
                 elif '<||>' in message:
                     self.callbacks['update_chat_window_special_text'](message)
                 elif '<|*|>' in message:
@@ -49,13 +72,32 @@ class SocketThreadedTask(threading.Thread):
                 elif '/clear' in message:
                     self.callbacks['clear_only_chat_window']()
                 elif 'left' in message:
-                    self.callbacks['update_chat_window'](message)
-                    self.callbacks['remove_user_from_list'](message.split(' ')[2])
+                    self.callbacks['update_chat_window'](message, None, channel)
+                    self.callbacks['remove_user_from_list'](message.split(' ')[1], channel)
                 else:
-                    self.callbacks['update_chat_window'](message)
+                    sequence = [int(args[1]) - 1 for kind, args in self.socket.tags if kind == 'seq'] or [None]
+                    self.callbacks['update_chat_window'](message, sequence[0], channel)
             except OSError:
+                if self.socket.isClientConnected and self.reconnect():
+                    continue
                 break
 
+    def message_channel(self):
+        # The channel a message was tagged with, or None for messages that are not about any one channel.
+        for kind, args in self.socket.tags:
+            if kind in ('chan', 'seq', 'focus'):
+                return args[0]
+        return None
+
+    def reconnect(self, attempts=5):
+        # The connection dropped without a /quit; resume the session so only the missed messages are fetched.
+        for attempt in range(attempts):
+            if self.socket.reconnect():
+                self.callbacks['update_chat_window_special_text']('\n> Reconnected to the server.\n')
+                return True
+            time.sleep(2 ** attempt)
+        return False
+
 class ChatDialog(dialog.BaseDialog):
     def body(self, master):
         tk.Label(master, text="Enter host:").grid(row=0, sticky="w")
@@ -85,11 +127,35 @@ class ChatDialog(dialog.BaseDialog):
             return False
 
 class ChatWindow(tk.Frame):
+    MAX_CACHED_LINES = 20000 # per channel
+    MAX_USER_LIST_CHANGES = 500 # per frame; beyond this the user list box is rewritten in one go instead.
+    SCROLLBACK_LINES = 2000 # kept in the text widget while it follows new messages.
+    RENDER_CHUNK_LINES = 500 # inserted per event loop tick, so a large history never blocks the window.
+
     def __init__(self, parent):
         tk.Frame.__init__(self, parent, bg="#111111")
-
+        self.init_state()
         self.initUI(parent)
 
+    def init_state(self):
+        # Every channel keeps its own messages and users, so switching tabs only redraws from memory. A cached
+        # message is [text, tag, line count, log position of its first line or None].
+        self.channel_history = {} # Channel Name -> deque of cached messages
+        self.cached_lines = {} # Channel Name -> lines cached
+        self.history_before = {} # Channel Name -> log position older messages can be fetched back from
+        self.channel_users = {} # Channel Name -> Roster
+        self.receiving_channel = '' # the channel the server is sending messages for.
+        self.shown_channel = ''
+
+        # The text widget holds the shown channel's cached messages from rendered_from on, except for those still
+        # waiting in render_queue.
+        self.rendered_from = 0
+        self.rendered_lines = 0
+        self.render_queue = collections.deque()
+        self.render_scheduled = False
+        self.fetching = False
+        self.request_history = None
+
     def initUI(self, parent):
         self.config(bg="#fcfcfa")
         self.messageTextArea = tk.Text(parent, bg="#111111", state=tk.DISABLED, wrap=tk.WORD, highlightbackground='#111111', foreground="green")
@@ -100,7 +166,7 @@ class ChatWindow(tk.Frame):
         self.messageScrollbar = tk.Scrollbar(parent, orient=tk.VERTICAL, command=self.messageTextArea.yview, highlightbackground='#111111', bg='#111111', troughcolor='#111111')
         self.messageScrollbar.grid(row=0, column=3, sticky="nsew")
 
-        self.messageTextArea['yscrollcommand'] = self.messageScrollbar.set
+        self.messageTextArea['yscrollcommand'] = self.on_scroll
 
         self.usersListBox = tk.Listbox(parent, bg="#212121", foreground="#fcfcfa")
         self.usersListBox.grid(row=0, column=4, padx=5, sticky="nsew")
@@ -111,49 +177,277 @@ class ChatWindow(tk.Frame):
         self.send_message_button = tk.Button(parent, text="Send", width=10, bg="green", highlightbackground='#313131')
         self.send_message_button.grid(row=1, column=1, padx=5, sticky="we")
 
-    def update_chat_window(self, message):
+    def apply_events(self, events):
+        # Applies a frame's worth of events from the socket thread with at most one text insert and only the user
+        # list box rows that changed, however many messages arrived.
+        redraw = False
+        listChanges = [] # list box changes for the shown channel, in the order they happened.
+
+        for name, args in events:
+            if name == 'show_channel':
+                self.receiving_channel = args[0]
+                changes = self.roster(args[0]).replace(args[1].split(' '))
+                if args[0] == self.shown_channel:
+                    listChanges.extend(changes)
+                if args[0] not in self.channel_history:
+                    self.history_before[args[0]] = args[2]
+                if args[0] != self.shown_channel:
+                    self.shown_channel = args[0]
+                    redraw = True
+            elif name == 'focus_channel':
+                self.receiving_channel = args[0]
+                if args[0] != self.shown_channel:
+                    self.shown_channel = args[0]
+                    redraw = True
+            elif name in ('update_chat_window', 'update_chat_window_special_text'):
+                tag = "user" if name == 'update_chat_window' else "nonuser"
+                self.add_message(self.event_channel(args, 2), args[0], tag, args[1] if len(args) > 1 else None)
+            elif name == 'prepend_history':
+                self.prepend_history(*args)
+            elif name == 'clear_chat_window':
+                self.channel_history.clear()
+                self.cached_lines.clear()
+                self.history_before.clear()
+                self.channel_users.clear()
+                self.receiving_channel = self.shown_channel = ''
+                redraw = True
+            elif name == 'clear_only_chat_window':
+                self.channel_history.pop(self.receiving_channel, None)
+                self.cached_lines.pop(self.receiving_channel, None)
+                self.history_before.pop(self.receiving_channel, None)
+                redraw = redraw or self.receiving_channel == self.shown_channel
+            elif name == 'clear_user_list':
+                roster = self.roster(self.event_channel(args, 0))
+                roster.clear()
+                if roster is self.roster(self.shown_channel):
+                    listChanges.append(('clear',))
+            elif name == 'update_user_list':
+                roster = self.roster(self.event_channel(args, 1))
+                for user in args[0].split(' '):
+                    index = roster.add(user)
+                    if index is not None and roster is self.roster(self.shown_channel):
+                        listChanges.append(('insert', index, user))
+            elif name == 'remove_user_from_list':
+                roster = self.roster(self.event_channel(args, 1))
+                index = roster.remove(args[0])
+                if index is not None and roster is self.roster(self.shown_channel):
+                    listChanges.append(('delete', index))
+
+        if redraw:
+            self.render_history()
+        else:
+            self.render_pending()
+
+        if redraw or len(listChanges) > ChatWindow.MAX_USER_LIST_CHANGES:
+            self.render_users()
+        else:
+            self.apply_user_list_changes(listChanges)
+
+    def event_channel(self, args, index):
+        # Messages tagged with a channel go to that channel; anything else belongs to the one being talked in.
+        return args[index] if len(args) > index and args[index] else self.receiving_channel
+
+    def roster(self, channelName):
+        if channelName not in self.channel_users:
+            self.channel_users[channelName] = Roster.Roster()
+        return self.channel_users[channelName]
+
+    def apply_user_list_changes(self, changes):
+        for change in changes:
+            if change[0] == 'insert':
+                self.usersListBox.insert(change[1], change[2])
+            elif change[0] == 'delete':
+                self.usersListBox.delete(change[1])
+            else:
+                self.usersListBox.delete(0, tk.END)
+
+    def split_message(self, text, tag, position):
+        # Large messages, such as the history sent on join, are cached in pieces of RENDER_CHUNK_LINES lines.
+        lines = text.splitlines(True)
+        if len(lines) <= ChatWindow.RENDER_CHUNK_LINES:
+            return [[text, tag, text.count('\n'), position]]
+
+        pieces = []
+        for start in range(0, len(lines), ChatWindow.RENDER_CHUNK_LINES):
+            piece = lines[start:start + ChatWindow.RENDER_CHUNK_LINES]
+            pieces.append([''.join(piece), tag, len(piece), position + start if position is not None else None])
+        return pieces
+
+    def cached_history(self, channelName):
+        if channelName not in self.channel_history:
+            self.channel_history[channelName] = collections.deque()
+            self.cached_lines[channelName] = 0
+        return self.channel_history[channelName]
+
+    def add_message(self, channelName, text, tag, position=None):
+        if not text:
+            return
+
+        messages = self.split_message(text, tag, position)
+        self.cached_history(channelName).extend(messages)
+        self.cached_lines[channelName] += sum(message[2] for message in messages)
+
+        if channelName == self.shown_channel:
+            self.render_queue.extend(messages)
+
+        self.trim_cache(channelName)
+
+    def prepend_history(self, channelName, position, text):
+        self.fetching = False
+        self.history_before[channelName] = position
+
+        messages = self.split_message(text, "user", position) if text else []
+        self.cached_history(channelName).extendleft(reversed(messages))
+        self.cached_lines[channelName] += sum(message[2] for message in messages)
+
+        if channelName == self.shown_channel:
+            self.rendered_from += len(messages)
+            self.load_older()
+
+    def following(self):
+        return self.messageTextArea.yview()[1] >= 1.0
+
+    def trim_cache(self, channelName):
+        # Drops the oldest messages in bulk, but never out from under someone reading back through the channel.
+        cache = self.channel_history[channelName]
+        if self.cached_lines[channelName] <= ChatWindow.MAX_CACHED_LINES * 1.1:
+            return
+        if channelName == self.shown_channel and not self.following():
+            return
+
+        characters = 0
+        while self.cached_lines[channelName] > ChatWindow.MAX_CACHED_LINES and len(cache) > 1:
+            message = cache.popleft()
+            self.cached_lines[channelName] -= message[2]
+
+            if channelName == self.shown_channel:
+                if self.rendered_from > 0:
+                    self.rendered_from -= 1
+                elif len(cache) + 1 > len(self.render_queue): # it is on screen.
+                    characters += len(message[0])
+                    self.rendered_lines -= message[2]
+                else:
+                    self.render_queue.popleft()
+
+        self.delete_top(characters)
+
+        positions = [message[3] for message in cache if message[3] is not None][:1]
+        if positions:
+            self.history_before[channelName] = positions[0]
+
+    def delete_top(self, characters):
+        if characters > 0:
+            self.messageTextArea.configure(state='normal')
+            self.messageTextArea.delete('1.0', '1.0 + {0} chars'.format(characters))
+            self.messageTextArea.configure(state='disabled')
+
+    def render_history(self):
+        # Redraws the shown channel from its cache, starting with the messages that fit in the scrollback.
+        cache = self.channel_history.get(self.shown_channel, ())
+        self.rendered_from = len(cache)
+        lines = 0
+        while self.rendered_from > 0 and lines < ChatWindow.SCROLLBACK_LINES:
+            self.rendered_from -= 1
+            lines += cache[self.rendered_from][2]
+
+        self.render_queue = collections.deque(list(cache)[self.rendered_from:])
+        self.rendered_lines = 0
         self.messageTextArea.configure(state='normal')
-        tag = "user"
-        self.messageTextArea.insert(tk.END, message, tag)
+        self.messageTextArea.delete('1.0', tk.END)
         self.messageTextArea.configure(state='disabled')
 
-    def update_chat_window_special_text(self, message):
-        tag = "nonuser"
+        self.render_pending()
+
+    def render_pending(self):
+        self.render_scheduled = False
+        if not self.render_queue:
+            return
+
+        segments = [] # alternating text and tag, as Text.insert takes them.
+        lines = 0
+        while self.render_queue and lines < ChatWindow.RENDER_CHUNK_LINES:
+            message = self.render_queue.popleft()
+            segments.extend(message[:2])
+            lines += message[2]
+
+        following = self.following()
         self.messageTextArea.configure(state='normal')
-        self.messageTextArea.insert(tk.END, message, tag)
+        self.messageTextArea.insert(tk.END, *segments)
         self.messageTextArea.configure(state='disabled')
+        self.rendered_lines += lines
 
-    def update_user_list(self, user_message):
-        users = user_message.split(' ')
+        if following:
+            self.trim_scrollback()
+            self.messageTextArea.see(tk.END)
 
-        for user in users:
-            if user not in self.usersListBox.get(0, tk.END):
-                self.usersListBox.insert(tk.END, user)
+        if self.render_queue:
+            self.render_scheduled = True
+            self.after(1, self.render_pending)
 
-    def clear_user_list(self):
-        for user in self.usersListBox.get(0, tk.END):
-            index = self.usersListBox.get(0, tk.END).index(user)
-            self.usersListBox.delete(index)
+    def trim_scrollback(self):
+        # Trims in bulk once the widget is a tenth over its limit rather than a line at a time.
+        if self.rendered_lines <= ChatWindow.SCROLLBACK_LINES * 1.1:
+            return
 
-    def remove_user_from_list(self, user):
-        print(user)
-        index = self.usersListBox.get(0, tk.END).index(user)
-        self.usersListBox.delete(index)
+        cache = self.channel_history[self.shown_channel]
+        characters = 0
+        while self.rendered_lines > ChatWindow.SCROLLBACK_LINES and self.rendered_from < len(cache):
+            message = cache[self.rendered_from]
+            characters += len(message[0])
+            self.rendered_lines -= message[2]
+            self.rendered_from += 1
 
-    def clear_only_chat_window(self):
-        if not self.messageTextArea.compare("end-1c", "==", "1.0"):
-            self.messageTextArea.configure(state='normal')
-            self.messageTextArea.delete('1.0', tk.END)
-            self.messageTextArea.configure(state='disabled')
+        self.delete_top(characters)
+
+    def on_scroll(self, first, last):
+        self.messageScrollbar.set(first, last)
 
-    def clear_chat_window(self):
-        if not self.messageTextArea.compare("end-1c", "==", "1.0"):
+        if float(first) <= 0.0 and not self.render_scheduled:
+            self.load_older()
+
+    def load_older(self):
+        # At the top of the window: show older cached messages, or fetch the page before them from the server.
+        cache = self.channel_history.get(self.shown_channel)
+
+        if cache and self.rendered_from > 0:
+            end = self.rendered_from
+            lines = 0
+            while self.rendered_from > 0 and lines < ChatWindow.RENDER_CHUNK_LINES:
+                self.rendered_from -= 1
+                lines += cache[self.rendered_from][2]
+
+            segments = [item for message in list(cache)[self.rendered_from:end] for item in message[:2]]
             self.messageTextArea.configure(state='normal')
-            self.messageTextArea.delete('1.0', tk.END)
+            self.messageTextArea.insert('1.0', *segments)
             self.messageTextArea.configure(state='disabled')
-
-        if self.usersListBox.size() > 0:
+            self.messageTextArea.yview('{0}.0'.format(lines + 1)) # keep the line that was at the top in view.
+            self.rendered_lines += lines
+        elif self.history_before.get(self.shown_channel) and not self.fetching and self.request_history is not None:
+            self.fetching = True
+            self.request_history(self.shown_channel, self.history_before[self.shown_channel])
+
+    def show_channel(self, channelName):
+        # Switches the window to a channel straight from the cache, before the server has answered the /join.
+        if channelName != self.shown_channel:
+            self.shown_channel = channelName
+            self.render_history()
+            self.render_users()
+
+    def render_users(self):
+        users = list(self.roster(self.shown_channel))
+
+        if list(self.usersListBox.get(0, tk.END)) != users:
             self.usersListBox.delete(0, tk.END)
+            self.usersListBox.insert(tk.END, *users)
+
+    def update_user_list(self, user_message):
+        self.apply_events([('update_user_list', (user_message,))])
+
+    def clear_user_list(self):
+        self.apply_events([('clear_user_list', ())])
+
+    def remove_user_from_list(self, user):
+        self.apply_events([('remove_user_from_list', (user,))])
 
     def send_message(self, **callbacks):
         message = self.entryField.get()
@@ -166,11 +460,15 @@ class ChatWindow(tk.Frame):
         self.entryField.insert(0, message)
 
     def bind_widgets(self, callback):
+        self.request_history = lambda channelName, before: callback('/history {0} {1}'.format(channelName, before))
         self.send_message_button['command'] = lambda sendCallback = callback : self.send_message(send_message_to_server=sendCallback)
         self.entryField.bind("<Return>", lambda event, sendCallback = callback : self.send_message(send_message_to_server=sendCallback))
         self.messageTextArea.bind("<1>", lambda event: self.messageTextArea.focus_set())
 
 class ChatGUI(tk.Frame):
+    FRAME_INTERVAL = 50 # milliseconds between drains of the socket thread's event queue.
+    MAX_EVENTS_PER_FRAME = 5000
+
     def __init__(self, parent):
         tk.Frame.__init__(self, parent, bg= "#111111")
 
@@ -182,8 +480,10 @@ class ChatGUI(tk.Frame):
 
         self.channelTabs = []
 
+        self.events = queue.Queue() # (callback name, args) from the socket thread; Tk is only touched from here.
+        self.parent.after(ChatGUI.FRAME_INTERVAL, self.process_events)
 
-        self.ChatWindow.bind_widgets(self.clientSocket.send)
+        self.ChatWindow.bind_widgets(self.send_message)
         self.parent.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def initUI(self, parent):
@@ -217,10 +517,40 @@ class ChatGUI(tk.Frame):
     def add_channel_tab(self, channelName):
 
         if channelName not in self.channelTabs:
-            self.mainMenu.add_command(label=channelName, command=lambda: self.clientSocket.send('/join ' + channelName))
+            self.mainMenu.add_command(label=channelName, command=lambda: self.send_message('/join ' + channelName))
 
             self.channelTabs.append(channelName)
 
+    def send_message(self, message):
+        # A /join for a channel that is already cached switches to it locally and only asks for what was missed.
+        parts = message.split()
+        if len(parts) == 2 and parts[0] == '/join' and parts[1] in self.ChatWindow.channel_history \
+                and parts[1] in self.clientSocket.last_seen:
+            self.ChatWindow.show_channel(parts[1])
+            message = '/join {0} {1}'.format(parts[1], self.clientSocket.last_seen[parts[1]])
+
+        self.clientSocket.send(message)
+
+    def queue_event(self, name):
+        return lambda *args: self.events.put((name, args))
+
+    def process_events(self):
+        events = []
+        try:
+            while len(events) < ChatGUI.MAX_EVENTS_PER_FRAME:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+
+        for name, args in events:
+            if name == 'add_channel_tab':
+                self.add_channel_tab(*args)
+
+        if events:
+            self.ChatWindow.apply_events(events)
+
+        self.parent.after(ChatGUI.FRAME_INTERVAL, self.process_events)
+
     def connect_to_server(self):
         if self.clientSocket.isClientConnected:
             tk.messagebox.showwarning("Info", "Already connected to the server.")
@@ -232,15 +562,18 @@ class ChatGUI(tk.Frame):
             self.clientSocket.connect(dialogResult[0], dialogResult[1])
 
             if self.clientSocket.isClientConnected:
-                self.ChatWindow.clear_chat_window()
-                SocketThreadedTask(self.clientSocket, update_chat_window=self.ChatWindow.update_chat_window,
-                                                      update_chat_window_special_text=self.ChatWindow.update_chat_window_special_text,
-                                                      update_user_list=self.ChatWindow.update_user_list,
-                                                      clear_user_list=self.ChatWindow.clear_user_list,
-                                                      clear_chat_window=self.ChatWindow.clear_chat_window,
-                                                      clear_only_chat_window=self.ChatWindow.clear_only_chat_window,
-                                                      remove_user_from_list=self.ChatWindow.remove_user_from_list,
-                                                      add_channel_tab = self.add_channel_tab).start()
+                self.ChatWindow.apply_events([('clear_chat_window', ())])
+                SocketThreadedTask(self.clientSocket, update_chat_window=self.queue_event('update_chat_window'),
+                                                      update_chat_window_special_text=self.queue_event('update_chat_window_special_text'),
+                                                      update_user_list=self.queue_event('update_user_list'),
+                                                      clear_user_list=self.queue_event('clear_user_list'),
+                                                      clear_chat_window=self.queue_event('clear_chat_window'),
+                                                      clear_only_chat_window=self.queue_event('clear_only_chat_window'),
+                                                      remove_user_from_list=self.queue_event('remove_user_from_list'),
+                                                      show_channel=self.queue_event('show_channel'),
+                                                      focus_channel=self.queue_event('focus_channel'),
+                                                      prepend_history=self.queue_event('prepend_history'),
+                                                      add_channel_tab = self.queue_event('add_channel_tab')).start()
 
             else:
                 tk.messagebox.showwarning("Error", "Unable to connect to the server.")
@@ -0,0 +1,270 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0) # Without it (Windows) a send may block, as it always did.
+COALESCE = 64 * 1024 # Messages queued behind the one being written are merged into writes of up to this size.
+
+
+class Outbox:
+    """
+    Wraps a client socket so that sending to it never blocks the caller, be it a shard in the middle of a fan-out,
+    the timer wheel or another client's thread. Whatever the socket takes at once goes straight out; the rest is
+    queued, in order, for the Writer to finish as the peer reads. A peer that lets more than limit bytes pile up is
+    not reading at all: it is disconnected, and every later send to it fails as it would on a dead socket.
+    """
+    __slots__ = ("socket", "writer", "limit", "queue", "queued", "lock", "broken", "closed", "held")
+
+    def __init__(self, sock, writer, limit):
+        self.socket = sock
+        self.writer = writer
+        self.limit = limit
+        self.queue = None # deque of bytes not sent yet, oldest first; only exists while something is waiting.
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.broken = False # set once the peer is gone or was cut off; sends fail from then on.
+        self.closed = False # set by close(); the socket is closed as soon as nothing is left queued.
+        self.held = False # set by hold() while a hot restart hands the connection over; nothing is written meanwhile.
+
+    def sendall(self, data):
+        with self.lock:
+            if self.broken or self.closed:
+                raise BrokenPipeError("The connection is closed.")
+
+            if self.held:
+                if self.queue is None:
+                    self.queue = collections.deque()
+                self.queue.append(data)
+                self.queued += len(data)
+                return
+            elif self.queue is None:
+                sent = self.write(data)
+                if sent == len(data):
+                    return
+                self.queue = collections.deque()
+                self.queue.append(data[sent:])
+                self.queued = len(data) - sent
+                self.writer.watch(self)
+            elif len(self.queue) > 1 and len(self.queue[-1]) + len(data) <= COALESCE:
+                self.queue[-1] += data # never the head, which may be half written and must be retried as it is.
+                self.queued += len(data)
+            else:
+                self.queue.append(data)
+                self.queued += len(data)
+
+            if self.queued > self.limit:
+                self.abort()
+                raise ConnectionResetError("The peer stopped reading; {0} bytes were waiting.".format(self.limit))
+
+    def send(self, data, flags=0):
+        # With MSG_DONTWAIT this only ever tries: if another thread is sending or a backlog is already waiting,
+        # nothing is sent and 0 is returned. A write the socket only took part of is finished later, as usual.
+        if not DONTWAIT or not flags & DONTWAIT:
+            self.sendall(data)
+            return len(data)
+
+        if not self.lock.acquire(False):
+            return 0
+        try:
+            if self.broken or self.closed:
+                raise BrokenPipeError("The connection is closed.")
+            if self.queue is not None or self.held:
+                return 0
+
+            sent = self.write(data)
+            if 0 < sent < len(data):
+                self.queue = collections.deque()
+                self.queue.append(data[sent:])
+                self.queued = len(data) - sent
+                self.writer.watch(self)
+            return len(data) if sent else 0
+        finally:
+            self.lock.release()
+
+    def write(self, data):
+        # One attempt that does not block; returns how many bytes the socket took.
+        try:
+            return self.socket.send(data, DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def flush(self):
+        # Runs on the Writer when the socket is writable; True once nothing is left waiting.
+        with self.lock:
+            while self.queue and not self.held:
+                data = self.queue[0]
+                try:
+                    sent = self.write(data)
+                except OSError:
+                    self.abort()
+                    return True
+
+                self.queued -= sent
+                if sent < len(data):
+                    if sent:
+                        self.queue[0] = data[sent:]
+                    return False
+                self.queue.popleft()
+
+            if self.held:
+                return False
+            self.queue = None
+            return True
+
+    def hold(self):
+        # For a hot restart, with the Writer held: from now on sends are only queued, never written, and the peer is
+        # never shut out, since the connection is about to belong to another process. Returns what is still queued,
+        # for that process to send first.
+        with self.lock:
+            self.held = True
+            return b''.join(self.queue) if self.queue else b''
+
+    def unhold(self):
+        # The handoff failed: everything queued meanwhile goes out after all.
+        with self.lock:
+            self.held = False
+            waiting = self.queue is not None
+        if waiting:
+            self.writer.watch(self)
+
+    def shutdown(self, how):
+        with self.lock:
+            if self.held:
+                return
+        self.socket.shutdown(how)
+
+    def abort(self):
+        # Called with the lock held. Drops the backlog and shuts the socket, so the client's own thread reads EOF and
+        # removes the user; the socket itself is closed when that thread closes the outbox.
+        self.broken = True
+        self.queue = None
+        self.queued = 0
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.writer.watch(self)
+
+    def close(self):
+        # A last reply still queued (to /quit, say) goes out first; the Writer closes the socket once it has.
+        with self.lock:
+            self.closed = True
+        self.writer.watch(self)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class Writer(threading.Thread):
+    """
+    The one thread that finishes every Outbox's queued sends, waking when their sockets become writable, and that
+    closes each outbox once it has been closed and its queue has gone out, or after linger seconds regardless.
+    """
+    def __init__(self, linger=5.0):
+        threading.Thread.__init__(self, name="outbox-writer", daemon=True)
+        self.linger = linger
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.changes = collections.deque() # Outboxes that got a backlog or were closed since the last pass.
+        self.passing = threading.Lock() # Held through every pass, and by hold() to keep the writer off the sockets.
+        self.closing = {} # Outbox -> when to close it even if its queue has not drained
+        self.stop_signal = threading.Event()
+
+    def watch(self, outbox):
+        self.changes.append(outbox)
+        try:
+            self.waker.send(b'\0')
+        except OSError: # a wakeup is already pending, or the writer has stopped.
+            pass
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            events = self.selector.select(1.0 if self.closing else None)
+            with self.passing:
+                for key, mask in events:
+                    if key.data is None:
+                        try:
+                            while self.wakeup.recv(4096):
+                                pass
+                        except OSError:
+                            pass
+                    elif key.data.flush():
+                        self.settle(key.data)
+
+                while self.changes:
+                    self.settle(self.changes.popleft())
+
+                now = time.monotonic()
+                for outbox, deadline in list(self.closing.items()):
+                    if deadline <= now:
+                        self.finish(outbox)
+
+        for outbox in list(self.closing):
+            self.finish(outbox)
+
+    def settle(self, outbox):
+        # Watches the socket of an outbox with something queued, forgets one with nothing, and closes a closed one
+        # whose queue is empty. Queues only ever appear together with a watch() call, so nothing is missed.
+        key = self.key(outbox)
+        waiting = outbox.queue is not None
+
+        if waiting and key is None:
+            fd = outbox.socket.fileno()
+            if fd in self.selector.get_map(): # left by a closed connection whose descriptor was reused.
+                self.selector.unregister(fd)
+            self.selector.register(fd, selectors.EVENT_WRITE, outbox)
+        elif not waiting and key is not None:
+            self.selector.unregister(key.fd)
+
+        if outbox.closed:
+            if waiting:
+                self.closing.setdefault(outbox, time.monotonic() + self.linger)
+            else:
+                self.finish(outbox)
+
+    def key(self, outbox):
+        try:
+            key = self.selector.get_map().get(outbox.socket.fileno())
+        except (OSError, ValueError): # already closed.
+            return None
+        return key if key is not None and key.data is outbox else None
+
+    def finish(self, outbox):
+        key = self.key(outbox)
+        if key is not None:
+            self.selector.unregister(key.fd)
+        self.closing.pop(outbox, None)
+        try:
+            outbox.socket.close()
+        except OSError:
+            pass
+
+    def backlog(self):
+        # How many outboxes still have something queued.
+        return len(self.selector.get_map()) - 1
+
+    def wait_drained(self, timeout):
+        # For a hot restart: gives what is queued a chance to go out before the sockets change hands.
+        deadline = time.monotonic() + timeout
+        while self.backlog() > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.backlog() == 0
+
+    def hold(self):
+        # Returns once the writer is between passes, and keeps it there until unhold().
+        self.passing.acquire()
+
+    def unhold(self):
+        self.passing.release()
+
+    def stop(self):
+        self.stop_signal.set()
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
@@ -0,0 +1,67 @@
+import threading
+
+STATES = ("online", "away", "offline")
+
+
+class PresenceIndex:
+    """
+    Monitor lists, indexed both ways. watchers maps a username to the users watching it, so a change in someone's
+    presence costs one lookup and a send per subscriber; watching maps each user to their own list, so it can be
+    dropped in one go when they leave. Each user may watch at most limit names.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.watchers = {} # Username -> set of User watching it
+        self.watching = {} # User -> set of Usernames
+        self.lock = threading.Lock()
+
+    def watch(self, user, names):
+        # Returns the names the user is now watching out of those asked for; the rest did not fit under the limit.
+        accepted = []
+        with self.lock:
+            watched = self.watching.setdefault(user, set())
+            for name in names:
+                if name not in watched:
+                    if len(watched) >= self.limit:
+                        continue
+                    watched.add(name)
+                    self.watchers.setdefault(name, set()).add(user)
+                accepted.append(name)
+
+            if not watched:
+                del self.watching[user]
+        return accepted
+
+    def unwatch(self, user, names):
+        with self.lock:
+            watched = self.watching.get(user, set())
+            for name in names:
+                if name in watched:
+                    watched.discard(name)
+                    self.forget(name, user)
+
+            if not watched:
+                self.watching.pop(user, None)
+
+    def clear(self, user):
+        with self.lock:
+            for name in self.watching.pop(user, ()):
+                self.forget(name, user)
+
+    def forget(self, name, user):
+        subscribers = self.watchers.get(name)
+        if subscribers is not None:
+            subscribers.discard(user)
+            if not subscribers:
+                del self.watchers[name]
+
+    def watched(self, user):
+        with self.lock:
+            return sorted(self.watching.get(user, ()))
+
+    def has_subscribers(self, name):
+        return name in self.watchers
+
+    def subscribers(self, name):
+        with self.lock:
+            return list(self.watchers.get(name, ()))
@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import sys
+import time
+import Capture
+
+SETTLE = 0.05 # Seconds to wait for a reply before sending an unframed client's next command regardless.
+REPLY_TIMEOUT = 2.0 # A command with no reply for this long counts as unanswered rather than as slow.
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+class ReplayConnection:
+    """
+    One captured connection played back: its commands are sent at their recorded times, scaled by the replay speed,
+    and the first reply after each one marks its latency. An unframed client's commands must reach the server in
+    separate reads, so each waits for a reply to the one before it, or SETTLE seconds, before it goes out.
+    """
+    def __init__(self, replay, records):
+        self.replay = replay
+        self.records = records # (seconds since the start, kind, payload)
+        self.pending = collections.deque() # Send times of commands with no reply yet.
+        self.answered = asyncio.Event()
+        self.receiver = None
+        self.reader = None
+        self.writer = None
+
+    async def run(self):
+        try:
+            for offset, kind, payload in self.records:
+                await self.replay.wait_until(offset)
+
+                if kind == Capture.OPEN:
+                    await self.open()
+                elif kind == Capture.CLOSE:
+                    break
+                elif self.writer is not None:
+                    if kind == Capture.MESSAGE and self.pending:
+                        try:
+                            await asyncio.wait_for(self.answered.wait(), SETTLE)
+                        except asyncio.TimeoutError:
+                            pass
+                    await self.send(offset, payload + b'\n' if kind == Capture.LINE else payload)
+        except (OSError, asyncio.IncompleteReadError):
+            self.replay.errors += 1
+        finally:
+            await self.close()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(*self.replay.address)
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def send(self, offset, data):
+        now = time.monotonic()
+        if self.replay.speed:
+            self.replay.lag = max(self.replay.lag, now - self.replay.due(offset))
+        self.answered.clear()
+        self.pending.append(now)
+        self.writer.write(data)
+        await self.writer.drain()
+        self.replay.sent += 1
+        self.replay.sent_bytes += len(data)
+
+    async def receive(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic()
+            self.replay.received_bytes += len(data)
+            while self.pending:
+                latency = now - self.pending.popleft()
+                if latency < REPLY_TIMEOUT:
+                    self.replay.latencies.append(latency)
+            self.answered.set()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        await asyncio.sleep(SETTLE) # let replies to the last commands arrive.
+        self.receiver.cancel()
+        self.writer.close()
+        self.writer = None
+
+
+class Replay:
+    """
+    Drives a server with a trace written by Capture.TraceWriter, at the speed it was recorded (1), some multiple of
+    it, or as fast as the server will take it (None), and reports throughput and reply latency.
+    """
+    def __init__(self, address, records, speed=1):
+        self.address = address
+        self.speed = speed
+        self.connections = collections.defaultdict(list) # Connection id -> [(seconds since the start, kind, payload)]
+        for offset, connection, kind, payload in records:
+            self.connections[connection].append((offset, kind, payload))
+        self.start = None
+        self.sent = self.sent_bytes = self.received_bytes = self.errors = 0
+        self.latencies = []
+        self.lag = 0.0 # The furthest behind schedule a command went out.
+
+    def due(self, offset):
+        return self.start + (offset / self.speed if self.speed else 0)
+
+    async def wait_until(self, offset):
+        delay = self.due(offset) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self):
+        self.start = time.monotonic()
+        await asyncio.gather(*[ReplayConnection(self, records).run() for records in self.connections.values()])
+        elapsed = time.monotonic() - self.start
+
+        answered = len(self.latencies)
+        return {"connections": len(self.connections), "sent": self.sent, "sent_bytes": self.sent_bytes,
+                "received_bytes": self.received_bytes, "seconds": elapsed, "per_second": self.sent / max(elapsed, 1e-9),
+                "answered": answered, "unanswered": self.sent - answered, "errors": self.errors, "lag": self.lag,
+                "p50": percentile(self.latencies, 0.5), "p99": percentile(self.latencies, 0.99),
+                "max": max(self.latencies) if self.latencies else float('nan')}
+
+
+def replay(path, host='127.0.0.1', port=50000, speed=1):
+    header, records = Capture.read_trace(path)
+    return asyncio.run(Replay((host, port), records, speed).run())
+
+
+def report(result, speed):
+    return "{0}: {1} connections, {2} commands ({3} bytes) in {4:.2f}s ({5:.0f}/s), latency p50 {6:.1f} ms, " \
+           "p99 {7:.1f} ms, max {8:.1f} ms, {9} unanswered, {10} errors, at most {11:.0f} ms behind schedule"\
+        .format("max speed" if not speed else "{0:g}x".format(speed), result["connections"], result["sent"],
+                result["sent_bytes"], result["seconds"], result["per_second"], result["p50"] * 1000,
+                result["p99"] * 1000, result["max"] * 1000, result["unanswered"], result["errors"],
+                result["lag"] * 1000)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: Replay.py [trace file] [host] [port] [speed: 1, 10, ... or max]")
+        sys.exit(2)
+
+    host = sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+    speed = None if len(sys.argv) > 4 and sys.argv[4] == 'max' else float(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    print(report(replay(sys.argv[1], host, port, speed), speed))
+
+if __name__ == "__main__":
+    main()
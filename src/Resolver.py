@@ -0,0 +1,60 @@
+import collections
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Resolver:
+    """
+    Reverse DNS for peer addresses, off the calling thread. Answers are cached for ttl seconds (failures for
+    failureTtl) in an LRU of at most maxEntries addresses, and concurrent lookups of one address share a single query.
+    """
+    def __init__(self, ttl=300, failureTtl=60, maxEntries=4096, workers=2):
+        self.ttl = ttl
+        self.failure_ttl = failureTtl
+        self.max_entries = maxEntries
+        self.cache = collections.OrderedDict() # IP Address -> (hostname or None, expiry)
+        self.pending = {} # IP Address -> [callback] waiting on the query in flight
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="resolver")
+
+    def lookup(self, address, callback=None):
+        # Returns (True, hostname or None) from the cache, or (False, None) after starting a query whose answer is
+        # later passed to callback on a resolver thread.
+        with self.lock:
+            entry = self.cache.get(address)
+            if entry is not None and entry[1] > time.monotonic():
+                self.cache.move_to_end(address)
+                return True, entry[0]
+
+            waiting = self.pending.get(address)
+            if waiting is None:
+                waiting = self.pending[address] = []
+                self.executor.submit(self.resolve, address)
+            if callback is not None:
+                waiting.append(callback)
+
+        return False, None
+
+    def resolve(self, address):
+        try:
+            hostname = socket.gethostbyaddr(address)[0]
+        except (OSError, UnicodeError):
+            hostname = None
+
+        with self.lock:
+            self.cache[address] = (hostname, time.monotonic() + (self.ttl if hostname else self.failure_ttl))
+            self.cache.move_to_end(address)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+            callbacks = self.pending.pop(address, [])
+
+        for callback in callbacks:
+            try:
+                callback(hostname)
+            except OSError: # whoever asked has gone away.
+                pass
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,54 @@
+import bisect
+
+
+class Roster:
+    """
+    The users of one channel, kept as a set for membership tests and as a sorted list that mirrors the order of the
+    user list box. Every change returns the list box position it touched, so the widget can be updated in place.
+    """
+    def __init__(self, usernames=()):
+        self.members = set(username for username in usernames if username)
+        self.ordered = sorted(self.members)
+
+    def __contains__(self, username):
+        return username in self.members
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def add(self, username):
+        if not username or username in self.members:
+            return None
+
+        index = bisect.bisect_left(self.ordered, username)
+        self.ordered.insert(index, username)
+        self.members.add(username)
+        return index
+
+    def remove(self, username):
+        if username not in self.members:
+            return None
+
+        index = bisect.bisect_left(self.ordered, username)
+        del self.ordered[index]
+        self.members.discard(username)
+        return index
+
+    def clear(self):
+        self.members.clear()
+        del self.ordered[:]
+
+    def replace(self, usernames):
+        # Returns the ('delete', index) and ('insert', index, username) changes that turn the old list into the new.
+        usernames = set(username for username in usernames if username)
+        changes = []
+
+        for username in sorted(self.members - usernames, reverse=True):
+            changes.append(('delete', self.remove(username)))
+        for username in sorted(usernames - self.members):
+            changes.append(('insert', self.add(username), username))
+
+        return changes
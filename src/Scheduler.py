@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+# Priority classes, most urgent first.
+CONTROL = 0 # /part, /away: cheap and never worth waiting behind chat for.
+CHAT = 1 # messages and everything that delivers them.
+ADMIN = 2 # operator commands; rare, so they never crowd out chat, but never shed either.
+QUERY = 3 # scans of the user and channel lists, the first thing to go under load.
+NAMES = ("control", "chat", "admin", "query")
+
+SHED = object() # returned by run() in place of a result when the command was not executed.
+
+
+class Scheduler:
+    """
+    Runs client commands on a fixed pool of workers, always taking the oldest command of the most urgent class that
+    has one waiting. Classes from shedFrom down are refused outright while their own queue is longer than queueLimit,
+    or while a more urgent class has had a command waiting longer than its latency budget; each class can also be
+    held to a number of workers so a burst of it always leaves room for the others.
+    """
+    def __init__(self, workers, budgets, queueLimit, shedFrom=QUERY, concurrency=None):
+        self.budgets = budgets # Priority -> seconds a command of that class may wait before lower classes are shed.
+        self.queue_limit = queueLimit
+        self.shed_from = shedFrom
+        self.concurrency = concurrency or {} # Priority -> most workers that class may hold at once
+        self.queues = [collections.deque() for name in NAMES] # (enqueued at, future, function, args)
+        self.running = [0] * len(NAMES)
+        self.shed_counts = [0] * len(NAMES)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.workers = [threading.Thread(target=self.work, name="worker-{0}".format(index), daemon=True)
+                        for index in range(workers)]
+
+        for worker in self.workers:
+            worker.start()
+
+    def run(self, priority, function, *args):
+        # Runs function on a worker and returns its result (or raises its exception), or returns SHED.
+        if not self.workers or priority is None:
+            return function(*args)
+
+        future = Future()
+        with self.condition:
+            if priority >= self.shed_from and self.overloaded(priority):
+                self.shed_counts[priority] += 1
+                return SHED
+
+            self.queues[priority].append((time.monotonic(), future, function, args))
+            self.condition.notify()
+
+        return future.result()
+
+    def overloaded(self, priority):
+        if len(self.queues[priority]) >= self.queue_limit:
+            return True
+
+        now = time.monotonic()
+        for urgent in range(priority):
+            if self.queues[urgent] and now - self.queues[urgent][0][0] > self.budgets.get(urgent, float('inf')):
+                return True
+        return False
+
+    def next_task(self):
+        for priority, waiting in enumerate(self.queues):
+            if waiting and self.running[priority] < self.concurrency.get(priority, len(self.workers)):
+                self.running[priority] += 1
+                return priority, waiting.popleft()
+        return None, None
+
+    def work(self):
+        while True:
+            with self.condition:
+                priority, task = self.next_task()
+                while task is None and not self.stopped:
+                    self.condition.wait()
+                    priority, task = self.next_task()
+                if task is None:
+                    return
+
+            enqueued, future, function, args = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as error:
+                    future.set_exception(error)
+
+            with self.condition:
+                self.running[priority] -= 1
+                self.condition.notify() # a class held back by its concurrency limit may be able to go now.
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            return [(NAMES[priority], len(waiting), now - waiting[0][0] if waiting else 0.0, self.shed_counts[priority])
+                    for priority, waiting in enumerate(self.queues)]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
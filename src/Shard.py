@@ -0,0 +1,87 @@
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+
+
+class Shard(threading.Thread):
+    """
+    A single executor thread that owns a subset of the channels. Every join, message and history write for those
+    channels runs here one at a time, so channel state never needs its own lock.
+    """
+    def __init__(self, index):
+        threading.Thread.__init__(self, name="shard-{0}".format(index), daemon=True)
+        self.index = index
+        self.tasks = queue.Queue()
+
+    def submit(self, function, *args):
+        future = Future()
+        self.tasks.put((future, function, args))
+        return future
+
+    def stop(self):
+        self.tasks.put((None, None, None))
+
+    def run(self):
+        while True:
+            future, function, args = self.tasks.get()
+
+            if function is None:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+
+
+class ShardPool:
+    """
+    Partitions channels across a fixed number of shards by hashing the channel name. Shard tasks must never wait on
+    another shard; operations that touch several channels (/nick, /quit) are coordinated from the calling thread
+    with run_all.
+    """
+    def __init__(self, count):
+        self.shards = [Shard(index) for index in range(max(1, count))]
+
+        for shard in self.shards:
+            shard.start()
+
+    def shard_for(self, channelName):
+        return self.shards[zlib.crc32(channelName.encode('utf8')) % len(self.shards)]
+
+    def submit(self, channelName, function, *args):
+        return self.shard_for(channelName).submit(function, *args)
+
+    def run(self, channelName, function, *args):
+        shard = self.shard_for(channelName)
+
+        if threading.current_thread() is shard:
+            return function(*args)
+
+        return shard.submit(function, *args).result()
+
+    def run_all(self, channelNames, function):
+        # Calls function(channelName) on the owning shard of every channel. Each shard gets one task for all of its
+        # channels, the shards work in parallel and the caller waits for every one of them to finish.
+        groups = {}
+        for channelName in channelNames:
+            groups.setdefault(self.shard_for(channelName), []).append(channelName)
+
+        def run_group(names):
+            return [function(name) for name in names]
+
+        futures = [shard.submit(run_group, names) for shard, names in groups.items()]
+
+        results = []
+        for future in futures:
+            results.extend(future.result())
+
+        return results
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
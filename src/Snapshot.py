@@ -0,0 +1,222 @@
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+
+# File layout: MAGIC, a header (index offset, channel count, user count), the channel and user records, then an
+# index of (kind, name, offset, length) entries so a reader can find any record without decoding the others.
+MAGIC = b'CHATSNP1'
+HEADER = struct.Struct('!QII')
+INDEX_ENTRY = struct.Struct('!QI')
+CHANNEL_RECORD = 0
+USER_RECORD = 1
+
+
+def pack_string(text):
+    data = text.encode('utf8')
+    return struct.pack('!I', len(data)) + data
+
+
+def unpack_string(buffer, position):
+    length = struct.unpack_from('!I', buffer, position)[0]
+    position += 4
+    return bytes(buffer[position:position + length]).decode('utf8'), position + length
+
+
+def pack_offsets(offsets):
+    if sys.byteorder != 'little':
+        offsets = array.array('Q', offsets)
+        offsets.byteswap()
+    return struct.pack('!I', len(offsets)) + offsets.tobytes()
+
+
+def encode_channel(channel, history):
+    members = list(channel.users) # the owning shard may change the members while the snapshot is taken.
+    record = [pack_string(channel.topic), struct.pack('!I', len(members))]
+    record.extend(pack_string(user.username) for user in members)
+
+    if history is not None and history.offsets is not None:
+        record.append(struct.pack('!Q', history.size))
+        record.append(pack_offsets(history.offsets))
+    else:
+        record.append(struct.pack('!QI', 0, 0))
+
+    return b''.join(record)
+
+
+USER_FIELDS = ("fullname", "nickname", "usertype", "status", "awaymessage", "channel", "resume_token")
+
+
+def encode_user(user, channelNames):
+    # The channel field holds every channel the user is in, space separated, with the focused one last. The resume
+    # token is what the user has to present to get any of it back after a restart.
+    return b''.join(pack_string(field) for field in (user.fullname, user.nickname, user.usertype, user.status,
+                                                     user.awaymessage, ' '.join(channelNames),
+                                                     user.resume_token or ''))
+
+
+class SnapshotReader:
+    """
+    Maps a snapshot file and decodes records only when they are asked for, so start-up cost does not grow with the
+    number of channels beyond reading the index.
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not a chat server snapshot.".format(path))
+
+        indexOffset, channelCount, userCount = HEADER.unpack_from(self.buffer, len(MAGIC))
+        self.channels = {} # Channel Name -> (offset, length)
+        self.users = {} # User Name -> (offset, length)
+
+        position = indexOffset
+        for entry in range(channelCount + userCount):
+            kind = self.buffer[position]
+            name, position = unpack_string(self.buffer, position + 1)
+            (self.channels if kind == CHANNEL_RECORD else self.users)[name] = INDEX_ENTRY.unpack_from(self.buffer,
+                                                                                                     position)
+            position += INDEX_ENTRY.size
+
+    @staticmethod
+    def open(path):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+
+        try:
+            return SnapshotReader(path)
+        except (OSError, ValueError, struct.error) as errorMessage:
+            sys.stderr.write("Ignoring unreadable snapshot {0}. Error - {1}\n".format(path, errorMessage))
+            return None
+
+    def channel(self, channelName):
+        offset, length = self.channels[channelName]
+        topic, position = unpack_string(self.buffer, offset)
+
+        memberCount = struct.unpack_from('!I', self.buffer, position)[0]
+        position += 4
+        members = []
+        for member in range(memberCount):
+            username, position = unpack_string(self.buffer, position)
+            members.append(username)
+
+        logSize, offsetCount = struct.unpack_from('!QI', self.buffer, position)
+        position += 12
+        offsets = array.array('Q')
+        offsets.frombytes(self.buffer[position:position + offsetCount * offsets.itemsize])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        return {"topic": topic, "members": members, "log_size": logSize, "offsets": offsets}
+
+    def user(self, username):
+        offset, length = self.users[username]
+        fields = []
+        position = offset
+        for field in USER_FIELDS:
+            if position >= offset + length: # written before the field existed.
+                fields.append('')
+                continue
+            value, position = unpack_string(self.buffer, position)
+            fields.append(value)
+
+        return dict(zip(USER_FIELDS, fields))
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Periodically writes the server state to disk from its own thread. Only records whose channel or user changed
+    since the last snapshot are re-encoded; the rest are reused as they are.
+    """
+    def __init__(self, server, path, interval):
+        threading.Thread.__init__(self, name="snapshot", daemon=True)
+        self.server = server
+        self.path = path
+        self.interval = interval
+        self.stop_signal = threading.Event()
+        self.channel_records = {} # Channel Name -> (version, encoded record)
+        self.user_records = {} # User Name -> (version, encoded record)
+
+    def run(self):
+        while not self.stop_signal.wait(self.interval):
+            self.save()
+
+    def stop(self):
+        self.stop_signal.set()
+
+    def save(self):
+        try:
+            records, changed = self.collect()
+            if changed:
+                self.write(records)
+        except OSError as errorMessage:
+            sys.stderr.write("Failed to write snapshot {0}. Error - {1}\n".format(self.path, errorMessage))
+
+    def collect(self):
+        reencoded = 0
+
+        channelRecords = {}
+        for channelName, channel in list(self.server.channels.items()):
+            history = self.server.channel_files.get(channelName)
+            version = (channel.version, history.size if history is not None else 0)
+            cached = self.channel_records.get(channelName)
+            if cached is None or cached[0] != version:
+                cached = (version, encode_channel(channel, history))
+                reencoded += 1
+            channelRecords[channelName] = cached
+
+        userRecords = {}
+        for user in list(self.server.users):
+            if not user.username:
+                continue
+            channelNames = tuple(user.channel_names())
+            version = (user.version, channelNames, user.resume_token)
+            cached = self.user_records.get(user.username)
+            if cached is None or cached[0] != version:
+                cached = (version, encode_user(user, channelNames))
+                reencoded += 1
+            userRecords[user.username] = cached
+
+        # Channels and users from the previous snapshot that have not been touched since start-up are copied over
+        # byte for byte without being decoded.
+        previous = self.server.snapshot
+        if previous is not None:
+            for recordMap, previousIndex in ((channelRecords, previous.channels), (userRecords, previous.users)):
+                for name, (offset, length) in list(previousIndex.items()):
+                    if name not in recordMap:
+                        recordMap[name] = (None, previous.buffer[offset:offset + length])
+
+        changed = reencoded > 0 or set(channelRecords) != set(self.channel_records) \
+            or set(userRecords) != set(self.user_records)
+
+        self.channel_records = channelRecords
+        self.user_records = userRecords
+        return (channelRecords, userRecords), changed
+
+    def write(self, records):
+        channelRecords, userRecords = records
+        temporaryPath = self.path + ".tmp"
+
+        with open(temporaryPath, "wb") as snapshotFile:
+            snapshotFile.write(MAGIC + HEADER.pack(0, 0, 0))
+            index = []
+            offset = len(MAGIC) + HEADER.size
+
+            for kind, recordMap in ((CHANNEL_RECORD, channelRecords), (USER_RECORD, userRecords)):
+                for name, (version, record) in recordMap.items():
+                    snapshotFile.write(record)
+                    index.append(bytes([kind]) + pack_string(name) + INDEX_ENTRY.pack(offset, len(record)))
+                    offset += len(record)
+
+            snapshotFile.write(b''.join(index))
+            snapshotFile.seek(len(MAGIC))
+            snapshotFile.write(HEADER.pack(offset, len(channelRecords), len(userRecords)))
+
+        os.replace(temporaryPath, self.path)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+
+class Timer:
+    __slots__ = ("tick", "callback", "args", "slot")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+
+class TimerWheel(threading.Thread):
+    """
+    A hierarchical timing wheel driven by a single thread. Level L has 64 slots of 64**L ticks each; a timer sits in
+    the lowest level whose span still reaches its deadline and is moved down a level as the wheel turns. Scheduling
+    and cancelling are O(1) set operations, so one wheel serves every connection.
+    """
+    def __init__(self, tick=1.0, levels=4):
+        threading.Thread.__init__(self, name="timer-wheel", daemon=True)
+        self.tick = tick
+        self.levels = [[set() for slot in range(SLOTS)] for level in range(levels)]
+        self.current = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.stop_signal = threading.Event()
+
+    def schedule(self, delay, callback, *args):
+        with self.lock:
+            timer = Timer(self.current + max(1, int(delay / self.tick + 0.999)), callback, args)
+            self.place(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer is not None and timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+
+    def place(self, timer):
+        tick = max(timer.tick, self.current)
+
+        for level, slots in enumerate(self.levels):
+            shift = SLOT_BITS * level
+            if (tick >> shift) - (self.current >> shift) < SLOTS:
+                timer.slot = slots[(tick >> shift) & SLOT_MASK]
+                break
+        else: # Further out than the top level reaches; park it in the last slot and re-place it when it cascades.
+            shift = SLOT_BITS * (len(self.levels) - 1)
+            timer.slot = self.levels[-1][((self.current >> shift) + SLOT_MASK) & SLOT_MASK]
+
+        timer.slot.add(timer)
+
+    def advance(self):
+        with self.lock:
+            self.current += 1
+
+            # Cascade from the highest level whose slot boundary we just crossed down to level 1.
+            level = 1
+            while level < len(self.levels) and self.current & ((1 << (SLOT_BITS * level)) - 1) == 0:
+                level += 1
+            for cascadeLevel in range(level - 1, 0, -1):
+                slot = self.levels[cascadeLevel][(self.current >> (SLOT_BITS * cascadeLevel)) & SLOT_MASK]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self.place(timer)
+
+            slot = self.levels[0][self.current & SLOT_MASK]
+            expired = list(slot)
+            slot.clear()
+            for timer in expired:
+                timer.slot = None
+
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as error:
+                print("Timer callback failed: {0}".format(error))
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            delay = self.start_time + (self.current + 1) * self.tick - time.monotonic()
+            if delay > 0 and self.stop_signal.wait(delay):
+                break
+            self.advance()
+
+    def stop(self):
+        self.stop_signal.set()
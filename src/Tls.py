@@ -0,0 +1,92 @@
+import select
+import ssl
+import threading
+
+
+def server_context(certFile, keyFile, tickets=1):
+    # Resumption needs nothing beyond one shared context: OpenSSL keeps a session cache for TLS 1.2 clients and
+    # issues tickets to TLS 1.3 ones, all encrypted with keys that live as long as the context does.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certFile, keyFile)
+    if hasattr(context, "num_tickets"):
+        context.num_tickets = tickets
+    return context
+
+
+def client_context(caFile=None):
+    return ssl.create_default_context(cafile=caFile)
+
+
+class SecureSocket:
+    """
+    A client connection that is to be TLS once handshake() has run on the client's own thread, so the accept loop
+    never waits on a handshake. After it the socket is non-blocking and every read and write on the SSL object is
+    made under one lock, since it must not be used from two threads at once; the lock is never held while waiting
+    for the network, so a peer that stops reading cannot hold up its own reader, its outbox or the timer wheel.
+    Anything sent before the handshake has finished is dropped: the client cannot have registered yet, so it can
+    only be a broadcast it would never have seen anyway.
+    """
+    def __init__(self, sock, context):
+        self.socket = sock
+        self.context = context
+        self.secure = False
+        self.lock = threading.Lock()
+
+    def handshake(self, timeout):
+        with self.lock:
+            secureSocket = self.context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+            secureSocket.settimeout(timeout)
+            secureSocket.do_handshake()
+            secureSocket.setblocking(False)
+            self.socket = secureSocket
+            self.secure = True
+
+    def send(self, data, flags=0):
+        # Never blocks, whatever the flags (the ssl module takes none): returns 0 if another thread is using the SSL
+        # object or the socket is full, and the caller tries again with the same data.
+        if not self.secure:
+            return len(data)
+        if not self.lock.acquire(False):
+            return 0
+        try:
+            return self.socket.send(data)
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return 0
+        finally:
+            self.lock.release()
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            sent = self.send(view)
+            view = view[sent:]
+            if not sent:
+                select.select([], [self.socket], [], 1.0)
+
+    def recv_into(self, buffer, nbytes=0):
+        # Blocks only while waiting on the socket, without the lock, until a whole record has arrived.
+        while True:
+            with self.lock:
+                try:
+                    return self.socket.recv_into(buffer, nbytes)
+                except ssl.SSLWantReadError:
+                    readable, writable = [self.socket], []
+                except ssl.SSLWantWriteError:
+                    readable, writable = [], [self.socket]
+            select.select(readable, writable, [])
+
+    def pending(self):
+        # Bytes already decrypted and waiting, which poll() on the socket cannot see.
+        if not self.secure:
+            return 0
+        with self.lock:
+            return self.socket.pending()
+
+    def shutdown(self, how):
+        if not self.secure: # cuts a handshake short rather than waiting for it.
+            return self.socket.shutdown(how)
+        with self.lock:
+            self.socket.shutdown(how)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
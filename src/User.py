@@ -1,16 +1,50 @@
+import sys
 import Util
 
+NO_CHANNELS = {} # Shared by every user in no channel; only ever read, add_channel gives a user their own dict.
+
+
 class User:
+    # Slots instead of a __dict__ per connection; with tens of thousands of idle users this is most of their size.
+    __slots__ = ("_client_socket", "_fullname", "_username", "_nickname", "_password", "_usertype", "_status",
+                 "_awaymessage", "_channels", "version", "buffer", "last_seen", "last_activity", "auto_away",
+                 "idle_timer", "resume_token", "framed", "focus", "address")
+
     def __init__(self, client_socket, fullname='',username='', nickname=Util.generate_random_nickname(), password='', usertype='user'):
         self._client_socket = client_socket
         self._fullname = fullname
-        self._username = username
-        self._nickname = nickname
+        self._username = sys.intern(username)
+        self._nickname = sys.intern(nickname)
         self._password = password
         self._usertype = usertype
         self._status = "Online"
-        self.awaymessage = ""
-        self.channels = {}   # Channels that user has connected to from latest to most recent.
+        self._awaymessage = ""
+        self._channels = None
+        self.version = 0 # Bumped by every setter so snapshots know what to re-encode.
+        self.buffer = b''   # Received bytes not yet decoded (a multi-byte character split across reads).
+        self.last_seen = 0          # When anything, keepalive replies included, last arrived (time.monotonic()).
+        self.last_activity = 0      # When the user last sent a command or message.
+        self.auto_away = False      # Set when the server marked the user away for being idle.
+        self.idle_timer = None
+        self.resume_token = None
+        self.framed = False         # Negotiated with /caps framed: input is split on newlines and replies are framed.
+        self.focus = None    # The channel plain messages go to.
+        self.address = None  # (IP address, port) of the peer.
+
+    @property
+    def channels(self):
+        # Channel Name -> Channel for every channel the user is in, in the order they were joined.
+        return self._channels if self._channels is not None else NO_CHANNELS
+
+    def add_channel(self, channelName, channel):
+        if self._channels is None:
+            self._channels = {}
+        self._channels[channelName] = channel
+
+    def channel_names(self):
+        # The focused channel comes last, so joining these in order gives the same focus back.
+        return [channelName for channelName in self.channels if channelName != self.focus] + \
+            ([self.focus] if self.focus in self.channels else [])
 
     @property
     def socket(self):
@@ -40,26 +74,45 @@ class User:
     def status(self):
         return self._status
 
+    @property
+    def awaymessage(self):
+        return self._awaymessage
+
+    @socket.setter
+    def socket(self, new_socket):
+        self._client_socket = new_socket
+
     @fullname.setter
     def fullname(self, new_fullname):
         self._fullname = new_fullname
+        self.version += 1
 
     @username.setter
     def username(self, new_username):
-        self._username = new_username
+        self._username = sys.intern(new_username)
+        self.version += 1
 
     @nickname.setter
     def nickname(self, new_nickname):
-        self._nickname = new_nickname
+        self._nickname = sys.intern(new_nickname)
+        self.version += 1
 
     @usertype.setter
     def usertype(self, new_usertype):
         self._usertype = new_usertype
+        self.version += 1
 
     @password.setter
     def password(self, new_password):
         self._password = new_password
+        self.version += 1
 
     @status.setter
     def status(self, new_status):
         self._status = new_status
+        self.version += 1
+
+    @awaymessage.setter
+    def awaymessage(self, new_awaymessage):
+        self._awaymessage = new_awaymessage
+        self.version += 1
@@ -0,0 +1,66 @@
+import threading
+
+
+class UsernameAllocator:
+    """
+    Hands out unique usernames of the form <prefix><suffix>, where the prefix comes from the user's name and the
+    suffix is at least three digits. Each prefix keeps a counter of the next never-used suffix and a free list of
+    suffixes given back, so allocating is O(1) however crowded a prefix gets; once 999 is passed the suffixes simply
+    grow a digit. Names taken some other way (a /nick, or a user handed over by a hot restart) are claimed so they
+    are skipped. Every name also records the connected user holding it, so users can be found by name in O(1).
+    """
+    def __init__(self):
+        self.owners = {} # Username -> the connected User holding it, or None while only a resume session holds it.
+        self.allocated = {} # Username -> (prefix, suffix) for names that came from allocate.
+        self.next_suffix = {} # Prefix -> the lowest suffix never handed out
+        self.free = {} # Prefix -> [suffixes handed back]
+        self.lock = threading.Lock()
+
+    def __contains__(self, username):
+        return username in self.owners
+
+    def owner(self, username):
+        return self.owners.get(username)
+
+    def assign(self, username, owner):
+        # Moves a name that is already held to another holder, e.g. from a resume session to the new connection.
+        with self.lock:
+            if username in self.owners:
+                self.owners[username] = owner
+
+    def allocate(self, prefix, owner=None):
+        with self.lock:
+            free = self.free.get(prefix)
+
+            while True:
+                if free:
+                    suffix = free.pop()
+                else:
+                    suffix = self.next_suffix.get(prefix, 1)
+                    self.next_suffix[prefix] = suffix + 1
+
+                username = "{0}{1:03d}".format(prefix, suffix)
+                if username not in self.owners: # otherwise someone claimed it as a nickname; that suffix stays theirs.
+                    break
+
+            self.owners[username] = owner
+            self.allocated[username] = (prefix, suffix)
+            return username
+
+    def claim(self, username, owner=None):
+        # Takes a specific name; False if it is already in use.
+        with self.lock:
+            if username in self.owners:
+                return False
+            self.owners[username] = owner
+            return True
+
+    def release(self, username):
+        with self.lock:
+            if username not in self.owners:
+                return
+
+            del self.owners[username]
+            allocation = self.allocated.pop(username, None)
+            if allocation is not None:
+                self.free.setdefault(allocation[0], []).append(allocation[1])
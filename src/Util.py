@@ -1,7 +1,13 @@
 import random
+import re
 import string
 
-def generate_username(name):
+# Control tags ride along with normal text as \x02kind args\x03. Clients strip them before displaying anything.
+TAG_START = '\x02'
+TAG_END = '\x03'
+TAG_PATTERN = re.compile('\x02([^\x02\x03]*)\x03')
+
+def username_prefix(name):
     names = name.split(" ")
 
     if len(names) <= 1:
@@ -9,9 +15,13 @@ def generate_username(name):
 
     first_letter = name[0][0]
     three_letters_surname = names[-1][:3]
-    number = '{:03d}'.format(random.randrange(1, 999))
 
-    return "{0}{1}{2}".format(first_letter, three_letters_surname, number)
+    return "{0}{1}".format(first_letter, three_letters_surname)
+
+def generate_username(name):
+    # Not unique on its own; the server hands out names with Usernames.UsernameAllocator.
+    prefix = username_prefix(name)
+    return "{0}{1:03d}".format(prefix, random.randrange(1, 999)) if prefix else ""
 
 def generate_random_nickname():
     minLength = 8
@@ -19,3 +29,17 @@ def generate_random_nickname():
     length = random.randint(minLength, maxLength)
 
     return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+def make_tag(kind, *args):
+    return TAG_START + ' '.join([kind] + [str(arg) for arg in args]) + TAG_END
+
+def split_tags(message):
+    # Returns the displayable text, the (kind, args) tags found, and any trailing partial tag to prepend to the
+    # next chunk received.
+    remainder = ''
+    start = message.rfind(TAG_START)
+    if start != -1 and message.find(TAG_END, start) == -1:
+        message, remainder = message[:start], message[start:]
+
+    tags = [(tag.split(' ')[0], tag.split(' ')[1:]) for tag in TAG_PATTERN.findall(message)]
+    return TAG_PATTERN.sub('', message), tags, remainder